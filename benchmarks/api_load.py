@@ -0,0 +1,158 @@
+""" Load test comparing the WSGI (Flask) and async (ASGI) serving modes of the metrics API.
+
+Fills a scratch database file with a day of once-a-minute values for a set of tickers, serves it
+over HTTP on localhost from the threaded Werkzeug server (as `flask run` does) and from uvicorn,
+and has a pool of concurrent clients hammer `/metrics/<id>` on each. Reports p50 and p99 latency
+and requests/sec. The WSGI app is measured both with and without its response cache, since a
+cache hit skips the very queries being compared.
+
+Run from the root project directory with `python -m benchmarks.api_load`. """
+
+# Serve a scratch database file rather than the filesystem production one. Both serving modes need
+# to share it, so an in-memory database won't do.
+import os
+from tempfile import TemporaryDirectory
+
+_DIRECTORY = TemporaryDirectory()
+os.environ['MONTECARLO_DATABASE_URI'] = 'sqlite:///' + os.path.join(
+    _DIRECTORY.name, 'metrics_db.sqlite'
+)
+
+from datetime import datetime, timedelta
+from logging import getLogger, WARNING
+from random import Random
+from statistics import median
+from threading import Thread
+from time import perf_counter, sleep
+
+import requests
+import uvicorn
+
+from werkzeug.serving import make_server
+
+from montecarlo import DB, app
+from montecarlo.api.cache import LocalCacheBackend, RESPONSE_CACHE
+from montecarlo.asgi import asgi_app
+from montecarlo.persistence.metrics_manager import (
+    _insert_metric_values,
+    bulk_save_metrics,
+    get_all_crypto_pair_metrics,
+    rebuild_rolling_stats,
+    refresh_metric_rankings
+)
+
+_TICKERS = 20
+_HISTORY_MINUTES = 24 * 60
+_CLIENTS = 16
+_REQUESTS_PER_CLIENT = 10
+_WSGI_PORT = 8765
+_ASGI_PORT = 8766
+
+
+def _fill_database():
+    now = datetime.utcnow()
+    bulk_save_metrics({
+        'MARKET:PAIR{}USD'.format(t): {'price': 100.0, 'volume': 10.0} for t in range(_TICKERS)
+    }, now)
+    metric_ids = [m.id for m in get_all_crypto_pair_metrics()]
+
+    random = Random(0)
+    for minute in range(1, _HISTORY_MINUTES):
+        timestamp = now - timedelta(minutes=minute)
+        _insert_metric_values([
+            {'custom_metric_id': m, 'metric_value': random.uniform(90, 110), 'timestamp': timestamp}
+            for m in metric_ids
+        ])
+    rebuild_rolling_stats(now)
+    DB.session.commit()
+    refresh_metric_rankings(now)
+
+    return metric_ids
+
+
+def _client(base_url, metric_ids, seed, latencies):
+    random = Random(seed)
+    with requests.Session() as session:
+        for _ in range(_REQUESTS_PER_CLIENT):
+            url = '{}/metrics/{}'.format(base_url, random.choice(metric_ids))
+            start = perf_counter()
+            session.get(url).raise_for_status()
+            latencies.append(perf_counter() - start)
+
+
+def _load(base_url, metric_ids):
+    latencies = list()
+    clients = [
+        Thread(target=_client, args=(base_url, metric_ids, n, latencies))
+        for n in range(_CLIENTS)
+    ]
+
+    start = perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = perf_counter() - start
+
+    latencies.sort()
+    return (
+        median(latencies) * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000,
+        len(latencies) / elapsed
+    )
+
+
+def _serve_wsgi():
+    getLogger('werkzeug').setLevel(WARNING)
+    server = make_server('127.0.0.1', _WSGI_PORT, app, threaded=True)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server.shutdown
+
+
+def _serve_asgi():
+    server = uvicorn.Server(uvicorn.Config(
+        asgi_app, host='127.0.0.1', port=_ASGI_PORT, log_level='warning'
+    ))
+    Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        sleep(0.01)
+
+    def shutdown():
+        server.should_exit = True
+
+    return shutdown
+
+
+def run():
+    metric_ids = _fill_database()
+    DB.session.remove()
+
+    print('{} metrics with {} values each, {} clients x {} requests'.format(
+        len(metric_ids), _HISTORY_MINUTES, _CLIENTS, _REQUESTS_PER_CLIENT
+    ))
+    print('{:>24} {:>10} {:>10} {:>10}'.format('mode', 'p50 (ms)', 'p99 (ms)', 'req/sec'))
+
+    stop_wsgi = _serve_wsgi()
+    wsgi_url = 'http://127.0.0.1:{}'.format(_WSGI_PORT)
+
+    cache_backend = RESPONSE_CACHE.backend
+    RESPONSE_CACHE.backend = LocalCacheBackend(max_bytes=0)
+    print('{:>24} {:>10.1f} {:>10.1f} {:>10.0f}'.format(
+        'wsgi, no response cache', *_load(wsgi_url, metric_ids)
+    ))
+
+    RESPONSE_CACHE.backend = cache_backend
+    print('{:>24} {:>10.1f} {:>10.1f} {:>10.0f}'.format(
+        'wsgi', *_load(wsgi_url, metric_ids)
+    ))
+    stop_wsgi()
+
+    stop_asgi = _serve_asgi()
+    print('{:>24} {:>10.1f} {:>10.1f} {:>10.0f}'.format(
+        'asgi', *_load('http://127.0.0.1:{}'.format(_ASGI_PORT), metric_ids)
+    ))
+    stop_asgi()
+
+
+if __name__ == '__main__':
+    run()
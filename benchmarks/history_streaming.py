@@ -0,0 +1,141 @@
+""" Benchmark for serializing a very long metric history in metrics_info.
+
+Fills a scratch database file with 1M values for one metric within the last 24 hours, then
+requests its history both the way metrics_info used to build it (every value loaded as an ORM
+object, converted to a dict, and serialized in one go) and as it now streams it (row tuples from a
+streaming cursor, serialized a batch at a time), and in each of the columnar formats it offers by
+content negotiation. Reports time to first byte, total time, body size and the peak RSS growth of
+each, measured in a forked process of its own so one doesn't inflate the other.
+
+Linux only. Run from the root project directory with `python -m benchmarks.history_streaming`. """
+
+# A database of this size doesn't belong in memory, or in the production database.
+import os
+from tempfile import TemporaryDirectory
+
+_DIRECTORY = TemporaryDirectory()
+os.environ['MONTECARLO_DATABASE_URI'] = 'sqlite:///' + os.path.join(
+    _DIRECTORY.name, 'metrics_db.sqlite'
+)
+
+from datetime import datetime, timedelta
+from functools import partial
+from multiprocessing import get_context
+from resource import getpagesize, getrusage, RUSAGE_SELF
+from time import perf_counter
+
+from flask import json
+
+from montecarlo import DB, app
+from montecarlo.api.columnar import COLUMNAR_JSON_MIMETYPE, JSON_MIMETYPE, PACKED_MIMETYPE
+from montecarlo.persistence.metrics_manager import (
+    _insert_metric_values,
+    bulk_save_metrics,
+    get_24h_metric_history,
+    get_all_crypto_pair_metrics,
+    rebuild_rolling_stats,
+    refresh_metric_rankings
+)
+
+_ROWS = 1000000
+_INSERT_BATCH = 100000
+
+
+def _fill_database():
+    now = datetime.utcnow()
+    bulk_save_metrics({'MARKET:PAIRUSD': {'price': 100.0}}, now)
+    metric_id = get_all_crypto_pair_metrics()[0].id
+
+    spacing = timedelta(days=1) / (_ROWS + 1)
+    for start in range(1, _ROWS, _INSERT_BATCH):
+        _insert_metric_values([
+            {
+                'custom_metric_id': metric_id,
+                'metric_value': 100.0 + (n % 1000) / 100,
+                'timestamp': now - spacing * n
+            }
+            for n in range(start, min(start + _INSERT_BATCH, _ROWS))
+        ])
+    DB.session.commit()
+
+    rebuild_rolling_stats(now)
+    DB.session.commit()
+    refresh_metric_rankings(now)
+    DB.session.remove()
+
+    return metric_id
+
+
+def _rss_bytes():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * getpagesize()
+
+
+def _buffered(metric_id):
+    """ The history as metrics_info used to serialize it. Nothing can be sent until it's done. """
+
+    start = perf_counter()
+    with app.app_context():
+        body = json.dumps({
+            'id': metric_id,
+            'metric_24h_history': [
+                m.to_json() for m in get_24h_metric_history(metric_id, datetime.utcnow())
+            ]
+        }).encode()
+        DB.session.remove()
+    elapsed = perf_counter() - start
+
+    return elapsed, elapsed, len(body)
+
+
+def _served(mimetype, metric_id):
+    """ The history as metrics_info serves it now, in the specified format. """
+
+    start = perf_counter()
+    with app.test_client() as c:
+        # The test client reads the first chunk of the body before returning.
+        response = c.get(
+            '/metrics/{}'.format(metric_id), headers={'Accept': mimetype}, buffered=False
+        )
+        first_byte = perf_counter() - start
+        size = sum(len(chunk) for chunk in response.iter_encoded())
+        response.close()
+    elapsed = perf_counter() - start
+
+    return first_byte, elapsed, size
+
+
+def _measure(serialize, metric_id, results):
+    rss_before = _rss_bytes()
+    first_byte, elapsed, size = serialize(metric_id)
+    peak_rss_growth = getrusage(RUSAGE_SELF).ru_maxrss * 1024 - rss_before
+    results.put((first_byte, elapsed, size, peak_rss_growth))
+
+
+def run():
+    metric_id = _fill_database()
+    print('{} values in the history'.format(_ROWS))
+    print('{:>14} {:>10} {:>10} {:>12} {:>16}'.format(
+        'mode', 'TTFB (s)', 'total (s)', 'body (MB)', 'peak RSS (MB)'
+    ))
+
+    context = get_context('fork')
+    for name, serialize in [
+        ('buffered', _buffered),
+        ('streamed', partial(_served, JSON_MIMETYPE)),
+        ('columnar json', partial(_served, COLUMNAR_JSON_MIMETYPE)),
+        ('packed', partial(_served, PACKED_MIMETYPE))
+    ]:
+        results = context.Queue()
+        process = context.Process(target=_measure, args=(serialize, metric_id, results))
+        process.start()
+        first_byte, elapsed, size, peak_rss_growth = results.get()
+        process.join()
+
+        print('{:>14} {:>10.2f} {:>10.2f} {:>12.1f} {:>16.1f}'.format(
+            name, first_byte, elapsed, size / 2 ** 20, peak_rss_growth / 2 ** 20
+        ))
+
+
+if __name__ == '__main__':
+    run()
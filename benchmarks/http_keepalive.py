@@ -0,0 +1,129 @@
+""" Benchmark for making Cryptowatch requests over the pooled keep-alive session rather than a new
+connection per request.
+
+Points the Cryptowatch client at a local stub server, which sleeps for a fixed latency on every
+request and again on every new connection (standing in for the TCP and TLS handshakes with a
+remote API), then times pull_market_summary calls, one at a time and from a thread pool, over a
+new connection each time and over the pooled session. Reports per-request latency and how many
+connections each way opened.
+
+Run from the root project directory with `python -m benchmarks.http_keepalive`. """
+
+# Use an in-memory SQLite database rather than the filesystem production one.
+import os
+os.environ['MONTECARLO_TEST_ENV'] = 'true'
+
+import json
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from statistics import mean, median
+from threading import Lock, Thread
+from time import perf_counter, sleep
+from unittest.mock import patch
+
+from requests import Session
+
+from montecarlo.metrics.config import HttpConfig
+from montecarlo.metrics.crypto import cw_client, pull_market_summary
+from montecarlo.metrics.http_session import create_session, get_connection_stats
+
+_CONNECT_LATENCY_SECONDS = 0.02
+_REQUEST_LATENCY_SECONDS = 0.002
+_REQUESTS = 200
+_WORKERS = 8
+
+_BODY = json.dumps({
+    'result': {'price': {'last': 123.45}, 'volume': 67.89},
+    'allowance': {'cost': 0.005, 'remaining': 9.5}
+}).encode()
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    # Send each response as soon as it's written, as a real server would.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        sleep(_CONNECT_LATENCY_SECONDS)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        sleep(_REQUEST_LATENCY_SECONDS)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(_BODY)))
+        self.end_headers()
+        self.wfile.write(_BODY)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ConnectionPerRequest:
+    """ Stands in for a session, making every request over a new connection. """
+
+    def get(self, url, **kwargs):
+        with Session() as session:
+            return session.get(url, **kwargs)
+
+
+def _time_requests(workers):
+    def timed(_):
+        start = perf_counter()
+        pull_market_summary('MARKET:PAIRUSD')
+        return perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return sorted(executor.map(timed, range(_REQUESTS)))
+
+
+def run():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+    server.daemon_threads = True
+    server.lock = Lock()
+    server.connections = 0
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    print('{} requests, {:.0f}ms injected latency per connection, {:.0f}ms per request'.format(
+        _REQUESTS, _CONNECT_LATENCY_SECONDS * 1000, _REQUEST_LATENCY_SECONDS * 1000
+    ))
+    print('{:>8} {:>24} {:>10} {:>10} {:>10} {:>12}'.format(
+        'threads', 'session', 'mean (ms)', 'p50 (ms)', 'p99 (ms)', 'connections'
+    ))
+
+    endpoint = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    with patch.object(cw_client.requestor, 'rest_endpoint', endpoint), \
+            patch('montecarlo.metrics.crypto._log'):
+        for workers in [1, _WORKERS]:
+            for name, session in [
+                ('connection per request', _ConnectionPerRequest()),
+                ('pooled keep-alive', create_session(HttpConfig({'pool_size': _WORKERS})))
+            ]:
+                server.connections = 0
+                with patch.object(cw_client.requestor, 'api_client', session):
+                    latencies = _time_requests(workers)
+
+                print('{:>8} {:>24} {:>10.2f} {:>10.2f} {:>10.2f} {:>12}'.format(
+                    workers,
+                    name,
+                    mean(latencies) * 1000,
+                    median(latencies) * 1000,
+                    latencies[int(len(latencies) * 0.99) - 1] * 1000,
+                    server.connections
+                ))
+
+                if isinstance(session, Session):
+                    print('{:>8} {}'.format('', get_connection_stats(session).to_json()))
+                    session.close()
+
+    server.shutdown()
+    server.server_close()
+
+
+if __name__ == '__main__':
+    run()
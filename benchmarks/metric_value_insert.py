@@ -0,0 +1,69 @@
+""" Micro-benchmark comparing the ORM and Core write paths for MetricInstanceValues.
+
+The ORM path builds one MetricInstanceValue per value and adds each to the session, which is how
+bulk_save_metrics used to persist a cycle. The Core path is the single executemany INSERT that it
+uses now. Reports rows/sec for each path at a range of batch sizes.
+
+Run from the root project directory with `python -m benchmarks.metric_value_insert`. """
+
+# Use an in-memory SQLite database rather than the filesystem production one.
+import os
+os.environ['MONTECARLO_TEST_ENV'] = 'true'
+
+from datetime import datetime
+from time import perf_counter
+
+from montecarlo import DB
+from montecarlo.persistence.metrics_manager import _insert_metric_values
+from montecarlo.persistence.models import CryptoPairMetric, MetricInstanceValue
+
+_ROW_COUNTS = [10, 1000, 100000]
+
+
+def _orm_insert(metric_id, row_count, timestamp):
+    for i in range(row_count):
+        DB.session.add(MetricInstanceValue(
+            custom_metric_id=metric_id,
+            metric_value=float(i),
+            timestamp=timestamp
+        ))
+    DB.session.commit()
+
+
+def _core_insert(metric_id, row_count, timestamp):
+    _insert_metric_values([
+        {'custom_metric_id': metric_id, 'metric_value': float(i), 'timestamp': timestamp}
+        for i in range(row_count)
+    ])
+    DB.session.commit()
+
+
+def _time(insert, row_count):
+    DB.drop_all()
+    DB.create_all()
+
+    metric = CryptoPairMetric(ticker='KRAKEN:BTCUSD', metric_type='price')
+    DB.session.add(metric)
+    DB.session.commit()
+
+    start = perf_counter()
+    insert(metric.id, row_count, datetime.utcnow())
+    elapsed = perf_counter() - start
+
+    assert MetricInstanceValue.query.count() == row_count
+    return row_count / elapsed
+
+
+def run():
+    print('{:>10} {:>16} {:>16} {:>10}'.format('rows', 'ORM rows/s', 'Core rows/s', 'speedup'))
+
+    for row_count in _ROW_COUNTS:
+        orm_rate = _time(_orm_insert, row_count)
+        core_rate = _time(_core_insert, row_count)
+        print('{:>10} {:>16,.0f} {:>16,.0f} {:>9.1f}x'.format(
+            row_count, orm_rate, core_rate, core_rate / orm_rate
+        ))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,77 @@
+""" Benchmark for the concurrent market summary fan-out in poll_crypto_metrics.
+
+Runs full poll cycles against a stubbed Cryptowatch client which sleeps for a fixed latency on
+every request, and reports how the cycle time scales with the size of the polling thread pool.
+
+Run from the root project directory with `python -m benchmarks.poll_fanout`. """
+
+# Use an in-memory SQLite database rather than the filesystem production one.
+import os
+os.environ['MONTECARLO_TEST_ENV'] = 'true'
+
+import json
+
+from time import perf_counter, sleep
+from unittest.mock import Mock, patch
+
+from montecarlo.metrics.config import GovernorConfig, PollingConfig
+from montecarlo.metrics.crypto import poll_crypto_metrics
+from montecarlo.metrics.governor import RequestGovernor
+
+_LATENCY_SECONDS = 0.05
+_MARKETS = 10
+_PAIRS_PER_MARKET = 20
+_POOL_SIZES = [1, 2, 4, 8, 16, 32]
+
+
+def _fake_market_summary(resource):
+    """ Stand-in for cw_client.requestor.get_resource which simulates network latency. """
+
+    sleep(_LATENCY_SECONDS)
+
+    return json.dumps({'result': {'price': {'last': 123.45}, 'volume': 67.89}}), None
+
+
+def _build_markets():
+    markets = list()
+    for m in range(_MARKETS):
+        market = Mock()
+        market.name = 'MARKET{}'.format(m)
+        market.pairs = ['PAIR{}USD'.format(p) for p in range(_PAIRS_PER_MARKET)]
+        markets.append(market)
+    return markets
+
+
+def run():
+    tickers = _MARKETS * _PAIRS_PER_MARKET
+    print('{} tickers, {:.0f}ms injected latency per request'.format(
+        tickers, _LATENCY_SECONDS * 1000
+    ))
+    print('{:>10} {:>12} {:>14}'.format('pool size', 'cycle (s)', 'speedup'))
+
+    baseline = None
+    with patch('montecarlo.metrics.crypto.cw_client') as patched_cw_client, \
+            patch('montecarlo.metrics.crypto.CRYPTO_CONFIG') as patched_config:
+        patched_cw_client.requestor.get_resource.side_effect = _fake_market_summary
+        patched_config.markets = _build_markets()
+
+        for pool_size in _POOL_SIZES:
+            # Keep every ticker a single request, and give every cycle the budget to poll them all.
+            patched_config.polling = PollingConfig({
+                'max_workers': pool_size,
+                'max_per_market': pool_size,
+                'bulk_threshold': _PAIRS_PER_MARKET + 1
+            })
+            governor = RequestGovernor(GovernorConfig({'burst': tickers}))
+
+            start = perf_counter()
+            with patch('montecarlo.metrics.crypto.REQUEST_GOVERNOR', governor):
+                poll_crypto_metrics()
+            elapsed = perf_counter() - start
+
+            baseline = baseline or elapsed
+            print('{:>10} {:>12.3f} {:>13.1f}x'.format(pool_size, elapsed, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    run()
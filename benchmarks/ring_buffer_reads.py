@@ -0,0 +1,104 @@
+""" Benchmark for reading recent metric values from the memory-mapped ring buffers rather than
+the database.
+
+Fills a scratch database file with a day of once-a-minute values for a set of tickers, builds
+their ring buffers from it as the poller would, then times the reads behind the metrics_info and
+summary endpoints (a metric's 24-hour history, as rows and as columns, and the 24-hour aggregates
+and summaries of every metric of its type) both ways.
+
+Run from the root project directory with `python -m benchmarks.ring_buffer_reads`. """
+
+# A scratch database file and ring buffer directory, rather than the production ones.
+import os
+from tempfile import TemporaryDirectory
+
+_DIRECTORY = TemporaryDirectory()
+os.environ['MONTECARLO_DATABASE_URI'] = 'sqlite:///' + os.path.join(
+    _DIRECTORY.name, 'metrics_db.sqlite'
+)
+os.environ['METRICS_RING_BUFFER_DIR'] = os.path.join(_DIRECTORY.name, 'ring_buffers')
+
+from datetime import datetime, timedelta
+from random import Random
+from time import perf_counter
+from unittest.mock import patch
+
+from montecarlo import DB
+from montecarlo.metrics.analytics import get_24h_metric_summaries
+from montecarlo.persistence import metrics_manager
+from montecarlo.persistence.metrics_manager import (
+    _append_to_ring_buffers,
+    _insert_metric_values,
+    bulk_save_metrics,
+    get_24h_metric_aggregates,
+    get_all_crypto_pair_metrics,
+    stream_24h_metric_history,
+    stream_24h_metric_history_columns
+)
+
+_TICKERS = 20
+_HISTORY_MINUTES = 24 * 60
+_REPEATS = 50
+_BATCH_SIZE = 1000
+
+
+def _fill_database():
+    now = datetime.utcnow()
+    bulk_save_metrics({
+        'MARKET:PAIR{}USD'.format(t): {'price': 100.0} for t in range(_TICKERS)
+    }, now)
+    metric_ids = [m.id for m in get_all_crypto_pair_metrics()]
+
+    random = Random(0)
+    for minute in range(1, _HISTORY_MINUTES):
+        _insert_metric_values([
+            {
+                'custom_metric_id': m,
+                'metric_value': random.uniform(90, 110),
+                'timestamp': now - timedelta(minutes=minute)
+            }
+            for m in metric_ids
+        ])
+    DB.session.commit()
+
+    # The poller's first write to each ring buffer fills it from the database
+    _append_to_ring_buffers([
+        {'custom_metric_id': m, 'metric_value': 100.0, 'timestamp': now} for m in metric_ids
+    ])
+
+    return metric_ids, now
+
+
+def _time(read):
+    start = perf_counter()
+    for _ in range(_REPEATS):
+        read()
+    return (perf_counter() - start) / _REPEATS * 1000
+
+
+def run():
+    metric_ids, now = _fill_database()
+    metric_id = metric_ids[0]
+
+    reads = [
+        ('history rows', lambda: [
+            rows for rows in stream_24h_metric_history(metric_id, now, _BATCH_SIZE)
+        ]),
+        ('history columns', lambda: [
+            columns for columns in stream_24h_metric_history_columns(metric_id, now, _BATCH_SIZE)
+        ]),
+        ('type aggregates', lambda: get_24h_metric_aggregates('price', now)),
+        ('type summaries', lambda: get_24h_metric_summaries('price', now))
+    ]
+
+    print('{} metrics with {} values each'.format(len(metric_ids), _HISTORY_MINUTES))
+    print('{:>16} {:>14} {:>16}'.format('read', 'database (ms)', 'ring buffer (ms)'))
+    for name, read in reads:
+        with patch.object(metrics_manager, 'RING_BUFFERS', None):
+            database = _time(read)
+        ring_buffer = _time(read)
+        print('{:>16} {:>14.2f} {:>16.2f}'.format(name, database, ring_buffer))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,144 @@
+""" Benchmark for streaming new metric values to many connected clients.
+
+A stub poller saves a cycle of values for every ticker at a fixed interval and the metric feed
+publishes them, while a pool of simulated dashboard clients holds /metrics/stream connections open
+and reads events. A few of the clients are deliberately slow, to show them being dropped once
+their queues fill rather than holding up everyone else. Reports how long values took to reach the
+clients, and how many clients were dropped.
+
+Run from the root project directory with `python -m benchmarks.stream_fanout`. """
+
+# Use an in-memory SQLite database rather than the filesystem production one.
+import os
+os.environ['MONTECARLO_TEST_ENV'] = 'true'
+
+import json
+
+from datetime import datetime, timedelta
+from statistics import median
+from threading import Lock, Thread
+from time import perf_counter, sleep
+from unittest.mock import patch
+
+from montecarlo import app
+from montecarlo.api.stream import METRIC_HUB, MetricFeed
+from montecarlo.persistence.metrics_manager import bulk_save_metrics, get_all_crypto_pair_metrics
+
+_TICKERS = 50
+_CYCLES = 40
+_CYCLE_SECONDS = 0.05
+_CLIENTS = 200
+_SLOW_CLIENTS = 10
+_SLOW_CLIENT_SECONDS = 0.05
+_METRICS_PER_CLIENT = 5
+_QUEUE_SIZE = 20
+
+
+def _ticker_metric_map(cycle):
+    return {
+        'MARKET:PAIR{}USD'.format(t): {'price': 100.0 + cycle + t, 'volume': 10.0 + cycle}
+        for t in range(_TICKERS)
+    }
+
+
+class _Results:
+
+    def __init__(self):
+        self.latencies = list()
+        self.dropped = 0
+        self.lock = Lock()
+
+
+def _client(metric_ids, slow, saved_at, results):
+    """ A dashboard holding a stream open until the last cycle's values arrive or it's dropped. """
+
+    last_timestamp = str(saved_at['last'])
+    url = '/metrics/stream?ids={}'.format(','.join(str(m) for m in metric_ids))
+
+    with app.test_client() as c:
+        response = c.get(url, buffered=False)
+        try:
+            for chunk in response.response:
+                event = chunk.decode()
+                if event.startswith('event: dropped'):
+                    with results.lock:
+                        results.dropped += 1
+                    return
+                if not event.startswith('event: value'):
+                    continue
+
+                value = json.loads(event.split('data: ')[1])
+                latency = perf_counter() - saved_at[value['timestamp']]
+                with results.lock:
+                    results.latencies.append(latency)
+
+                if slow:
+                    sleep(_SLOW_CLIENT_SECONDS)
+                if value['timestamp'] == last_timestamp:
+                    return
+        finally:
+            response.close()
+
+
+def run():
+    start = datetime.utcnow()
+    timestamps = [start + timedelta(minutes=n) for n in range(1, _CYCLES + 1)]
+
+    # Create the metrics up front, so clients have IDs to subscribe to.
+    bulk_save_metrics(_ticker_metric_map(0), start)
+    metric_ids = [m.id for m in get_all_crypto_pair_metrics()]
+
+    saved_at = {'last': timestamps[-1]}
+    results = _Results()
+    feed = MetricFeed(METRIC_HUB, poll_seconds=_CYCLE_SECONDS)
+    feed.check()
+
+    # The feed is checked by the stub poller itself below, so it's never started in the
+    # background, and both share the in-memory database's single connection from one thread.
+    with patch('montecarlo.api.routes.METRIC_FEED'), \
+            patch.dict(app.config, {
+                'METRICS_STREAM_QUEUE_SIZE': _QUEUE_SIZE,
+                'METRICS_STREAM_HEARTBEAT_SECONDS': 1
+            }):
+
+        clients = list()
+        for n in range(_CLIENTS):
+            subscribed = [
+                metric_ids[(n + k) % len(metric_ids)] for k in range(_METRICS_PER_CLIENT)
+            ]
+            clients.append(Thread(
+                target=_client, args=(subscribed, n < _SLOW_CLIENTS, saved_at, results)
+            ))
+        for client in clients:
+            client.start()
+
+        while len(METRIC_HUB) < _CLIENTS:
+            sleep(0.01)
+
+        print('{} clients ({} slow) of {} metrics each, {} cycles of {} metrics'.format(
+            _CLIENTS, _SLOW_CLIENTS, _METRICS_PER_CLIENT, _CYCLES, len(metric_ids)
+        ))
+
+        publish_start = perf_counter()
+        for n, timestamp in enumerate(timestamps):
+            bulk_save_metrics(_ticker_metric_map(n + 1), timestamp)
+            saved_at[str(timestamp)] = perf_counter()
+            feed.check()
+            sleep(_CYCLE_SECONDS)
+
+        for client in clients:
+            client.join()
+        elapsed = perf_counter() - publish_start
+
+    latencies = sorted(results.latencies)
+    print('{} values delivered in {:.2f}s, {:.0f} values/sec'.format(
+        len(latencies), elapsed, len(latencies) / elapsed
+    ))
+    print('latency from commit: median {:.1f}ms, p99 {:.1f}ms'.format(
+        median(latencies) * 1000, latencies[int(len(latencies) * 0.99)] * 1000
+    ))
+    print('{} slow clients dropped'.format(results.dropped))
+
+
+if __name__ == '__main__':
+    run()
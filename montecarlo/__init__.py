@@ -5,24 +5,76 @@ from os.path import abspath, dirname, join
 from sys import stdout
 
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
+
+from montecarlo.persistence.storage import StorageSQLAlchemy
 
 log_format = '%(levelname)s %(asctime)s [%(filename)s %(funcName)s] - %(message)s'
 logging.basicConfig(stream=stdout, format=log_format)
 
 app = Flask(__name__)
 
-# Lean sqlite database setup
+# Lean sqlite database setup, by default. Point MONTECARLO_DATABASE_URI at a database server (e.g.
+# postgresql://...) to use that instead, see montecarlo.persistence.storage.
 basedir = abspath(dirname(__file__))
 
 if environ.get('MONTECARLO_TEST_ENV') == 'true':
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
 else:
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + join(basedir, 'metrics_db.sqlite')
+    SQLALCHEMY_DATABASE_URI = environ.get(
+        'MONTECARLO_DATABASE_URI', 'sqlite:///' + join(basedir, 'metrics_db.sqlite')
+    )
 
 app.config['SQLALCHEMY_DATABASE_URI'] = SQLALCHEMY_DATABASE_URI
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-DB = SQLAlchemy(app)
+# Storage backend (sqlite or server), picked from the database URI unless set. Database connections
+# are pooled per process for either; SQLite connections also wait up to the busy timeout for another
+# process' write to finish, and get a page cache and memory map of the sizes set here.
+app.config['METRICS_STORAGE_BACKEND'] = environ.get('METRICS_STORAGE_BACKEND')
+app.config['METRICS_DB_POOL_SIZE'] = int(environ.get('METRICS_DB_POOL_SIZE', 5))
+app.config['METRICS_DB_MAX_OVERFLOW'] = int(environ.get('METRICS_DB_MAX_OVERFLOW', 10))
+app.config['METRICS_DB_POOL_TIMEOUT_SECONDS'] = float(
+    environ.get('METRICS_DB_POOL_TIMEOUT_SECONDS', 30)
+)
+app.config['METRICS_DB_POOL_RECYCLE_SECONDS'] = int(
+    environ.get('METRICS_DB_POOL_RECYCLE_SECONDS', 30 * 60)
+)
+app.config['METRICS_SQLITE_BUSY_TIMEOUT_MS'] = int(
+    environ.get('METRICS_SQLITE_BUSY_TIMEOUT_MS', 5000)
+)
+app.config['METRICS_SQLITE_CACHE_KB'] = int(environ.get('METRICS_SQLITE_CACHE_KB', 64 * 1024))
+app.config['METRICS_SQLITE_MMAP_BYTES'] = int(
+    environ.get('METRICS_SQLITE_MMAP_BYTES', 256 * 1024 * 1024)
+)
+
+# API response cache. The local backend is per process; point every web worker at the same Redis
+# server with the redis backend to share one cache between them.
+app.config['METRICS_CACHE_BACKEND'] = environ.get('METRICS_CACHE_BACKEND', 'local')
+app.config['METRICS_CACHE_MAX_BYTES'] = int(environ.get('METRICS_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+app.config['METRICS_CACHE_MAX_ENTRY_BYTES'] = int(
+    environ.get('METRICS_CACHE_MAX_ENTRY_BYTES', 4 * 1024 * 1024)
+)
+app.config['METRICS_CACHE_REDIS_URL'] = environ.get('METRICS_CACHE_REDIS_URL', 'redis://localhost:6379/0')
+
+# Database connections available to the async (ASGI) serving mode, see montecarlo.asgi
+app.config['METRICS_ASYNC_POOL_SIZE'] = int(environ.get('METRICS_ASYNC_POOL_SIZE', 10))
+
+# Streaming of new metric values: how often to check for values saved by the poller, how many
+# values a client may fall behind by before it's dropped, and how often to send idle clients a
+# keep-alive.
+app.config['METRICS_STREAM_POLL_SECONDS'] = float(environ.get('METRICS_STREAM_POLL_SECONDS', 1))
+app.config['METRICS_STREAM_QUEUE_SIZE'] = int(environ.get('METRICS_STREAM_QUEUE_SIZE', 1000))
+app.config['METRICS_STREAM_HEARTBEAT_SECONDS'] = float(
+    environ.get('METRICS_STREAM_HEARTBEAT_SECONDS', 15)
+)
+
+# Memory-mapped ring buffers of each metric's most recent values, see
+# montecarlo.persistence.ring_buffer. Disabled unless a directory is set, which the poller and every
+# web worker must share. Capacity is in values per metric, about 2.8 days of once-a-minute polling.
+app.config['METRICS_RING_BUFFER_DIR'] = environ.get('METRICS_RING_BUFFER_DIR')
+app.config['METRICS_RING_BUFFER_CAPACITY'] = int(environ.get('METRICS_RING_BUFFER_CAPACITY', 4096))
+
+DB = StorageSQLAlchemy(app)
+
 
 from montecarlo.api.routes import *
@@ -0,0 +1,250 @@
+""" Response caching for the API routes.
+
+Metric data only changes when the poller writes a new cycle, so responses are cached keyed on the
+current data generation (see metrics_manager.get_data_generation) as well as the request. When the
+poller commits, the generation moves on and the old entries are simply never asked for again, aging
+out of the cache under LRU eviction instead of being invalidated on a timer. """
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+
+from flask import request
+
+from montecarlo import app
+from montecarlo.persistence.metrics_manager import get_data_generation
+
+_BACKEND_LOCAL = 'local'
+_BACKEND_REDIS = 'redis'
+
+_KEY_TEMPLATE = 'montecarlo:{generation}:{route}:{path}?{query}|{accept}'
+
+# Stale generations in a shared cache are only ever read by a worker that hasn't seen the latest
+# commit yet, so they don't need to live long. This is garbage collection, not invalidation.
+_REDIS_ENTRY_SECONDS = 60 * 60
+
+
+class CacheBackend(ABC):
+    """ Storage for cached responses, as serialized bytes keyed by string. """
+
+    @abstractmethod
+    def get(self, key):
+        """ Returns the bytes cached for the key, or None. """
+
+    @abstractmethod
+    def set(self, key, value):
+        """ Caches the bytes for the key. """
+
+    @abstractmethod
+    def clear(self):
+        """ Drops every cached entry. """
+
+
+class LocalCacheBackend(CacheBackend):
+    """ An in-process LRU cache, which evicts the least recently used entries once the total size
+    of the cached values exceeds max_bytes. Only shared between threads of one process. """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        # Never let a single oversized response flush everything else out.
+        if len(value) > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.size_bytes -= len(self._entries.pop(key))
+
+            self._entries[key] = value
+            self.size_bytes += len(value)
+
+            while self.size_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size_bytes -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCacheBackend(CacheBackend):
+    """ A cache shared by every web worker pointed at the same Redis server. Size limits and
+    eviction are left to the server's own maxmemory and maxmemory-policy (allkeys-lru) settings. """
+
+    def __init__(self, url):
+        # Only needed when this backend is configured, so it's not in requirements.txt
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('The redis response cache backend requires the "redis" package.')
+
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        return self._client.get(key)
+
+    def set(self, key, value):
+        self._client.set(key, value, ex=_REDIS_ENTRY_SECONDS)
+
+    def clear(self):
+        for key in self._client.scan_iter('montecarlo:*'):
+            self._client.delete(key)
+
+
+class ResponseCache:
+    """ Caches successful responses from the wrapped routes in a backend, keyed on the data
+    generation, and counts hits and misses. Responses bigger than max_entry_bytes aren't cached. """
+
+    def __init__(self, backend, max_entry_bytes):
+        self.backend = backend
+        self.max_entry_bytes = max_entry_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+    def cached(self, route):
+        """ Decorator for a route returning a JSON-serializable dict or a response (and optionally a
+        status code), which serves it from the cache when possible. Only successful responses are
+        cached, along with their mimetype. """
+
+        @wraps(route)
+        def wrapper(*args, **kwargs):
+            key = cache_key(
+                get_data_generation(),
+                route.__name__,
+                request.path,
+                request.query_string.decode(),
+                request.headers.get('Accept', '')
+            )
+
+            entry = self.get(key)
+            if entry is None:
+                response = app.make_response(route(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+                # Don't hold up (or buffer) a streamed response; cache it as it goes out instead.
+                if response.is_streamed:
+                    response.response = self._cache_as_streamed(
+                        key, response.mimetype, response.response
+                    )
+                    return response
+
+                self.set(key, response.mimetype, response.get_data())
+                return response
+
+            mimetype, body = entry
+            return app.response_class(body, mimetype=mimetype)
+
+        return wrapper
+
+    def get(self, key):
+        """ Returns the (mimetype, body) of the response cached for the key (see cache_key), or
+        None, counting a hit or a miss. """
+
+        entry = self.backend.get(key)
+        self._count(entry is not None)
+
+        return _unpack_entry(entry) if entry is not None else None
+
+    def set(self, key, mimetype, body):
+        """ Caches a successful response's body and mimetype for the key, unless it's too big. """
+
+        if len(body) <= self.max_entry_bytes:
+            self.backend.set(key, _entry(mimetype, body))
+
+    def _cache_as_streamed(self, key, mimetype, chunks):
+        """ Passes through the chunks of a streamed response body, and caches the whole body once
+        it's been sent, unless it turns out to be too big. """
+
+        body = list()
+        size = 0
+
+        for chunk in chunks:
+            if body is not None:
+                chunk_bytes = chunk.encode() if isinstance(chunk, str) else chunk
+                size += len(chunk_bytes)
+                if size <= self.max_entry_bytes:
+                    body.append(chunk_bytes)
+                else:
+                    body = None
+            yield chunk
+
+        if body is not None:
+            self.backend.set(key, _entry(mimetype, b''.join(body)))
+
+    def clear(self):
+        """ Drops every cached response and resets the counters. """
+
+        self.backend.clear()
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+def cache_key(generation, route, path, query, accept):
+    """ Returns the key to cache the response of the named route to a request for the path, query
+    string and Accept header under, as of the specified data generation. """
+
+    # Routes may pick a response format by content negotiation, so the Accept header is part of it.
+    return _KEY_TEMPLATE.format(
+        generation=generation,
+        route=route,
+        path=path,
+        query=query,
+        accept=accept
+    )
+
+
+def _entry(mimetype, body):
+    """ Packs a response body and its mimetype into a single cache entry. """
+
+    return mimetype.encode() + b'\n' + body
+
+
+def _unpack_entry(entry):
+    mimetype, _, body = entry.partition(b'\n')
+    return mimetype.decode(), body
+
+
+def _build_backend():
+    backend = app.config['METRICS_CACHE_BACKEND']
+
+    if backend == _BACKEND_LOCAL:
+        return LocalCacheBackend(app.config['METRICS_CACHE_MAX_BYTES'])
+    if backend == _BACKEND_REDIS:
+        return RedisCacheBackend(app.config['METRICS_CACHE_REDIS_URL'])
+
+    raise RuntimeError('Unknown response cache backend: {}'.format(backend))
+
+
+RESPONSE_CACHE = ResponseCache(_build_backend(), app.config['METRICS_CACHE_MAX_ENTRY_BYTES'])
@@ -0,0 +1,97 @@
+""" Columnar encodings of a metric's raw history, offered through content negotiation as compact
+alternatives to the default list of {"timestamp", "value"} objects.
+
+Both carry the history as two parallel columns: timestamps as integer milliseconds since the Unix
+epoch (UTC), and values as float64. The history comes in batches of NumPy arrays (see
+metrics_manager.stream_24h_metric_history_columns), which are serialized in one go, rather than
+building and serializing a dict per data point.
+
+* application/vnd.montecarlo.columnar+json - the usual JSON document, with the history as
+  {"timestamp": [...], "value": [...]} instead of a list of objects.
+* application/vnd.montecarlo.packed - a binary stream of little-endian buffers. A uint32 byte
+  length and a UTF-8 JSON document holding the other fields come first, then any number of
+  batches, each a uint32 count n followed by n int64 timestamps and then n float64 values. A batch
+  with a count of 0 ends the stream. """
+
+from struct import Struct
+
+import numpy as np
+
+from flask import json, request
+
+JSON_MIMETYPE = 'application/json'
+COLUMNAR_JSON_MIMETYPE = 'application/vnd.montecarlo.columnar+json'
+PACKED_MIMETYPE = 'application/vnd.montecarlo.packed'
+
+# In order of preference when a client accepts several equally, e.g. */*
+HISTORY_MIMETYPES = [JSON_MIMETYPE, COLUMNAR_JSON_MIMETYPE, PACKED_MIMETYPE]
+
+_UINT32 = Struct('<I')
+_TIMESTAMP_DTYPE = np.dtype('<i8')
+_VALUE_DTYPE = np.dtype('<f8')
+
+
+def negotiate_history_mimetype():
+    """ Returns the history format the current request's Accept header prefers. Falls back to
+    plain JSON when it accepts none of them, as for any other route. """
+
+    return request.accept_mimetypes.best_match(HISTORY_MIMETYPES, default=JSON_MIMETYPE)
+
+
+def columnar_json(fields, key, batches):
+    """ Returns the fields as a JSON document, with the batches of (timestamps, values) history
+    arrays added under the key as a timestamp column and a value column. """
+
+    columns = list(batches)
+
+    history = {
+        'timestamp': np.concatenate([c[0] for c in columns] or [np.empty(0, _TIMESTAMP_DTYPE)]),
+        'value': np.concatenate([c[1] for c in columns] or [np.empty(0, _VALUE_DTYPE)])
+    }
+
+    return json.dumps(dict(fields, **{key: {k: v.tolist() for k, v in history.items()}}))
+
+
+def stream_packed(fields, batches):
+    """ Yields the fields and the batches of (timestamps, values) history arrays in the packed
+    binary format, a batch at a time. """
+
+    header = json.dumps(fields).encode()
+    yield _UINT32.pack(len(header)) + header
+
+    for timestamps, values in batches:
+        if len(timestamps):
+            yield b''.join([
+                _UINT32.pack(len(timestamps)),
+                timestamps.astype(_TIMESTAMP_DTYPE, copy=False).tobytes(),
+                values.astype(_VALUE_DTYPE, copy=False).tobytes()
+            ])
+
+    yield _UINT32.pack(0)
+
+
+def read_packed(body):
+    """ Decodes a packed response body into its fields and its timestamp and value columns. The
+    counterpart of stream_packed, for clients written in Python. """
+
+    length, = _UINT32.unpack_from(body)
+    offset = _UINT32.size + length
+    fields = json.loads(body[_UINT32.size:offset])
+
+    timestamps, values = list(), list()
+    while True:
+        count, = _UINT32.unpack_from(body, offset)
+        offset += _UINT32.size
+        if count == 0:
+            break
+
+        timestamps.append(np.frombuffer(body, _TIMESTAMP_DTYPE, count, offset))
+        offset += count * _TIMESTAMP_DTYPE.itemsize
+        values.append(np.frombuffer(body, _VALUE_DTYPE, count, offset))
+        offset += count * _VALUE_DTYPE.itemsize
+
+    return (
+        fields,
+        np.concatenate(timestamps or [np.empty(0, _TIMESTAMP_DTYPE)]),
+        np.concatenate(values or [np.empty(0, _VALUE_DTYPE)])
+    )
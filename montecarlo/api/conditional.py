@@ -0,0 +1,99 @@
+""" Conditional GET support for the API routes.
+
+Responses carry a strong ETag and a Last-Modified header derived from the latest data point behind
+them, so that a client which already has the current response can revalidate it with
+If-None-Match or If-Modified-Since and get back an empty 304 Not Modified, without the route
+running any of its queries. """
+
+from datetime import timezone
+from functools import wraps
+from hashlib import sha1
+
+from flask import request
+from werkzeug.http import parse_date, parse_etags
+
+from montecarlo import app
+from montecarlo.persistence.metrics_manager import get_data_generation
+
+_ETAG_TEMPLATE = '{server}|{path}?{query}|{accept}|{last_modified}|{generation}'
+
+# The Flask app, as opposed to the async one in montecarlo.asgi
+_SERVER = 'wsgi'
+
+
+def conditional(last_modified_for):
+    """ Decorator for a route which adds validators to its successful responses, and answers
+    matching conditional requests with a 304.
+
+    last_modified_for is called with the route's arguments, and returns the timestamp of the
+    latest data point the response depends on, or None if the request can't be validated (an
+    invalid or unknown metric, say), in which case the route handles it as usual. """
+
+    def decorator(route):
+
+        @wraps(route)
+        def wrapper(*args, **kwargs):
+            last_modified = last_modified_for(*args, **kwargs)
+            if last_modified is None:
+                return route(*args, **kwargs)
+
+            etag = make_etag(
+                _SERVER,
+                request.path,
+                request.query_string.decode(),
+                request.headers.get('Accept', ''),
+                last_modified,
+                get_data_generation()
+            )
+
+            if not_modified(request.headers, etag, last_modified):
+                response = app.response_class(status=304)
+            else:
+                response = app.make_response(route(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            # Each format a route negotiates is a different representation, with its own ETag
+            response.vary.add('Accept')
+
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def make_etag(server, path, query, accept, last_modified, generation):
+    """ Returns the ETag of the response a server (the Flask or async app, whose responses differ
+    byte for byte) gives to a request for the path, query string and Accept header, when the latest
+    data point behind it was saved at last_modified and the data generation is as specified. """
+
+    # The poller writes a cycle's values and then its rankings in separate transactions, and both
+    # move the data generation on, so include it to tell those responses apart.
+    return sha1(_ETAG_TEMPLATE.format(
+        server=server,
+        path=path,
+        query=query,
+        accept=accept,
+        last_modified=last_modified.isoformat(),
+        generation=generation
+    ).encode()).hexdigest()
+
+
+def not_modified(headers, etag, last_modified):
+    """ Whether the conditional headers of a request match the specified validators.
+    If-None-Match takes precedence over If-Modified-Since when both are present. """
+
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match:
+        return parse_etags(if_none_match).contains(etag)
+
+    if_modified_since = parse_date(headers.get('If-Modified-Since'))
+    if if_modified_since is not None:
+        # HTTP dates only have whole seconds
+        last_modified = last_modified.replace(tzinfo=timezone.utc, microsecond=0)
+        return last_modified <= if_modified_since
+
+    return False
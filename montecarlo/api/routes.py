@@ -1,17 +1,66 @@
 """ API routes. """
 
-from datetime import datetime
-from statistics import stdev
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from datetime import datetime, timedelta, timezone
+from math import sqrt
+
+from flask import json, request, stream_with_context
 
 from montecarlo import app
+from montecarlo.api.cache import RESPONSE_CACHE
+from montecarlo.api.columnar import (
+    COLUMNAR_JSON_MIMETYPE,
+    PACKED_MIMETYPE,
+    columnar_json,
+    negotiate_history_mimetype,
+    stream_packed
+)
+from montecarlo.api.conditional import conditional
+from montecarlo.api.stream import METRIC_FEED, METRIC_HUB
+from montecarlo.metrics.analytics import MetricSummary, get_24h_metric_summaries
 from montecarlo.persistence.metrics_manager import (
+    METRIC_PRICE,
+    METRIC_VOLUME,
+    ROLLUP_RESOLUTIONS,
     get_all_crypto_pair_metrics,
     get_crypto_pair_metric_by_id,
-    get_24h_metric_history
+    get_latest_metric_timestamp,
+    get_metric_history_since,
+    get_metric_ranking,
+    get_24h_metric_aggregates,
+    get_24h_metric_rollups,
+    stream_24h_metric_history,
+    stream_24h_metric_history_columns
 )
 
+_METRIC_TYPES = [METRIC_PRICE, METRIC_VOLUME]
+
+# Data points serialized into a streamed history response at a time
+_HISTORY_BATCH_SIZE = 1000
+
+
+def _metrics_list_last_modified():
+    """ The metrics list changes, if at all, when the poller saves a cycle. """
+
+    return get_latest_metric_timestamp()
+
+
+def _metrics_info_last_modified(metric_id):
+    """ A metric's info changes when the poller saves a cycle for any metric of the same type,
+    since those are what it's ranked against. """
+
+    try:
+        metric = get_crypto_pair_metric_by_id(int(metric_id))
+    except ValueError:
+        return None
+
+    return get_latest_metric_timestamp(metric.metric_type) if metric is not None else None
+
 
 @app.route('/metrics', methods=['GET'])
+@conditional(_metrics_list_last_modified)
+@RESPONSE_CACHE.cached
 def metrics_list():
     """ Returns a JSON response containing all CryptoPairMetrics in the database.
 
@@ -41,7 +90,67 @@ def metrics_list():
     }
 
 
+def _metrics_summary_last_modified():
+    """ A metric type's summaries change when the poller saves a cycle for it. """
+
+    metric_type = request.args.get('metric_type')
+    if metric_type not in _METRIC_TYPES:
+        return None
+
+    return get_latest_metric_timestamp(metric_type)
+
+
+@app.route('/metrics/summary', methods=['GET'])
+@conditional(_metrics_summary_last_modified)
+@RESPONSE_CACHE.cached
+def metrics_summary():
+    """ Returns summary statistics over the last 24 hours of every metric of the metric type given
+    in the `metric_type` query parameter. Metrics with fewer than two data points in that period
+    have no standard deviation, and metrics with none only have a count.
+
+    Ex: {
+        "metric_type": "price",
+        "summaries": [
+            {
+                "id": 3,
+                "ticker": "KRAKEN:ETHUSD",
+                "count": 1440,
+                "mean": 2701.3,
+                "standard_deviation": 65.7042239543861,
+                "min": 2584.1,
+                "max": 2812.9,
+                "percentiles": {"p50": 2698.2, "p90": 2790.4, "p99": 2809.6}
+            },
+            ...
+        ]
+    } """
+
+    # Ensure the metric type is one we track, and return a 400 Bad Request if it's not
+    metric_type = request.args.get('metric_type')
+    if metric_type not in _METRIC_TYPES:
+        msg = 'Invalid metric type: "{}". Must be one of {}.'.format(
+            metric_type, ', '.join(_METRIC_TYPES)
+        )
+        return {'error': msg}, 400
+
+    summaries = get_24h_metric_summaries(metric_type, datetime.utcnow())
+
+    return {
+        'metric_type': metric_type,
+        'summaries': [
+            dict(
+                id=m.id,
+                ticker=m.ticker,
+                **summaries.get(m.id, MetricSummary(count=0)).to_json()
+            )
+            for m in get_all_crypto_pair_metrics() if m.metric_type == metric_type
+        ]
+    }
+
+
 @app.route('/metrics/<metric_id>', methods=['GET'])
+@conditional(_metrics_info_last_modified)
+@RESPONSE_CACHE.cached
 def metrics_info(metric_id):
     """ Returns a 24-hour history of data points for the requested metric, as well as its standard
      deviation in that time period and rank against other metrics of the same metric type.
@@ -63,7 +172,27 @@ def metrics_info(metric_id):
       "metric_type": "price",
       "standard_deviation": 65.7042239543861,
       "ticker": "KRAKEN:ETHUSD"
-    } """
+    }
+
+    Accepts an optional `resolution` query parameter (one of 1m, 5m or 1h) to return the history as
+    time buckets of that size instead of raw data points. Each bucket's "value" is its mean, and it
+    also includes "open", "high", "low", "close" and "count".
+
+    The raw history is also offered in two columnar formats, chosen by the Accept header: columnar
+    JSON (application/vnd.montecarlo.columnar+json) and packed binary buffers
+    (application/vnd.montecarlo.packed). See montecarlo.api.columnar.
+
+    Responses carry ETag and Last-Modified headers, and a request with a matching If-None-Match or
+    If-Modified-Since gets an empty 304 Not Modified until the poller saves another cycle. """
+
+    # Ensure the resolution, if any, is one we maintain rollups for, and return a 400 Bad Request
+    # if it's not
+    resolution = request.args.get('resolution')
+    if resolution is not None and resolution not in ROLLUP_RESOLUTIONS:
+        msg = 'Invalid resolution: "{}". Must be one of {}.'.format(
+            resolution, ', '.join(ROLLUP_RESOLUTIONS)
+        )
+        return {'error': msg}, 400
 
     # Ensure metric ID is an integer and return a 400 Bad Request if it's not
     try:
@@ -78,47 +207,289 @@ def metrics_info(metric_id):
     if metric is None:
         return {'error': 'No such metric with ID {}.'.format(metric_id)}, 404
 
-    # Get metric instance value history over the last day, so we can return values and timestamps
-    # in this API response for charting purposes.
-    metric_value_history = get_24h_metric_history(metric.id, datetime.utcnow())
-
     # Get this metric's standard deviation over the last day, and also its rank position against
     # the standard deviations of similar metrics in the same time period.
-    rank, standard_deviation = _rank_metric_against_similar(metric)
+    now = datetime.utcnow()
+    rank, standard_deviation = _get_metric_rank(metric, now)
+
+    metric_info = {
+        'id': metric_id,
+        'ticker': metric.ticker,
+        'metric_type': metric.metric_type,
+        'standard_deviation': standard_deviation,
+        'metric_rank': rank
+    }
+
+    # Get metric instance value history over the last day, so we can return values and timestamps
+    # in this API response for charting purposes. If a resolution was requested, serve it from the
+    # matching rollups instead, which are few enough to serialize in one go.
+    if resolution is not None:
+        metric_value_history = get_24h_metric_rollups(
+            metric.id, ROLLUP_RESOLUTIONS[resolution], now
+        )
+        metric_info['metric_24h_history'] = [m.to_json() for m in metric_value_history]
+        return metric_info
+
+    # Columnar formats serialize each batch of the history as arrays in one go.
+    mimetype = negotiate_history_mimetype()
+    if mimetype == COLUMNAR_JSON_MIMETYPE:
+        columns = stream_24h_metric_history_columns(metric.id, now, _HISTORY_BATCH_SIZE)
+        return app.response_class(
+            columnar_json(metric_info, 'metric_24h_history', columns), mimetype=mimetype
+        )
+    if mimetype == PACKED_MIMETYPE:
+        columns = stream_24h_metric_history_columns(metric.id, now, _HISTORY_BATCH_SIZE)
+        return app.response_class(
+            stream_with_context(stream_packed(metric_info, columns)), mimetype=mimetype
+        )
+
+    # Raw history can run to any number of data points, so stream them from the database cursor
+    # into the response a batch at a time rather than building it all up in memory first.
+    metric_value_history = (
+        [{'timestamp': str(timestamp), 'value': value} for timestamp, value in rows]
+        for rows in stream_24h_metric_history(metric.id, now, _HISTORY_BATCH_SIZE)
+    )
+
+    return app.response_class(
+        stream_with_context(_stream_json(metric_info, 'metric_24h_history', metric_value_history)),
+        mimetype='application/json'
+    )
+
+
+@app.route('/metrics/<metric_id>/history', methods=['GET'])
+@conditional(_metrics_info_last_modified)
+@RESPONSE_CACHE.cached
+def metrics_history(metric_id):
+    """ Returns the data points for the requested metric added since a client's last fetch, along
+    with its current standard deviation and rank, so a dashboard can keep a chart up to date
+    without downloading the whole 24-hour history every time.
+
+    Accepts either a `since` query parameter, a timestamp in the format of the history's
+    timestamps, or the opaque `cursor` returned by the previous call. Only data points after that
+    are returned. With neither, returns the whole 24-hour history.
+
+     Ex: {
+      "id": 3,
+      "metric_history": [
+        {
+          "timestamp": "2022-02-27 17:15:25.109373",
+          "value": 2801.2
+        }
+      ],
+      "cursor": "MjAyMi0wMi0yNyAxNzoxNToyNS4xMDkzNzM",
+      "metric_rank": "8/10",
+      "metric_type": "price",
+      "standard_deviation": 65.7142860152633,
+      "ticker": "KRAKEN:ETHUSD"
+    } """
+
+    now = datetime.utcnow()
+
+    since = request.args.get('since')
+    cursor = request.args.get('cursor')
+    if since is not None and cursor is not None:
+        return {'error': 'Only one of since and cursor may be given.'}, 400
+
+    # Ensure the starting point, if any, is a timestamp and return a 400 Bad Request if it's not
+    if cursor is not None:
+        try:
+            since = _decode_cursor(cursor)
+        except ValueError:
+            return {'error': 'Invalid cursor: "{}".'.format(cursor)}, 400
+    elif since is not None:
+        try:
+            since = _parse_timestamp(since)
+        except ValueError:
+            msg = 'Invalid since: "{}". Must be a timestamp, e.g. "2022-02-27 17:14:25".'.format(
+                since
+            )
+            return {'error': msg}, 400
+    else:
+        since = now - timedelta(days=1)
+
+    # Ensure metric ID is an integer and return a 400 Bad Request if it's not
+    try:
+        metric_id = int(metric_id)
+    except ValueError:
+        msg = 'Invalid metric ID: "{}". Must be an integer.'.format(metric_id)
+        return {'error': msg}, 400
+
+    metric = get_crypto_pair_metric_by_id(metric_id)
+
+    # Ensure the metric exists. If not, return a 404 Not Found.
+    if metric is None:
+        return {'error': 'No such metric with ID {}.'.format(metric_id)}, 404
+
+    metric_value_history = get_metric_history_since(metric.id, since, now)
+
+    # The next call picks up after the last data point returned, or from the same place if there
+    # weren't any.
+    if metric_value_history:
+        since = metric_value_history[-1].timestamp
+
+    rank, standard_deviation = _get_metric_rank(metric, now)
 
     return {
         'id': metric_id,
         'ticker': metric.ticker,
         'metric_type': metric.metric_type,
-        'metric_24h_history': [m.to_json() for m in metric_value_history],
+        'metric_history': [m.to_json() for m in metric_value_history],
+        'cursor': _encode_cursor(since),
         'standard_deviation': standard_deviation,
         'metric_rank': rank
     }
 
 
+@app.route('/metrics/stream', methods=['GET'])
+def metrics_stream():
+    """ Streams each new data point for the requested metrics as a server-sent event, as soon as
+    the poller saves it. Takes a comma-separated list of metric IDs in the `ids` query parameter,
+    e.g. /metrics/stream?ids=1,3.
+
+    Ex:
+    event: value
+    data: {"id": 3, "timestamp": "2022-02-27 17:15:25.109373", "value": 2801.2}
+
+    A client which falls too far behind is sent a final "dropped" event and disconnected, and
+    should reconnect and catch up with the history endpoint. """
+
+    # Ensure every metric ID is an integer and return a 400 Bad Request if not
+    ids = request.args.get('ids', '')
+    try:
+        metric_ids = {int(metric_id) for metric_id in ids.split(',')}
+    except ValueError:
+        msg = 'Invalid metric IDs: "{}". Must be a comma-separated list of integers.'.format(ids)
+        return {'error': msg}, 400
+
+    METRIC_FEED.start()
+
+    # Subscribe now rather than when the response starts streaming, so nothing saved in between
+    # is missed.
+    subscription = METRIC_HUB.subscribe(metric_ids, app.config['METRICS_STREAM_QUEUE_SIZE'])
+    heartbeat_seconds = app.config['METRICS_STREAM_HEARTBEAT_SECONDS']
+
+    def events():
+        try:
+            # Start the response straight away, rather than when the first value arrives, so the
+            # client knows it's connected.
+            yield ': connected\n\n'
+
+            while not subscription.dropped:
+                value = subscription.get(timeout=heartbeat_seconds)
+                if value is None:
+                    yield ': keep-alive\n\n'
+                else:
+                    yield 'event: value\ndata: {}\n\n'.format(json.dumps(value))
+
+            yield 'event: dropped\ndata: {}\n\n'
+        finally:
+            METRIC_HUB.unsubscribe(subscription)
+
+    return app.response_class(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Stop reverse proxies buffering the stream
+        'X-Accel-Buffering': 'no'
+    })
+
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """ Returns the response cache's hit and miss counters since the web app started.
+
+    Ex: {
+        "hits": 120,
+        "misses": 8
+    } """
+
+    return RESPONSE_CACHE.stats()
+
+
+def _stream_json(fields, key, batches):
+    """ Yields a JSON object with the specified fields, plus the specified key holding an array of
+    all of the items in batches (an iterable of lists of items), a batch at a time. """
+
+    yield json.dumps(fields)[:-1] + ', {}: ['.format(json.dumps(key))
+
+    separator = ''
+    for batch in batches:
+        if batch:
+            # Serialize the batch as an array and drop its brackets, to splice it into ours
+            yield separator + json.dumps(batch)[1:-1]
+            separator = ', '
+
+    yield ']}'
+
+
+def _encode_cursor(timestamp):
+    return urlsafe_b64encode(str(timestamp).encode()).decode().rstrip('=')
+
+
+def _decode_cursor(cursor):
+    """ Returns the timestamp in a cursor from _encode_cursor, or raises ValueError. """
+
+    try:
+        timestamp = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+    except (BinasciiError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+
+    return _parse_timestamp(timestamp)
+
+
+def _parse_timestamp(timestamp):
+    """ Parses an ISO 8601 timestamp into the naive UTC datetime metric values are stored with,
+    converting it to UTC first if it has a time zone. Raises ValueError if it's not a timestamp. """
+
+    # Python before 3.11 doesn't accept the "Z" suffix for UTC.
+    if timestamp.endswith('Z'):
+        timestamp = timestamp[:-1] + '+00:00'
+
+    parsed = datetime.fromisoformat(timestamp)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return parsed
+
+
+def _get_metric_rank(metric, timestamp):
+    """ Returns a tuple of (rank_position, standard_deviation) for the metric as of the specified
+    timestamp. The poller ranks metrics after every cycle, so only do the ranking here if that's
+    missing or stale. """
+
+    ranking = get_metric_ranking(metric.id, timestamp)
+    if ranking is not None:
+        return '{}/{}'.format(ranking.rank, ranking.total), ranking.standard_deviation
+
+    return _rank_metric_against_similar(metric)
+
+
 # Note: this probably belongs in a separate module with similar business logic, but since I don't
 # have anything else specific to put in there I'll keep it here.
 def _rank_metric_against_similar(metric):
-    """ Given a target metric, pull the 24h history all metrics with the same metric type
-    (we'll call these "similar metrics"), and ranking them by their standard deviation across this
+    """ Given a target metric, aggregate the 24h history of all metrics with the same metric type
+    (we'll call these "similar metrics"), and rank them by their standard deviation across this
     time range. Return a tuple of (rank_position, standard_deviation) for our target metric. """
 
-    # Store a list of tuples of metrics IDs and daily standard deviation, so we can rank metrics of
-    # the same type as the target metric.
-    metric_std_devs = list()
+    # Get the count, mean and sum of squared deviations over the last day of every similar metric
+    # in one query, and rank our target metric from those.
+    aggregates = get_24h_metric_aggregates(metric.metric_type, datetime.utcnow())
 
-    # Get all metrics and only keep the ones with the same metric type, so we can perform a
-    # meaningful ranking of similar metrics by their daily standard deviation.
-    all_metrics = get_all_crypto_pair_metrics()
-    similar_metrics = [m for m in all_metrics if m.metric_type == metric.metric_type]
+    return rank_metric_against_aggregates(metric.id, aggregates)
 
-    # Pull 24h metric value history for all similar metrics, calculate their standard deviation in
-    # this time period, store the result for that metric.
-    now = datetime.utcnow()
-    for similar_metric in similar_metrics:
-        metric_value_history = get_24h_metric_history(similar_metric.id, now)
-        raw_history = [m.metric_value for m in metric_value_history]
-        metric_std_devs.append((similar_metric.id, stdev(raw_history)))
+
+def rank_metric_against_aggregates(metric_id, aggregates):
+    """ Given a target metric ID and the 24h aggregates of it and its similar metrics (as returned
+    by get_24h_metric_aggregates), rank them by their standard deviation. Return a tuple of
+    (rank_position, standard_deviation) for our target metric, both None if it has fewer than two
+    data points in the window. """
+
+    # Derive each similar metric's daily standard deviation from its aggregates. Store a list of
+    # tuples of metric IDs and daily standard deviation, so we can rank them. A metric needs at
+    # least two data points to have a standard deviation.
+    metric_std_devs = [
+        (m_id, sqrt(sum_sq_deviations / (count - 1)))
+        for m_id, (count, _, sum_sq_deviations) in aggregates.items()
+        if count > 1
+    ]
 
     # Sort the metrics by their standard deviation values, in ascending order.
     metric_std_devs.sort(key=lambda x: x[1])
@@ -130,11 +501,15 @@ def _rank_metric_against_similar(metric):
     # The 1-based index of our metric in this list will be its ranking, and while we have the value,
     # remember its specific standard deviation so we can return it.
     for i, (m_id, std_dev) in enumerate(metric_std_devs):
-        if metric.id == m_id:
+        if metric_id == m_id:
             rank = i + 1
             standard_deviation = std_dev
             break
 
+    # A metric without a standard deviation of its own isn't ranked at all.
+    if rank is None:
+        return None, None
+
     # Report the rank as this metric's position within the total number of similar metrics
     rank_string = '{}/{}'.format(rank, len(metric_std_devs))
 
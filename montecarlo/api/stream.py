@@ -0,0 +1,180 @@
+""" Streaming push of new metric values to API clients.
+
+The poller runs in its own process, so new values reach the web app through the database: a
+MetricFeed thread watches the data generation counter (see metrics_manager.get_data_generation),
+and whenever the poller commits, reads just the values saved since the last one it saw for the
+metrics anyone is subscribed to, and publishes them to the MetricHub. It keeps its place by value
+ID rather than timestamp, as values aren't committed in timestamp order: several poller shards
+commit on their own schedules, and a poll cycle may be written in more than one batch. The hub fans
+each value out to the queue of every subscription to its metric. Queues are bounded, and a client
+which falls so far behind that its queue fills up is dropped rather than holding values in memory
+indefinitely. """
+
+from logging import getLogger, INFO
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+
+from montecarlo import app, DB
+from montecarlo.persistence.metrics_manager import (
+    get_data_generation,
+    get_latest_metric_value_id,
+    get_metric_values_after
+)
+
+_log = getLogger(__name__)
+_log.setLevel(INFO)
+
+
+class Subscription:
+    """ One client's subscription to new values of a set of metrics, with a bounded queue of
+    values waiting to be sent to it. """
+
+    def __init__(self, metric_ids, max_queued):
+        self.metric_ids = frozenset(metric_ids)
+        self.dropped = False
+        self._queue = Queue(maxsize=max_queued)
+
+    def offer(self, value):
+        """ Queues the value without blocking. Returns False if the queue is full. """
+
+        try:
+            self._queue.put_nowait(value)
+            return True
+        except Full:
+            return False
+
+    def get(self, timeout):
+        """ Returns the next value published to this subscription, waiting up to timeout seconds
+        for one, or None if there wasn't one. """
+
+        try:
+            return self._queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+
+class MetricHub:
+    """ In-process publish/subscribe of new metric values, keyed by CryptoPairMetric ID. """
+
+    def __init__(self):
+        self._subscriptions = set()
+        self._lock = Lock()
+
+    def subscribe(self, metric_ids, max_queued):
+        subscription = Subscription(metric_ids, max_queued)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def metric_ids(self):
+        """ Returns the IDs of every metric with at least one subscriber. """
+
+        with self._lock:
+            return set().union(*(s.metric_ids for s in self._subscriptions))
+
+    def publish(self, metric_id, value):
+        """ Queues the value for every subscriber to the metric without blocking. A subscriber
+        whose queue is full is dropped. Returns the number of subscribers the value was queued
+        for. """
+
+        with self._lock:
+            subscribers = [s for s in self._subscriptions if metric_id in s.metric_ids]
+
+        delivered = 0
+        for subscription in subscribers:
+            if subscription.offer(value):
+                delivered += 1
+            else:
+                _log.warning('Dropping a slow stream subscriber with a full queue.')
+                subscription.dropped = True
+                self.unsubscribe(subscription)
+
+        return delivered
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+
+class MetricFeed:
+    """ Publishes metric values to a hub as the poller saves them. """
+
+    def __init__(self, hub, poll_seconds):
+        self.hub = hub
+        self.poll_seconds = poll_seconds
+        self._generation = None
+        self._last_value_id = None
+        self._thread = None
+        self._stopped = Event()
+        self._lock = Lock()
+
+    def start(self):
+        """ Starts checking for new values in a background thread, if that's not running yet. """
+
+        with self._lock:
+            if self._thread is None:
+                self._stopped.clear()
+                self._thread = Thread(target=self._run, name='metric-feed', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stopped.set()
+            thread.join()
+
+    def check(self):
+        """ Publishes every value saved since the last check for a subscribed metric, if the poller
+        has saved anything at all since then. Returns the number of values published. """
+
+        with app.app_context():
+            try:
+                # Start from the latest value saved before the first check, if any.
+                if self._last_value_id is None:
+                    self._last_value_id = get_latest_metric_value_id()
+
+                generation = get_data_generation()
+                if generation == self._generation:
+                    return 0
+                self._generation = generation
+
+                # With nobody listening, skip ahead so a new subscriber isn't sent a backlog.
+                metric_ids = self.hub.metric_ids()
+                if not metric_ids:
+                    self._last_value_id = get_latest_metric_value_id()
+                    return 0
+
+                values = get_metric_values_after(metric_ids, self._last_value_id)
+            finally:
+                DB.session.remove()
+
+        for value in values:
+            self.hub.publish(value.custom_metric_id, {
+                'id': value.custom_metric_id,
+                'timestamp': str(value.timestamp),
+                'value': value.metric_value
+            })
+
+        # IDs are handed out in the order values are inserted, and SQLite commits one writer at a
+        # time, so nothing is left to read with a lower ID than the last one. (On a database server
+        # a transaction could commit after a concurrent one which inserted later, though each
+        # writer's transactions only take milliseconds.)
+        if values:
+            self._last_value_id = values[-1].id
+
+        return len(values)
+
+    def _run(self):
+        while not self._stopped.wait(self.poll_seconds):
+            try:
+                self.check()
+            except Exception:
+                _log.exception('Failed to check for new metric values.')
+
+
+METRIC_HUB = MetricHub()
+METRIC_FEED = MetricFeed(METRIC_HUB, app.config['METRICS_STREAM_POLL_SECONDS'])
@@ -0,0 +1,214 @@
+""" Async (ASGI) serving mode for the metrics API.
+
+Serves the same `/metrics` and `/metrics/<metric_id>` contracts as the Flask routes in
+montecarlo.api.routes, but without tying up a worker thread per request while it waits on the
+database: queries go through an async driver, and the independent queries behind metrics_info run
+concurrently on separate connections. Responses are cached in the same response cache as the Flask
+app's (see montecarlo.api.cache), and answer conditional requests with a 304 the same way (see
+montecarlo.api.conditional).
+
+Run with `uvicorn montecarlo.asgi:asgi_app`. """
+
+from asyncio import gather
+from datetime import datetime
+from functools import wraps
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from werkzeug.http import http_date
+
+from montecarlo import app
+from montecarlo.api.cache import RESPONSE_CACHE, cache_key
+from montecarlo.api.conditional import make_etag, not_modified
+from montecarlo.api.routes import rank_metric_against_aggregates
+from montecarlo.persistence.async_metrics_manager import (
+    create_async_metrics_engine,
+    get_all_crypto_pair_metrics,
+    get_crypto_pair_metric_by_id,
+    get_data_generation,
+    get_latest_metric_timestamp,
+    get_metric_ranking,
+    get_24h_metric_aggregates,
+    get_24h_metric_history,
+    get_24h_metric_rollups
+)
+from montecarlo.persistence.metrics_manager import ROLLUP_RESOLUTIONS
+
+# Tells this app's responses, which are always JSON, apart from the Flask app's (which may be in
+# other formats, and are serialized differently) in the ETags and the response cache.
+_SERVER = 'asgi'
+
+
+def _with_validators(response, etag, last_modified):
+    """ Adds the ETag and Last-Modified headers to a response, if the request could be
+    validated. """
+
+    if etag is not None:
+        response.headers['ETag'] = '"{}"'.format(etag)
+        response.headers['Last-Modified'] = http_date(last_modified)
+
+    return response
+
+
+def create_asgi_app(engine):
+    """ Returns the ASGI app serving the metrics API from the database behind the AsyncEngine. """
+
+    sessions = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    async def run(query, *args):
+        """ Runs the query in a session of its own, so it can run alongside others. """
+
+        async with sessions() as session:
+            return await query(session, *args)
+
+    def conditional_cached(last_modified_for):
+        """ Decorator for a route which serves it from the response cache when possible, adds
+        validators to its successful responses and answers matching conditional requests with a
+        304, like the cached and conditional decorators of the Flask routes.
+
+        last_modified_for is awaited with the request, and returns the timestamp of the latest data
+        point the response depends on, or None if the request can't be validated. """
+
+        def decorator(route):
+
+            @wraps(route)
+            async def wrapper(request):
+                generation, last_modified = await gather(
+                    run(get_data_generation), last_modified_for(request)
+                )
+                path, query = request.url.path, request.url.query
+
+                # Responses are always JSON, whatever the Accept header asks for.
+                etag = None
+                if last_modified is not None:
+                    etag = make_etag(_SERVER, path, query, '', last_modified, generation)
+                    if not_modified(request.headers, etag, last_modified):
+                        return _with_validators(Response(status_code=304), etag, last_modified)
+
+                # The backend may be a Redis server, so don't block the event loop on it.
+                route_name = '{}.{}'.format(_SERVER, route.__name__)
+                key = cache_key(generation, route_name, path, query, '')
+                entry = await run_in_threadpool(RESPONSE_CACHE.get, key)
+                if entry is not None:
+                    mimetype, body = entry
+                    response = Response(body, media_type=mimetype)
+                else:
+                    response = await route(request)
+                    if response.status_code != 200:
+                        return response
+
+                    await run_in_threadpool(
+                        RESPONSE_CACHE.set, key, response.media_type, response.body
+                    )
+
+                return _with_validators(response, etag, last_modified)
+
+            return wrapper
+
+        return decorator
+
+    async def metrics_list_last_modified(request):
+        """ The metrics list changes, if at all, when the poller saves a cycle. """
+
+        return await run(get_latest_metric_timestamp)
+
+    async def metrics_info_last_modified(request):
+        """ A metric's info changes when the poller saves a cycle for any metric of the same
+        type, since those are what it's ranked against. """
+
+        try:
+            metric = await run(get_crypto_pair_metric_by_id, int(request.path_params['metric_id']))
+        except ValueError:
+            return None
+
+        if metric is None:
+            return None
+
+        return await run(get_latest_metric_timestamp, metric.metric_type)
+
+    @conditional_cached(metrics_list_last_modified)
+    async def metrics_list(request):
+        """ Returns a JSON response containing all CryptoPairMetrics in the database. See
+        montecarlo.api.routes.metrics_list. """
+
+        return JSONResponse({
+            'metrics': [m.to_json() for m in await run(get_all_crypto_pair_metrics)]
+        })
+
+    @conditional_cached(metrics_info_last_modified)
+    async def metrics_info(request):
+        """ Returns a 24-hour history of data points for the requested metric, as well as its
+        standard deviation in that time period and rank against other metrics of the same metric
+        type. See montecarlo.api.routes.metrics_info. """
+
+        metric_id = request.path_params['metric_id']
+
+        # Ensure the resolution, if any, is one we maintain rollups for, and return a 400 Bad
+        # Request if it's not
+        resolution = request.query_params.get('resolution')
+        if resolution is not None and resolution not in ROLLUP_RESOLUTIONS:
+            msg = 'Invalid resolution: "{}". Must be one of {}.'.format(
+                resolution, ', '.join(ROLLUP_RESOLUTIONS)
+            )
+            return JSONResponse({'error': msg}, status_code=400)
+
+        # Ensure metric ID is an integer and return a 400 Bad Request if it's not
+        try:
+            metric_id = int(metric_id)
+        except ValueError:
+            msg = 'Invalid metric ID: "{}". Must be an integer.'.format(metric_id)
+            return JSONResponse({'error': msg}, status_code=400)
+
+        now = datetime.utcnow()
+        if resolution is not None:
+            history = run(get_24h_metric_rollups, metric_id, ROLLUP_RESOLUTIONS[resolution], now)
+        else:
+            history = run(get_24h_metric_history, metric_id, now)
+
+        # None of the metric, its history and its ranking depend on each other, so look them all
+        # up at once.
+        metric, metric_value_history, ranking = await gather(
+            run(get_crypto_pair_metric_by_id, metric_id),
+            history,
+            run(get_metric_ranking, metric_id, now)
+        )
+
+        # Ensure the metric exists. If not, return a 404 Not Found.
+        if metric is None:
+            return JSONResponse(
+                {'error': 'No such metric with ID {}.'.format(metric_id)}, status_code=404
+            )
+
+        # Only rank against similar metrics here if the poller's ranking is missing or stale.
+        if ranking is not None:
+            rank = '{}/{}'.format(ranking.rank, ranking.total)
+            standard_deviation = ranking.standard_deviation
+        else:
+            aggregates = await run(get_24h_metric_aggregates, metric.metric_type, now)
+            rank, standard_deviation = rank_metric_against_aggregates(metric.id, aggregates)
+
+        return JSONResponse({
+            'id': metric_id,
+            'ticker': metric.ticker,
+            'metric_type': metric.metric_type,
+            'metric_24h_history': [m.to_json() for m in metric_value_history],
+            'standard_deviation': standard_deviation,
+            'metric_rank': rank
+        })
+
+    return Starlette(
+        routes=[
+            Route('/metrics', metrics_list, methods=['GET']),
+            Route('/metrics/{metric_id}', metrics_info, methods=['GET'])
+        ],
+        on_shutdown=[engine.dispose]
+    )
+
+
+asgi_app = create_asgi_app(create_async_metrics_engine(
+    app.config['SQLALCHEMY_DATABASE_URI'], app.config['METRICS_ASYNC_POOL_SIZE']
+))
@@ -0,0 +1,119 @@
+""" Summary statistics over the 24-hour windows of metric values.
+
+A metric type's whole window is loaded into one contiguous array of values, segmented by metric,
+and every metric's statistics are computed together in a handful of vectorized NumPy passes,
+rather than a metric (and a value) at a time in Python. """
+
+import numpy as np
+
+from montecarlo.persistence.metrics_manager import stream_24h_metric_type_values
+
+# Percentiles reported for every metric, by name
+PERCENTILES = {
+    'p50': 50,
+    'p90': 90,
+    'p99': 99
+}
+
+# Data points read from the database and converted to arrays at a time
+_LOAD_BATCH_SIZE = 10000
+
+
+class MetricSummary:
+    """ Summary statistics of a CryptoPairMetric's data points over a window. A metric with no
+    data points only has a count, and one with a single data point has no standard deviation. """
+
+    def __init__(self, count, mean=None, standard_deviation=None, minimum=None, maximum=None,
+                 percentiles=None):
+        self.count = count
+        self.mean = mean
+        self.standard_deviation = standard_deviation
+        self.minimum = minimum
+        self.maximum = maximum
+        self.percentiles = percentiles if percentiles is not None else dict()
+
+    def to_json(self):
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'standard_deviation': self.standard_deviation,
+            'min': self.minimum,
+            'max': self.maximum,
+            'percentiles': self.percentiles
+        }
+
+
+def get_24h_metric_summaries(metric_type, ending_timestamp):
+    """ Returns a map of CryptoPairMetric ID to MetricSummary, over the 24 hours ending at the
+    specified timestamp, for every CryptoPairMetric of the specified metric type which has data
+    points in that period. """
+
+    metric_ids, values = list(), list()
+    for batch_ids, batch_values in stream_24h_metric_type_values(
+        metric_type, ending_timestamp, _LOAD_BATCH_SIZE
+    ):
+        metric_ids.append(batch_ids)
+        values.append(batch_values)
+
+    if not values:
+        return dict()
+
+    return summarize_metric_values(np.concatenate(metric_ids), np.concatenate(values))
+
+
+def summarize_metric_values(metric_ids, values):
+    """ Given parallel arrays of CryptoPairMetric IDs and data point values, in any order, returns
+    a map of each metric ID to a MetricSummary of its values. """
+
+    if len(values) == 0:
+        return dict()
+
+    # Sort by value within each metric, so each metric's values are a contiguous, ordered segment.
+    # The minimum, maximum and percentiles can then be read straight off the segment.
+    order = np.lexsort((values, metric_ids))
+    metric_ids = metric_ids[order]
+    values = values[order]
+
+    ids, starts, counts = np.unique(metric_ids, return_index=True, return_counts=True)
+    ends = starts + counts - 1
+
+    means = np.add.reduceat(values, starts) / counts
+
+    # Sum squared deviations from each metric's mean, rather than squares of the raw values, to
+    # avoid losing the variance to floating point cancellation.
+    deviations = values - np.repeat(means, counts)
+    sum_sq_deviations = np.add.reduceat(deviations * deviations, starts)
+
+    # A metric needs at least two data points to have a standard deviation
+    has_deviation = counts > 1
+    standard_deviations = np.full(len(ids), np.nan)
+    standard_deviations[has_deviation] = np.sqrt(
+        sum_sq_deviations[has_deviation] / (counts[has_deviation] - 1)
+    )
+
+    percentiles = {
+        name: _segment_percentile(values, starts, counts, q) for name, q in PERCENTILES.items()
+    }
+
+    return {
+        int(metric_id): MetricSummary(
+            count=int(counts[i]),
+            mean=float(means[i]),
+            standard_deviation=float(standard_deviations[i]) if has_deviation[i] else None,
+            minimum=float(values[starts[i]]),
+            maximum=float(values[ends[i]]),
+            percentiles={name: float(p[i]) for name, p in percentiles.items()}
+        )
+        for i, metric_id in enumerate(ids)
+    }
+
+
+def _segment_percentile(values, starts, counts, q):
+    """ Returns the q-th percentile of each sorted segment of values, interpolating linearly
+    between the closest ranks like numpy.percentile does. """
+
+    positions = starts + (counts - 1) * (q / 100)
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.ceil(positions).astype(np.int64)
+
+    return values[lower] + (values[upper] - values[lower]) * (positions - lower)
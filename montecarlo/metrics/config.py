@@ -4,6 +4,85 @@ from os.path import dirname, abspath, join
 _MARKETS = 'markets'
 _NAME = 'name'
 _PAIRS = 'pairs'
+_POLLING = 'polling'
+_MAX_WORKERS = 'max_workers'
+_MAX_PER_MARKET = 'max_per_market'
+_BULK_THRESHOLD = 'bulk_threshold'
+_RETENTION = 'retention'
+_RETENTION_DAYS = 'days'
+_BATCH_SIZE = 'batch_size'
+_VACUUM_PAGES = 'vacuum_pages'
+_INGESTION = 'ingestion'
+_QUEUE_SIZE = 'queue_size'
+_FLUSH_INTERVAL = 'flush_interval'
+_PUT_TIMEOUT = 'put_timeout'
+_RETRY_INTERVAL = 'retry_interval'
+_SCHEDULING = 'scheduling'
+_INTERVAL = 'interval'
+_MIN_INTERVAL = 'min_interval'
+_MAX_INTERVAL = 'max_interval'
+_JITTER = 'jitter'
+_TICK = 'tick'
+_ADAPT_INTERVAL = 'adapt_interval'
+_TICKERS = 'tickers'
+_GOVERNOR = 'governor'
+_RATE = 'rate'
+_BURST = 'burst'
+_CREDIT_RESERVE = 'credit_reserve'
+_CREDIT_REFRESH_INTERVAL = 'credit_refresh_interval'
+_BACKOFF_BASE = 'backoff_base'
+_BACKOFF_MAX = 'backoff_max'
+_BACKOFF_JITTER = 'backoff_jitter'
+_PRIORITIES = 'priorities'
+_HTTP = 'http'
+_POOL_SIZE = 'pool_size'
+_CONNECT_TIMEOUT = 'connect_timeout'
+_READ_TIMEOUT = 'read_timeout'
+_RETRIES = 'retries'
+_RETRY_BACKOFF = 'retry_backoff'
+_RETRY_STATUSES = 'retry_statuses'
+
+# Polling defaults, used when the config file doesn't override them
+_DEFAULT_MAX_WORKERS = 8
+_DEFAULT_MAX_PER_MARKET = 4
+_DEFAULT_BULK_THRESHOLD = 5
+
+# Retention defaults, used when the config file doesn't override them
+_DEFAULT_RETENTION_DAYS = 30
+_DEFAULT_BATCH_SIZE = 5000
+_DEFAULT_VACUUM_PAGES = 1000
+
+# Ingestion defaults, used when the config file doesn't override them
+_DEFAULT_QUEUE_SIZE = 10000
+_DEFAULT_INGESTION_BATCH_SIZE = 500
+_DEFAULT_FLUSH_INTERVAL = 1
+_DEFAULT_PUT_TIMEOUT = 30
+_DEFAULT_RETRY_INTERVAL = 5
+
+# Scheduling defaults, used when the config file doesn't override them
+_DEFAULT_INTERVAL = 60
+_DEFAULT_MIN_INTERVAL = 15
+_DEFAULT_MAX_INTERVAL = 300
+_DEFAULT_JITTER = 0.1
+_DEFAULT_TICK = 5
+_DEFAULT_ADAPT_INTERVAL = 300
+
+# Request governor defaults, used when the config file doesn't override them
+_DEFAULT_RATE = 1
+_DEFAULT_BURST = 20
+_DEFAULT_CREDIT_RESERVE = 0.1
+_DEFAULT_CREDIT_REFRESH_INTERVAL = 300
+_DEFAULT_BACKOFF_BASE = 5
+_DEFAULT_BACKOFF_MAX = 300
+_DEFAULT_BACKOFF_JITTER = 0.5
+
+# HTTP session defaults, used when the config file doesn't override them
+_DEFAULT_POOL_SIZE = 8
+_DEFAULT_CONNECT_TIMEOUT = 5
+_DEFAULT_READ_TIMEOUT = 10
+_DEFAULT_RETRIES = 3
+_DEFAULT_RETRY_BACKOFF = 0.1
+_DEFAULT_RETRY_STATUSES = [500, 502, 503, 504]
 
 
 class MarketConfig:
@@ -14,15 +93,129 @@ class MarketConfig:
         self.pairs = market_data[_PAIRS]
 
 
+class PollingConfig:
+    """ Poller-level config which specifies how many market summaries may be pulled concurrently
+    (overall and per market), and how many pairs a market needs before it's served from the bulk
+    "all market summaries" call instead. """
+
+    def __init__(self, polling_data):
+        self.max_workers = polling_data.get(_MAX_WORKERS, _DEFAULT_MAX_WORKERS)
+        self.max_per_market = polling_data.get(_MAX_PER_MARKET, _DEFAULT_MAX_PER_MARKET)
+        self.bulk_threshold = polling_data.get(_BULK_THRESHOLD, _DEFAULT_BULK_THRESHOLD)
+
+
+class RetentionConfig:
+    """ Retention-level config which specifies how many days of raw metric values are kept for
+    each metric type (anything older is compacted into hourly rollups and deleted), how many values
+    are deleted per batch, and how many freed database pages are reclaimed per run. """
+
+    def __init__(self, retention_data):
+        self.days = retention_data.get(_RETENTION_DAYS, dict())
+        self.batch_size = retention_data.get(_BATCH_SIZE, _DEFAULT_BATCH_SIZE)
+        self.vacuum_pages = retention_data.get(_VACUUM_PAGES, _DEFAULT_VACUUM_PAGES)
+
+    def days_for(self, metric_type):
+        """ Returns the number of days of raw values to keep for the specified metric type. """
+
+        return self.days.get(metric_type, _DEFAULT_RETENTION_DAYS)
+
+
+class IngestionConfig:
+    """ Ingestion-level config which specifies how many polled samples (one ticker's metric values
+    at a point in time) may wait to be written to the database, how many are written per batch, how
+    many seconds a sample may wait for its batch to fill before it's written anyway, how many
+    seconds the poller waits for room in a full queue before dropping samples, and how many seconds
+    to wait before retrying a batch the database rejected. """
+
+    def __init__(self, ingestion_data):
+        self.queue_size = ingestion_data.get(_QUEUE_SIZE, _DEFAULT_QUEUE_SIZE)
+        self.batch_size = ingestion_data.get(_BATCH_SIZE, _DEFAULT_INGESTION_BATCH_SIZE)
+        self.flush_interval = ingestion_data.get(_FLUSH_INTERVAL, _DEFAULT_FLUSH_INTERVAL)
+        self.put_timeout = ingestion_data.get(_PUT_TIMEOUT, _DEFAULT_PUT_TIMEOUT)
+        self.retry_interval = ingestion_data.get(_RETRY_INTERVAL, _DEFAULT_RETRY_INTERVAL)
+
+
+class SchedulingConfig:
+    """ Scheduling-level config which specifies how often, in seconds, each ticker is polled. On
+    average every ticker is polled once an interval, but the poller adapts each ticker's own
+    interval to how volatile it's been, between min_interval and max_interval, recomputing them
+    every adapt_interval. Tickers listed under tickers are polled at a fixed interval instead. Each
+    poll is scheduled up to a jitter fraction of its interval early or late, and the poller checks
+    for due tickers once a tick. """
+
+    def __init__(self, scheduling_data):
+        self.interval = scheduling_data.get(_INTERVAL, _DEFAULT_INTERVAL)
+        self.min_interval = scheduling_data.get(_MIN_INTERVAL, _DEFAULT_MIN_INTERVAL)
+        self.max_interval = scheduling_data.get(_MAX_INTERVAL, _DEFAULT_MAX_INTERVAL)
+        self.jitter = scheduling_data.get(_JITTER, _DEFAULT_JITTER)
+        self.tick = scheduling_data.get(_TICK, _DEFAULT_TICK)
+        self.adapt_interval = scheduling_data.get(_ADAPT_INTERVAL, _DEFAULT_ADAPT_INTERVAL)
+        self.tickers = {
+            ticker.upper(): interval
+            for ticker, interval in scheduling_data.get(_TICKERS, dict()).items()
+        }
+
+        if not self.min_interval <= self.interval <= self.max_interval:
+            raise ValueError('Scheduling interval must be between min_interval and max_interval')
+
+
+class GovernorConfig:
+    """ Governor-level config which specifies how many Cryptowatch requests a second the poller may
+    make on average (rate), and in a burst; how many API credits to leave unspent, and how many
+    seconds a reported credit balance is trusted for; how many seconds a failing ticker is first
+    backed off for, doubling with each failure in a row up to backoff_max, with a backoff_jitter
+    fraction of randomness; and the priority of each ticker (0 unless listed under priorities), the
+    highest being polled first when requests are short. """
+
+    def __init__(self, governor_data):
+        self.rate = governor_data.get(_RATE, _DEFAULT_RATE)
+        self.burst = governor_data.get(_BURST, _DEFAULT_BURST)
+        self.credit_reserve = governor_data.get(_CREDIT_RESERVE, _DEFAULT_CREDIT_RESERVE)
+        self.credit_refresh_interval = governor_data.get(
+            _CREDIT_REFRESH_INTERVAL, _DEFAULT_CREDIT_REFRESH_INTERVAL
+        )
+        self.backoff_base = governor_data.get(_BACKOFF_BASE, _DEFAULT_BACKOFF_BASE)
+        self.backoff_max = governor_data.get(_BACKOFF_MAX, _DEFAULT_BACKOFF_MAX)
+        self.backoff_jitter = governor_data.get(_BACKOFF_JITTER, _DEFAULT_BACKOFF_JITTER)
+        self.priorities = {
+            ticker.upper(): priority
+            for ticker, priority in governor_data.get(_PRIORITIES, dict()).items()
+        }
+
+
+class HttpConfig:
+    """ HTTP-level config which specifies how many connections to Cryptowatch are kept open for
+    reuse (pool_size, which requests wait for if they're all in use), how many seconds a request may
+    take to connect and to read a response, and how many times a request is retried after a
+    connection error or one of the retry_statuses, with waits between retries that double each time,
+    scaled by retry_backoff. """
+
+    def __init__(self, http_data):
+        self.pool_size = http_data.get(_POOL_SIZE, _DEFAULT_POOL_SIZE)
+        self.connect_timeout = http_data.get(_CONNECT_TIMEOUT, _DEFAULT_CONNECT_TIMEOUT)
+        self.read_timeout = http_data.get(_READ_TIMEOUT, _DEFAULT_READ_TIMEOUT)
+        self.retries = http_data.get(_RETRIES, _DEFAULT_RETRIES)
+        self.retry_backoff = http_data.get(_RETRY_BACKOFF, _DEFAULT_RETRY_BACKOFF)
+        self.retry_statuses = http_data.get(_RETRY_STATUSES, _DEFAULT_RETRY_STATUSES)
+
+
 class CryptoMetricsConfig:
-    """ Top-level config class that specifies which crypto markets are to be polled and which
-    crypto/fiat pairs in each market are tracked. """
+    """ Top-level config class that specifies which crypto markets are to be polled, which
+    crypto/fiat pairs in each market are tracked, how often and how the poller fans out its
+    requests, how many requests it may make and over which connections, how polled values are
+    queued up for the database, and how long metric values are retained. """
 
     def __init__(self, config_path):
         try:
             with open(config_path) as f:
                 data = json.loads(f.read())
                 self.markets = [MarketConfig(market) for market in data[_MARKETS]]
+                self.polling = PollingConfig(data.get(_POLLING, dict()))
+                self.scheduling = SchedulingConfig(data.get(_SCHEDULING, dict()))
+                self.governor = GovernorConfig(data.get(_GOVERNOR, dict()))
+                self.http = HttpConfig(data.get(_HTTP, dict()))
+                self.retention = RetentionConfig(data.get(_RETENTION, dict()))
+                self.ingestion = IngestionConfig(data.get(_INGESTION, dict()))
 
         except Exception as e:
             raise RuntimeError('Could not load crypto metrics config: {}'.format(e))
@@ -1,13 +1,22 @@
+import json
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from logging import getLogger, INFO
 from os import environ
+from threading import BoundedSemaphore
 
 import cryptowatch as cw_client
 from cryptowatch.errors import CryptowatchError
+from requests.exceptions import RequestException
 
 from montecarlo.metrics.config import CRYPTO_CONFIG
+from montecarlo.metrics.governor import RequestGovernor
+from montecarlo.metrics.http_session import create_session
 from montecarlo.persistence.metrics_manager import (
     bulk_save_metrics,
+    refresh_metric_rankings,
     METRIC_PRICE,
     METRIC_VOLUME
 )
@@ -18,14 +27,43 @@ _log.setLevel(INFO)
 
 _API_KEY = 'CRYPTO_API_KEY'
 _TICKER_TEMPLATE = '{market_name}:{pair_name}'
+_ALL_SUMMARIES_RESOURCE = '/markets/summaries'
+_MARKET_SUMMARY_RESOURCE = '/markets/{market_name}/{pair_name}/summary'
 
 # If a Cryptowatch API key is specified, use that instead of relying on free daily API credits.
 cw_client.api_key = environ.get(_API_KEY)
 
+# Make every Cryptowatch request over one pool of kept-alive connections, shared by every polling
+# thread, rather than the SDK's own session.
+HTTP_SESSION = create_session(CRYPTO_CONFIG.http)
+cw_client.requestor.api_client = HTTP_SESSION
+
+# Bound every individual Cryptowatch request, so one slow market can't stall a whole poll cycle.
+cw_client.requestor.connect_timeout = CRYPTO_CONFIG.http.connect_timeout
+cw_client.requestor.read_timeout = CRYPTO_CONFIG.http.read_timeout
+
+# Every Cryptowatch request the poller makes goes through this, so it slows down as it runs out of
+# API credits rather than being throttled.
+REQUEST_GOVERNOR = RequestGovernor(CRYPTO_CONFIG.governor)
+
+
+def get_configured_tickers():
+    """ Returns a list of (market name, ticker) tuples for every crypto/fiat pair of every market
+    in the config, in config order. """
+
+    return [
+        (market.name, _TICKER_TEMPLATE.format(market_name=market.name, pair_name=pair).upper())
+        for market in CRYPTO_CONFIG.markets
+        for pair in market.pairs
+    ]
 
-def poll_crypto_metrics():
+
+def poll_crypto_metrics(metric_writer=None, tickers=None):
     """ Entry point for the periodic task which polls Cryptowatch for crypto metrics, and persists
-    these metrics for retrieval by the web API. """
+    these metrics for retrieval by the web API. If a MetricWriter is given, the metrics are queued
+    up for it to write in the background, rather than written before returning. If a collection of
+    tickers is given, only those are polled, rather than every configured ticker. Requests are only
+    made as REQUEST_GOVERNOR allows: tickers it skips or is backing off aren't polled this time. """
 
     # Grab the current timestamp to assign to these metrics when we persist them.
     now = datetime.utcnow()
@@ -34,23 +72,115 @@ def poll_crypto_metrics():
     # insertion into the database.
     ticker_metric_map = dict()
 
-    # For each crypto/fiat pair in each market, construct the ticker identifier and pull the
+    # For each crypto/fiat pair in each market, construct the ticker identifier so we can pull the
     # latest market summary from the cryptowatch API. This crypto summary will include latest price
     # quotes as well as trade volume information.
-    for market in CRYPTO_CONFIG.markets:
-        for pair in market.pairs:
-            ticker = _TICKER_TEMPLATE.format(market_name=market.name, pair_name=pair).upper()
-            try:
-                price, volume = pull_market_summary(ticker)
-                ticker_metric_map[ticker] = {METRIC_PRICE: price, METRIC_VOLUME: volume}
-
-            except CryptowatchError as e:
-                err = 'Failed to pull market summary for {ticker}: {e}'.format(ticker=ticker, e=e)
-                _log.error(err)
+    # Markets with enough pairs being polled are served from a single bulk "all summaries" call,
+    # which costs far fewer API credits than one call per ticker. The rest are pulled per ticker.
+    polled_tickers = [
+        (market_name, ticker) for market_name, ticker in get_configured_tickers()
+        if tickers is None or ticker in tickers
+    ]
+    market_ticker_counts = Counter(market_name for market_name, _ in polled_tickers)
+
+    bulk_market_tickers = list()
+    market_tickers = list()
+    for market_name, ticker in polled_tickers:
+        if market_ticker_counts[market_name] >= CRYPTO_CONFIG.polling.bulk_threshold:
+            bulk_market_tickers.append((market_name, ticker))
+        else:
+            market_tickers.append((market_name, ticker))
+
+    # The bulk request is tried first, as it serves the most tickers. If the governor won't let it
+    # through, its tickers are requested individually, as far as the governor allows.
+    if bulk_market_tickers and not REQUEST_GOVERNOR.select([_ALL_SUMMARIES_RESOURCE])[0]:
+        market_tickers = bulk_market_tickers + market_tickers
+        bulk_market_tickers = list()
+
+    if bulk_market_tickers:
+        try:
+            all_summaries = pull_all_market_summaries()
+            REQUEST_GOVERNOR.record_success(_ALL_SUMMARIES_RESOURCE)
+            for _, ticker in bulk_market_tickers:
+                if ticker in all_summaries:
+                    price, volume = all_summaries[ticker]
+                    ticker_metric_map[ticker] = {METRIC_PRICE: price, METRIC_VOLUME: volume}
+                else:
+                    _log.error('No market summary for {ticker} in bulk response.'.format(
+                        ticker=ticker
+                    ))
+
+        except (CryptowatchError, RequestException, KeyError, ValueError) as e:
+            # Don't lose the whole cycle for these markets, fall back to pulling them per ticker.
+            err = 'Failed to pull all market summaries, falling back to per-ticker: {e}'.format(e=e)
+            _log.error(err)
+            REQUEST_GOVERNOR.record_failure(_ALL_SUMMARIES_RESOURCE, e)
+            market_tickers = bulk_market_tickers + market_tickers
+
+    # Sample fewer tickers rather than be throttled into losing them all.
+    granted, skipped = REQUEST_GOVERNOR.select([ticker for _, ticker in market_tickers])
+    if skipped:
+        _log.warning('Request budget exhausted, skipping {count} tickers: {tickers}'.format(
+            count=len(skipped),
+            tickers=', '.join(skipped)
+        ))
+    granted = set(granted)
+    market_tickers = [(market_name, t) for market_name, t in market_tickers if t in granted]
+
+    # Fan the market summary requests out across a bounded thread pool, but collect the results in
+    # config order so the resulting map doesn't depend on which request happened to finish first.
+    for ticker, future in _submit_market_summaries(market_tickers, CRYPTO_CONFIG.polling):
+        try:
+            price, volume = future.result()
+            ticker_metric_map[ticker] = {METRIC_PRICE: price, METRIC_VOLUME: volume}
+            REQUEST_GOVERNOR.record_success(ticker)
+
+        except (CryptowatchError, RequestException, KeyError, ValueError) as e:
+            err = 'Failed to pull market summary for {ticker}: {e}'.format(ticker=ticker, e=e)
+            _log.error(err)
+            REQUEST_GOVERNOR.record_failure(ticker, e)
+
+    if metric_writer is not None:
+        # The writer persists these metrics and re-ranks metrics once they're written.
+        metric_writer.submit(ticker_metric_map, now)
+        return
 
     # Persist these metrics to the database.
     bulk_save_metrics(ticker_metric_map, now)
 
+    # Now that every metric's statistics include this cycle, re-rank metrics against each other so
+    # the web API doesn't have to.
+    refresh_metric_rankings(now)
+
+
+def _submit_market_summaries(market_tickers, polling_config):
+    """ Accepts a list of (market name, ticker) tuples and submits a market summary request for
+    each to a thread pool, limiting both the overall concurrency and the number of requests in
+    flight against any single market. Returns a list of (ticker, future) tuples in the same order
+    as the tickers were provided. """
+
+    # One semaphore per market, so a market with many configured pairs can't monopolize the pool
+    # (or get us throttled by hammering a single exchange).
+    market_semaphores = dict()
+    for market_name, _ in market_tickers:
+        if market_name not in market_semaphores:
+            market_semaphores[market_name] = BoundedSemaphore(polling_config.max_per_market)
+
+    with ThreadPoolExecutor(max_workers=polling_config.max_workers) as executor:
+        return [
+            (ticker, executor.submit(
+                _pull_market_summary_limited, ticker, market_semaphores[market_name]
+            ))
+            for market_name, ticker in market_tickers
+        ]
+
+
+def _pull_market_summary_limited(ticker, market_semaphore):
+    """ Pulls the market summary for the ticker, once a slot is available for its market. """
+
+    with market_semaphore:
+        return pull_market_summary(ticker)
+
 
 def pull_market_summary(ticker):
     """ Calls the cryptowatch market summary API for the market and crypto/fiat pair ticker, and
@@ -59,9 +189,18 @@ def pull_market_summary(ticker):
 
     _log.info('Pulling market summary for {ticker}.'.format(ticker=ticker))
 
-    market_summary = cw_client.markets.get(ticker).market
-    price = market_summary.price.last
-    volume = market_summary.volume
+    # Go through the SDK's requestor rather than its markets resource, which rounds the fractional
+    # API credits in the response down to whole ones.
+    market_name, pair_name = ticker.split(':')
+    data, _ = cw_client.requestor.get_resource(
+        _MARKET_SUMMARY_RESOURCE.format(market_name=market_name, pair_name=pair_name)
+    )
+    response = json.loads(data)
+    REQUEST_GOVERNOR.record_allowance(response.get('allowance'))
+
+    market_summary = response['result']
+    price = market_summary['price']['last']
+    volume = market_summary['volume']
 
     _log.debug('{ticker}: price={price}, volume={volume}'.format(
         ticker=ticker,
@@ -70,3 +209,24 @@ def pull_market_summary(ticker):
     ))
 
     return price, volume
+
+
+def pull_all_market_summaries():
+    """ Calls the cryptowatch "all market summaries" API, which returns summaries for every market
+    and crypto/fiat pair in a single request, and returns a map of ticker to a tuple of
+    (price, volume) for this instant in time. """
+
+    _log.info('Pulling all market summaries.')
+
+    # The SDK doesn't wrap this resource, so go through its requestor directly; that way we still
+    # share its session, timeouts, retries and error handling.
+    data, _ = cw_client.requestor.get_resource(_ALL_SUMMARIES_RESOURCE)
+    response = json.loads(data)
+    REQUEST_GOVERNOR.record_allowance(response.get('allowance'))
+    summaries = response['result']
+
+    # Cryptowatch keys these as lowercase "market:pair", normalize to our ticker format.
+    return {
+        ticker.upper(): (summary['price']['last'], summary['volume'])
+        for ticker, summary in summaries.items()
+    }
@@ -0,0 +1,243 @@
+""" Governs how many Cryptowatch requests the poller makes, so that it slows down rather than being
+throttled into losing whole poll cycles.
+
+Requests are limited in two ways. A token bucket holds up to burst tokens and refills at rate
+tokens a second, with each request spending one. And Cryptowatch reports, with every response, what
+the request cost in API credits and how many credits are left: the governor stops spending once
+only credit_reserve credits would be left, going by what requests have been costing. Credits are
+replenished by Cryptowatch, so once the last reported balance is credit_refresh_interval seconds
+old, it's forgotten, and requests are let through again to find out the new balance. Being rate
+limited anyway (HTTP 429) counts as having no credits left.
+
+When there's less budget than tickers to poll, the highest priority tickers are polled and the rest
+skipped until a later poll cycle, ahead of other tickers of the same priority. Tickers that fail are
+backed off: they aren't polled again until an exponentially growing, jittered delay has passed,
+after which they're retried whether they're due or not. """
+
+from logging import getLogger, INFO
+from math import floor
+from random import Random
+from threading import Lock
+from time import monotonic
+
+from cryptowatch.errors import APIRateLimitError
+
+_log = getLogger(__name__)
+_log.setLevel(INFO)
+
+# Weight given to each new request cost in the running estimate of what a request costs
+_COST_SMOOTHING = 0.2
+
+# Most times a ticker's backoff is doubled. Far more than any sensible backoff_max needs.
+_MAX_BACKOFF_DOUBLINGS = 32
+
+
+class GovernorStats:
+    """ A snapshot of the governor's budget, and running totals of the requests it's let through,
+    skipped for lack of budget, seen fail, and seen rate limited. """
+
+    def __init__(self, tokens, credits_remaining, request_cost, backing_off, requests_granted,
+                 requests_skipped, requests_failed, requests_rate_limited):
+        self.tokens = tokens
+        self.credits_remaining = credits_remaining
+        self.request_cost = request_cost
+        self.backing_off = backing_off
+        self.requests_granted = requests_granted
+        self.requests_skipped = requests_skipped
+        self.requests_failed = requests_failed
+        self.requests_rate_limited = requests_rate_limited
+
+    def to_json(self):
+        return {
+            'tokens': self.tokens,
+            'credits_remaining': self.credits_remaining,
+            'request_cost': self.request_cost,
+            'backing_off': self.backing_off,
+            'requests_granted': self.requests_granted,
+            'requests_skipped': self.requests_skipped,
+            'requests_failed': self.requests_failed,
+            'requests_rate_limited': self.requests_rate_limited
+        }
+
+
+class RequestGovernor:
+    """ Decides which requests, each identified by a key (a ticker, or the resource for requests
+    not specific to one), may be made, as configured by a GovernorConfig. Safe to use from several
+    threads. """
+
+    def __init__(self, governor_config, clock=monotonic, random=None):
+        self.config = governor_config
+        self._clock = clock
+        self._random = random if random is not None else Random()
+        self._lock = Lock()
+
+        self._share = 1.0
+        self._tokens = float(governor_config.burst)
+        self._refilled_at = clock()
+
+        self._credits_remaining = None
+        self._credits_updated_at = None
+        self._request_cost = None
+
+        # Keys which failed: how many times in a row, and when they may next be tried
+        self._failures = dict()
+        self._retry_at = dict()
+
+        # How many times in a row each key has been skipped for lack of budget
+        self._skips = dict()
+
+        self._requests_granted = 0
+        self._requests_skipped = 0
+        self._requests_failed = 0
+        self._requests_rate_limited = 0
+
+    def set_share(self, share):
+        """ Scales the token bucket's rate and burst down to a share of those configured, for when
+        several poller processes make requests at the same time. The credit balance is the
+        account's, so it's shared already. """
+
+        with self._lock:
+            self._refill()
+            self._share = share
+            self._tokens = min(self._tokens, self._burst())
+
+    def select(self, keys):
+        """ Decides which of the keys may be requested now, spending a token (and the credits a
+        request is expected to cost) on each. Keys backing off from a failure are left out, and if
+        the budget doesn't cover the rest, the highest priority keys (and of those, the keys skipped
+        the most times in a row) are let through. Returns a tuple of the list of keys granted, and
+        the list of keys skipped for lack of budget, each in the order given. """
+
+        with self._lock:
+            now = self._clock()
+            self._refill()
+
+            ready = [key for key in keys if self._retry_at.get(key, now) <= now]
+            budget = min(len(ready), floor(self._tokens), self._affordable(now))
+
+            ranked = sorted(
+                ready, key=lambda k: (-self.config.priorities.get(k, 0), -self._skips.get(k, 0))
+            )
+            granted_keys = set(ranked[:budget])
+
+            granted, skipped = list(), list()
+            for key in ready:
+                if key in granted_keys:
+                    granted.append(key)
+                    self._skips.pop(key, None)
+                else:
+                    skipped.append(key)
+                    self._skips[key] = self._skips.get(key, 0) + 1
+
+            self._tokens -= len(granted)
+            if self._credits_remaining is not None and self._request_cost:
+                self._credits_remaining -= len(granted) * self._request_cost
+
+            self._requests_granted += len(granted)
+            self._requests_skipped += len(skipped)
+
+            return granted, skipped
+
+    def retries_due(self, keys):
+        """ Returns those of the keys backing off from a failure which are due to be retried. """
+
+        with self._lock:
+            now = self._clock()
+            return [key for key in keys if key in self._retry_at and self._retry_at[key] <= now]
+
+    def record_success(self, key):
+        """ Records a successful request, ending any backoff of its key. """
+
+        with self._lock:
+            self._failures.pop(key, None)
+            self._retry_at.pop(key, None)
+
+    def record_failure(self, key, error):
+        """ Records a failed request, backing its key off for longer each time it fails in a row.
+        Being rate limited also stops any more requests until the credit balance is refreshed. """
+
+        with self._lock:
+            now = self._clock()
+            failures = self._failures.get(key, 0) + 1
+            self._failures[key] = failures
+            self._retry_at[key] = now + self._backoff(failures)
+            self._requests_failed += 1
+
+            if isinstance(error, APIRateLimitError):
+                self._requests_rate_limited += 1
+                self._credits_remaining = 0.0
+                self._credits_updated_at = now
+
+    def record_allowance(self, allowance):
+        """ Records the API credit allowance reported with a response, a map with the request's
+        cost and the credits remaining. """
+
+        if not allowance or allowance.get('remaining') is None:
+            return
+
+        with self._lock:
+            self._credits_remaining = float(allowance['remaining'])
+            self._credits_updated_at = self._clock()
+
+            cost = allowance.get('cost')
+            if cost is not None:
+                self._request_cost = float(cost) if self._request_cost is None else (
+                    _COST_SMOOTHING * cost + (1 - _COST_SMOOTHING) * self._request_cost
+                )
+
+    def stats(self):
+        """ Returns a GovernorStats snapshot. """
+
+        with self._lock:
+            now = self._clock()
+            self._refill()
+            self._affordable(now)
+
+            return GovernorStats(
+                tokens=self._tokens,
+                credits_remaining=self._credits_remaining,
+                request_cost=self._request_cost,
+                backing_off=sum(1 for retry_at in self._retry_at.values() if retry_at > now),
+                requests_granted=self._requests_granted,
+                requests_skipped=self._requests_skipped,
+                requests_failed=self._requests_failed,
+                requests_rate_limited=self._requests_rate_limited
+            )
+
+    def _burst(self):
+        # A share of the bucket always holds at least one request.
+        return max(self.config.burst * self._share, 1.0)
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(
+            self._tokens + (now - self._refilled_at) * self.config.rate * self._share,
+            self._burst()
+        )
+        self._refilled_at = now
+
+    def _affordable(self, now):
+        # How many requests the credits left over the reserve pay for, if known.
+        if self._credits_updated_at is not None and \
+                now - self._credits_updated_at >= self.config.credit_refresh_interval:
+            self._credits_remaining = None
+            self._credits_updated_at = None
+
+        if self._credits_remaining is None:
+            return float('inf')
+
+        spendable = self._credits_remaining - self.config.credit_reserve
+        if spendable <= 0:
+            return 0
+        if not self._request_cost:
+            return float('inf')
+
+        return floor(spendable / self._request_cost)
+
+    def _backoff(self, failures):
+        config = self.config
+
+        # Cap the doubling, so a ticker that keeps failing doesn't overflow a float.
+        doublings = min(failures - 1, _MAX_BACKOFF_DOUBLINGS)
+        delay = min(config.backoff_base * 2 ** doublings, config.backoff_max)
+        return delay * (1 + self._random.uniform(-config.backoff_jitter, config.backoff_jitter))
@@ -0,0 +1,79 @@
+""" The pooled HTTP session the poller makes its Cryptowatch requests through.
+
+Connections are kept alive and reused between requests, so most requests don't pay for a new TCP
+connection and TLS handshake. The session is shared by every polling thread: up to pool_size
+connections are kept open, and once they're all in use, further requests wait for one to be free
+rather than opening connections that would be thrown away after a single request. """
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Hosts to keep connections open to; the poller only talks to Cryptowatch.
+_POOLED_HOSTS = 4
+
+
+class ConnectionStats:
+    """ Running totals of the requests sent over a session's connection pools (including retries),
+    and of the connections opened for them. Every request beyond the first on a connection reused
+    it. """
+
+    def __init__(self, requests, connections_opened):
+        self.requests = requests
+        self.connections_opened = connections_opened
+
+    @property
+    def connections_reused(self):
+        return max(self.requests - self.connections_opened, 0)
+
+    @property
+    def reuse_ratio(self):
+        if not self.requests:
+            return None
+
+        return self.connections_reused / self.requests
+
+    def to_json(self):
+        return {
+            'requests': self.requests,
+            'connections_opened': self.connections_opened,
+            'connections_reused': self.connections_reused,
+            'reuse_ratio': self.reuse_ratio
+        }
+
+
+def create_session(http_config):
+    """ Returns a requests Session with a connection pool and retry policy as configured by an
+    HttpConfig. Timeouts are per request, so are left to whoever makes them. """
+
+    retries = Retry(
+        total=http_config.retries,
+        backoff_factor=http_config.retry_backoff,
+        status_forcelist=http_config.retry_statuses
+    )
+    adapter = HTTPAdapter(
+        pool_connections=_POOLED_HOSTS,
+        pool_maxsize=http_config.pool_size,
+        max_retries=retries,
+        pool_block=True
+    )
+
+    session = Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_connection_stats(session):
+    """ Returns the ConnectionStats of the session's open connection pools. """
+
+    requests = connections_opened = 0
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                requests += pool.num_requests
+                connections_opened += pool.num_connections
+
+    return ConnectionStats(requests, connections_opened)
@@ -0,0 +1,248 @@
+""" Write-behind ingestion of polled metric values.
+
+Poll cycles hand their values to a MetricWriter, which queues them up in memory and returns
+straight away, rather than waiting on the database. A dedicated writer thread drains the queue in
+batches - once batch_size samples are waiting, or flush_interval seconds after the first of them
+arrived, whichever comes first - saving each batch with bulk_save_metrics and then re-ranking
+metrics, as a poll cycle used to, unless it's been asked not to (every metric is ranked at once, so
+only one of several poller processes needs to). A slow or locked database therefore only delays
+the writer.
+
+The queue is bounded. When it's full, poll cycles block until there's room again (backpressure)
+for up to put_timeout seconds, after which the rest of that cycle's samples are dropped and
+counted. Batches the database rejects are retried every retry_interval seconds, leaving new samples
+to queue up behind them. Closing the writer flushes everything still queued before it returns,
+giving up on a batch the database still rejects after a few more attempts. """
+
+from collections import OrderedDict
+from logging import getLogger, INFO
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from montecarlo import DB
+from montecarlo.persistence.metrics_manager import bulk_save_metrics, refresh_metric_rankings
+
+_log = getLogger(__name__)
+_log.setLevel(INFO)
+
+# Longest the writer thread waits on an empty queue before checking whether it's been closed
+_IDLE_WAIT_SECONDS = 0.5
+
+# Times to try writing a batch once the writer is closing, before giving up on it
+_SHUTDOWN_ATTEMPTS = 3
+
+
+class IngestionStats:
+    """ Counters and gauges of a MetricWriter: how many samples are queued now, and at most so far;
+    how many have been written, dropped because the queue stayed full, or lost to a failed batch at
+    shutdown; and how many batches have been flushed, and how long that took. """
+
+    def __init__(self):
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.samples_written = 0
+        self.samples_dropped = 0
+        self.samples_lost = 0
+        self.batches_flushed = 0
+        self.failed_flushes = 0
+        self.last_flush_seconds = None
+        self.max_flush_seconds = None
+        self.total_flush_seconds = 0.0
+
+    @property
+    def mean_flush_seconds(self):
+        if not self.batches_flushed:
+            return None
+
+        return self.total_flush_seconds / self.batches_flushed
+
+    def to_json(self):
+        return {
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'samples_written': self.samples_written,
+            'samples_dropped': self.samples_dropped,
+            'samples_lost': self.samples_lost,
+            'batches_flushed': self.batches_flushed,
+            'failed_flushes': self.failed_flushes,
+            'last_flush_seconds': self.last_flush_seconds,
+            'mean_flush_seconds': self.mean_flush_seconds,
+            'max_flush_seconds': self.max_flush_seconds
+        }
+
+
+class MetricWriter:
+    """ Queues polled metric values up and writes them to the database in batches, from its own
+    thread. Configured by an IngestionConfig. Re-ranks every metric after each batch if ranking is
+    set. Call start before submitting any values, and close to flush what's left and stop the
+    thread. """
+
+    def __init__(self, ingestion_config, ranking=True):
+        self.ranking = ranking
+        self.batch_size = ingestion_config.batch_size
+        self.flush_interval = ingestion_config.flush_interval
+        self.put_timeout = ingestion_config.put_timeout
+        self.retry_interval = ingestion_config.retry_interval
+
+        self._queue = Queue(maxsize=ingestion_config.queue_size)
+        self._closing = Event()
+        self._thread = Thread(target=self._run, name='metric-writer', daemon=True)
+
+        self._stats = IngestionStats()
+        self._stats_lock = Lock()
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, ticker_metric_map, timestamp):
+        """ Queues a poll cycle's map of tickers to their latest value for each metric type, taken
+        at the timestamp, to be written by bulk_save_metrics. Blocks while the queue is full, for up
+        to put_timeout seconds, then drops whatever didn't fit. Returns the number of samples (one
+        ticker's values) queued. """
+
+        if self._closing.is_set():
+            raise RuntimeError('Metric writer is closed')
+
+        samples = list(ticker_metric_map.items())
+        deadline = monotonic() + self.put_timeout
+        for queued, (ticker, metric_map) in enumerate(samples):
+            try:
+                self._queue.put(
+                    (timestamp, ticker, metric_map), timeout=max(0, deadline - monotonic())
+                )
+            except Full:
+                dropped = len(samples) - queued
+                _log.error('Metric write queue full, dropped {dropped} samples at {ts}.'.format(
+                    dropped=dropped,
+                    ts=timestamp
+                ))
+                with self._stats_lock:
+                    self._stats.samples_dropped += dropped
+                return queued
+
+            with self._stats_lock:
+                self._stats.max_queue_depth = max(self._stats.max_queue_depth, self._queue.qsize())
+
+        return len(samples)
+
+    def close(self):
+        """ Stops accepting values, waits for everything queued to be written, and stops the
+        writer thread. """
+
+        self._closing.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def stats(self):
+        """ Returns a snapshot of the writer's IngestionStats. """
+
+        with self._stats_lock:
+            stats = IngestionStats()
+            stats.__dict__.update(self._stats.__dict__)
+
+        stats.queue_depth = self._queue.qsize()
+        return stats
+
+    def _run(self):
+        try:
+            batch = list()
+            deadline = None
+            while True:
+                wait = _IDLE_WAIT_SECONDS if not batch else deadline - monotonic()
+                try:
+                    sample = self._queue.get(timeout=max(0, min(wait, _IDLE_WAIT_SECONDS)))
+                    if not batch:
+                        deadline = monotonic() + self.flush_interval
+                    batch.append(sample)
+                except Empty:
+                    pass
+
+                closed = self._closing.is_set() and self._queue.empty()
+                if batch and (len(batch) >= self.batch_size or monotonic() >= deadline or closed):
+                    self._flush(batch)
+                    batch = list()
+
+                if closed and not batch:
+                    return
+        finally:
+            DB.session.remove()
+
+    def _flush(self, batch):
+        """ Writes a batch of samples, and re-ranks metrics if asked to. Retries until that
+        succeeds, or only a few more times once the writer is closing. """
+
+        # Samples from the same poll cycle share a timestamp, and are saved together.
+        cycles = OrderedDict()
+        for timestamp, ticker, metric_map in batch:
+            cycles.setdefault(timestamp, dict())[ticker] = metric_map
+        latest_timestamp = max(cycles)
+
+        start = monotonic()
+        attempts_left = _SHUTDOWN_ATTEMPTS
+        while True:
+            try:
+                # Cycles are committed one at a time, so only write those not committed yet.
+                while cycles:
+                    timestamp, ticker_metric_map = next(iter(cycles.items()))
+                    bulk_save_metrics(ticker_metric_map, timestamp)
+                    del cycles[timestamp]
+                if self.ranking:
+                    refresh_metric_rankings(latest_timestamp)
+                break
+
+            except SQLAlchemyError as e:
+                DB.session.rollback()
+                unwritten = sum(len(ticker_metric_map) for ticker_metric_map in cycles.values())
+                with self._stats_lock:
+                    self._stats.failed_flushes += 1
+
+                if self._closing.is_set():
+                    attempts_left -= 1
+                    if attempts_left == 0:
+                        _log.error('Failed to write {count} samples at shutdown, lost: {e}'.format(
+                            count=unwritten,
+                            e=e
+                        ))
+                        with self._stats_lock:
+                            self._stats.samples_written += len(batch) - unwritten
+                            self._stats.samples_lost += unwritten
+                        return
+
+                _log.error('Failed to write {count} samples, retrying in {retry}s: {e}'.format(
+                    count=unwritten,
+                    retry=self.retry_interval,
+                    e=e
+                ))
+                if self._closing.is_set():
+                    sleep(self.retry_interval)
+                else:
+                    self._closing.wait(self.retry_interval)
+
+            except Exception:
+                # Don't let one bad batch stop the writer, and with it all ingestion. Any cycles
+                # committed before the failure are written all the same.
+                DB.session.rollback()
+                unwritten = sum(len(ticker_metric_map) for ticker_metric_map in cycles.values())
+                _log.exception('Failed to write {count} samples, lost.'.format(count=unwritten))
+                with self._stats_lock:
+                    self._stats.samples_written += len(batch) - unwritten
+                    self._stats.samples_lost += unwritten
+                return
+
+        elapsed = monotonic() - start
+        with self._stats_lock:
+            stats = self._stats
+            stats.samples_written += len(batch)
+            stats.batches_flushed += 1
+            stats.last_flush_seconds = elapsed
+            stats.max_flush_seconds = max(stats.max_flush_seconds or 0.0, elapsed)
+            stats.total_flush_seconds += elapsed
+
+        _log.info('Wrote {count} samples in {elapsed:.3f}s, {depth} still queued.'.format(
+            count=len(batch),
+            elapsed=elapsed,
+            depth=self._queue.qsize()
+        ))
@@ -0,0 +1,95 @@
+""" The poller process: polls each ticker's latest and greatest cryptocurrency metrics on its own
+interval (see montecarlo.metrics.scheduling), and runs the retention job hourly to keep the database
+from growing without bound. Polled metrics are written to the database by a background
+MetricWriter, so a slow database doesn't hold up polling.
+
+Run it with poller_entry.py, either as a single process polling every ticker, or as several shard
+processes each polling a share of them (see montecarlo.metrics.sharding). """
+
+from datetime import datetime
+from logging import getLogger, INFO
+from threading import Event
+
+from apscheduler.schedulers.background import BackgroundScheduler
+
+from montecarlo import DB
+from montecarlo.metrics.config import CRYPTO_CONFIG
+from montecarlo.metrics.crypto import HTTP_SESSION, REQUEST_GOVERNOR
+from montecarlo.metrics.http_session import get_connection_stats
+from montecarlo.metrics.ingestion import MetricWriter
+from montecarlo.metrics.scheduling import (
+    adapt_sampling_intervals,
+    create_sampling_scheduler,
+    poll_due_crypto_metrics
+)
+from montecarlo.persistence.metrics_manager import (
+    rebuild_rolling_stats,
+    warm_crypto_pair_metric_cache
+)
+from montecarlo.persistence.retention import run_retention
+
+_log = getLogger(__name__)
+_log.setLevel(INFO)
+
+
+def run_retention_job():
+    """ Runs retention as of now. The scheduler runs jobs in worker threads, and retention deletes
+    in small batches, so this doesn't hold up polling. """
+
+    run_retention(datetime.utcnow(), CRYPTO_CONFIG.retention)
+
+
+def backfill_rolling_stats():
+    """ Backfills rolling statistics for any metrics which have history but aren't tracked yet.
+    This inserts rows for metrics of every ticker, so must only run in one process at a time. """
+
+    rebuild_rolling_stats(datetime.utcnow())
+    DB.session.commit()
+
+
+def run_poller(tickers=None, stop_event=None, on_cycle=None, retention=True, backfill=True,
+               ranking=True):
+    """ Polls the specified tickers, or every configured ticker, until the stop event is set (or
+    the process is interrupted), then writes everything polled before returning. on_cycle is passed
+    on to poll_due_crypto_metrics. The retention job, rolling statistics backfill and re-ranking of
+    metrics after each write are only run if asked for, so that several poller processes don't run
+    them at once. """
+
+    # Load all known CryptoPairMetric IDs up front, so poll cycles don't need to look them up.
+    warm_crypto_pair_metric_cache()
+
+    if backfill:
+        backfill_rolling_stats()
+
+    metric_writer = MetricWriter(CRYPTO_CONFIG.ingestion, ranking=ranking)
+    metric_writer.start()
+
+    sampling_scheduler = create_sampling_scheduler(CRYPTO_CONFIG.scheduling, tickers)
+    adapt_sampling_intervals(sampling_scheduler)
+
+    # A tick that runs late is only run once, and never alongside the previous one.
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(
+        poll_due_crypto_metrics, 'interval', seconds=CRYPTO_CONFIG.scheduling.tick,
+        args=[sampling_scheduler, metric_writer, on_cycle], coalesce=True, max_instances=1
+    )
+    scheduler.add_job(
+        adapt_sampling_intervals, 'interval', seconds=CRYPTO_CONFIG.scheduling.adapt_interval,
+        args=[sampling_scheduler], coalesce=True, max_instances=1
+    )
+    if retention:
+        scheduler.add_job(run_retention_job, 'interval', hours=1)
+
+    try:
+        scheduler.start()
+        (stop_event if stop_event is not None else Event()).wait()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        # Let any poll cycle in progress finish queueing its metrics, then write everything queued.
+        if scheduler.running:
+            scheduler.shutdown()
+        metric_writer.close()
+        _log.info('Metric writer stopped: {}'.format(metric_writer.stats().to_json()))
+        _log.info('Request governor: {}'.format(REQUEST_GOVERNOR.stats().to_json()))
+        _log.info('HTTP connections: {}'.format(get_connection_stats(HTTP_SESSION).to_json()))
@@ -0,0 +1,216 @@
+""" Per-ticker scheduling of crypto metric polls.
+
+Rather than polling every ticker once a minute, each ticker has its own interval, and the poller
+checks every few seconds (a tick) which tickers are due and polls just those, together, so markets
+with several due tickers can still be served from one bulk request.
+
+Intervals adapt to how volatile each ticker has been: tickers are given a share of the polling
+budget - the request rate of polling every ticker once per configured interval - in
+proportion to the coefficient of variation (standard deviation over mean) of their price over the
+rolling statistics window, within the configured minimum and maximum intervals. Volatile pairs are
+polled more often and stable ones less often, without raising the total request rate. Tickers with
+a fixed interval configured use their share of the budget first.
+
+Each poll is scheduled a random jitter early or late, so tickers drift apart rather than all
+coming due on the same tick. A ticker is never queued up more than once: however late a tick runs,
+a due ticker is polled once, and its next poll is scheduled from then. """
+
+from datetime import datetime
+from logging import getLogger, INFO
+from random import Random
+from threading import Lock
+from time import monotonic
+
+from montecarlo import DB
+from montecarlo.metrics.crypto import (
+    get_configured_tickers,
+    poll_crypto_metrics,
+    REQUEST_GOVERNOR
+)
+from montecarlo.persistence.metrics_manager import (
+    get_all_crypto_pair_metrics,
+    get_rolling_stats,
+    METRIC_PRICE
+)
+
+_log = getLogger(__name__)
+_log.setLevel(INFO)
+
+
+class SamplingScheduler:
+    """ Tracks when each ticker is next due to be polled, as configured by a SchedulingConfig.
+    Safe to use from several threads. """
+
+    def __init__(self, tickers, scheduling_config, clock=monotonic, random=None):
+        self.config = scheduling_config
+        self._clock = clock
+        self._random = random if random is not None else Random()
+        self._lock = Lock()
+
+        self._intervals = {
+            ticker: scheduling_config.tickers.get(ticker, scheduling_config.interval)
+            for ticker in tickers
+        }
+
+        # Everything is due straight away, and drifts apart from there.
+        now = clock()
+        self._last_polled = dict()
+        self._next_due = {ticker: now for ticker in tickers}
+
+    def intervals(self):
+        """ Returns a map of each ticker to its current polling interval, in seconds. """
+
+        with self._lock:
+            return dict(self._intervals)
+
+    def due(self):
+        """ Returns the tickers due to be polled, and schedules their next polls on the assumption
+        they're polled now. """
+
+        with self._lock:
+            now = self._clock()
+            due = [ticker for ticker, next_due in self._next_due.items() if next_due <= now]
+            for ticker in due:
+                self._last_polled[ticker] = now
+                self._next_due[ticker] = now + self._jittered(self._intervals[ticker])
+
+            return due
+
+    def adapt(self, volatilities):
+        """ Recomputes the intervals of the tickers without a fixed interval, from a map of tickers
+        to how volatile they've recently been. Tickers missing from the map, e.g. because they've
+        no history yet, are treated as averagely volatile. Returns the new intervals. """
+
+        config = self.config
+
+        with self._lock:
+            adaptive = [ticker for ticker in self._intervals if ticker not in config.tickers]
+            if not adaptive:
+                return dict(self._intervals)
+
+            # The request rate of polling every ticker once an interval, less what the tickers
+            # with fixed intervals use up.
+            budget = len(self._intervals) / config.interval
+            budget -= sum(1 / self._intervals[t] for t in self._intervals if t in config.tickers)
+
+            known = [volatilities[t] for t in adaptive if volatilities.get(t) is not None]
+            average = sum(known) / len(known) if known else 1.0
+            weights = {
+                t: volatilities[t] if volatilities.get(t) is not None else average
+                for t in adaptive
+            }
+
+            rates = allocate_rates(
+                weights, budget, 1 / config.max_interval, 1 / config.min_interval
+            )
+            now = self._clock()
+            for ticker, rate in rates.items():
+                interval = 1 / rate
+                self._intervals[ticker] = interval
+
+                # Bring forward a poll which is now further off than the new interval allows.
+                if ticker in self._last_polled:
+                    self._next_due[ticker] = min(
+                        self._next_due[ticker], self._last_polled[ticker] + interval
+                    )
+
+            return dict(self._intervals)
+
+    def _jittered(self, interval):
+        return interval * (1 + self._random.uniform(-self.config.jitter, self.config.jitter))
+
+
+def allocate_rates(weights, budget, min_rate, max_rate):
+    """ Shares a total rate (e.g. requests per second) out between the keys of a map, in proportion
+    to their weights, but with each between min_rate and max_rate. Keys pushed to a bound are held
+    there, and the rest of the budget shared out again between the others. If the bounds don't
+    allow the budget to be met exactly, every key ends up at one of them. Returns a map of key to
+    rate. """
+
+    rates = dict()
+    free = dict(weights)
+    while free:
+        remaining = max(budget - sum(rates.values()), 0)
+        total_weight = sum(free.values())
+        shares = {
+            key: remaining * (weight / total_weight if total_weight > 0 else 1 / len(free))
+            for key, weight in free.items()
+        }
+
+        bounded = {
+            key: min(max(share, min_rate), max_rate)
+            for key, share in shares.items()
+            if not min_rate <= share <= max_rate
+        }
+        if not bounded:
+            rates.update(shares)
+            break
+
+        # Holding every key at the bound it broke would leave the others either short of budget or
+        # with some to spare. Only the keys which would stay at their bound either way can be held:
+        # those raised to min_rate in the first case, those lowered to max_rate in the second.
+        if sum(bounded.values()) > sum(shares[key] for key in bounded):
+            bounded = {key: rate for key, rate in bounded.items() if rate == min_rate}
+        else:
+            bounded = {key: rate for key, rate in bounded.items() if rate == max_rate}
+
+        rates.update(bounded)
+        for key in bounded:
+            del free[key]
+
+    return rates
+
+
+def get_ticker_volatilities(timestamp):
+    """ Returns a map of ticker to the coefficient of variation of its price over the rolling
+    statistics window ending at the specified timestamp, for those tickers whose statistics are
+    current and have a standard deviation. """
+
+    price_metrics = {
+        m.id: m.ticker for m in get_all_crypto_pair_metrics() if m.metric_type == METRIC_PRICE
+    }
+
+    volatilities = dict()
+    for metric_id, rolling_stats in get_rolling_stats(list(price_metrics), timestamp).items():
+        mean, standard_deviation = rolling_stats.mean, rolling_stats.standard_deviation
+        if standard_deviation is not None and mean:
+            volatilities[price_metrics[metric_id]] = standard_deviation / abs(mean)
+
+    return volatilities
+
+
+def create_sampling_scheduler(scheduling_config, tickers=None):
+    """ Returns a SamplingScheduler for the specified tickers, or for every configured ticker. """
+
+    if tickers is None:
+        tickers = [ticker for _, ticker in get_configured_tickers()]
+
+    return SamplingScheduler(tickers, scheduling_config)
+
+
+def poll_due_crypto_metrics(sampling_scheduler, metric_writer=None, on_cycle=None):
+    """ Entry point for the periodic task which polls the tickers which are due, as for
+    poll_crypto_metrics, along with any failed tickers due to be retried. If given, on_cycle is
+    called after each poll with how long it took, in seconds, and the number of tickers polled. """
+
+    tickers = set(sampling_scheduler.due())
+    tickers.update(REQUEST_GOVERNOR.retries_due(sampling_scheduler.intervals()))
+    if tickers:
+        start = monotonic()
+        poll_crypto_metrics(metric_writer, tickers=tickers)
+        if on_cycle is not None:
+            on_cycle(monotonic() - start, len(tickers))
+
+
+def adapt_sampling_intervals(sampling_scheduler):
+    """ Entry point for the periodic task which adapts each ticker's polling interval to its
+    recent volatility. """
+
+    try:
+        intervals = sampling_scheduler.adapt(get_ticker_volatilities(datetime.utcnow()))
+    finally:
+        DB.session.remove()
+
+    _log.info('Polling intervals: {}'.format(
+        ', '.join('{}={:.0f}s'.format(ticker, interval) for ticker, interval in intervals.items())
+    ))
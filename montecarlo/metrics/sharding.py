@@ -0,0 +1,277 @@
+""" Sharded polling: several poller processes, each polling its own share of the configured
+tickers, under a supervisor process.
+
+Tickers are assigned to shards by consistent hashing. Every shard owns a number of points on a hash
+ring, and a ticker belongs to the shard owning the first point at or after the ticker's own hash.
+Adding a shard only moves the tickers which land on its new points (about 1/N of them) over to it,
+and leaves every other ticker where it was, so most shards keep their warm caches and ring buffers.
+The assignment only depends on the ticker and the number of shards, so every process works it out
+the same way without coordinating.
+
+The supervisor starts a worker process per shard, restarts any which exit while it's running, and
+collects how long each shard's poll cycles take, which it logs periodically. On shutdown it asks
+every worker to stop, and waits for them to write what they've polled. The supervisor backfills
+rolling statistics once before starting the workers, and only shard 0 runs the retention job and
+re-ranks metrics, which covers every shard's metrics at once. """
+
+from bisect import bisect_left
+from hashlib import md5
+from logging import getLogger, INFO
+from multiprocessing import get_context
+from queue import Empty
+from signal import SIG_DFL, SIG_IGN, SIGINT, SIGTERM, signal
+from time import monotonic
+
+from montecarlo import DB
+from montecarlo.metrics.crypto import get_configured_tickers, HTTP_SESSION, REQUEST_GOVERNOR
+from montecarlo.metrics.poller import backfill_rolling_stats, run_poller
+
+_log = getLogger(__name__)
+_log.setLevel(INFO)
+
+# Points each shard owns on the hash ring. More points spread tickers more evenly between shards.
+_POINTS_PER_SHARD = 128
+
+# Longest the supervisor waits for a cycle report before checking on its workers
+_SUPERVISE_WAIT_SECONDS = 1.0
+
+
+class HashRing:
+    """ A consistent hash ring over shards numbered from 0 to shard_count - 1. """
+
+    def __init__(self, shard_count, points_per_shard=_POINTS_PER_SHARD):
+        if shard_count < 1:
+            raise ValueError('There must be at least one shard')
+
+        self.shard_count = shard_count
+        points = sorted(
+            (_hash('{}:{}'.format(shard, point)), shard)
+            for shard in range(shard_count)
+            for point in range(points_per_shard)
+        )
+        self._hashes = [h for h, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard_for(self, key):
+        """ Returns the shard the key belongs to. """
+
+        index = bisect_left(self._hashes, _hash(key))
+        return self._shards[index % len(self._shards)]
+
+
+def _hash(key):
+    # Stable across processes and runs, unlike the built-in hash of a string
+    return int.from_bytes(md5(key.encode()).digest()[:8], 'big')
+
+
+def assign_tickers(tickers, shard_count):
+    """ Returns a map of each shard (numbered from 0) to the list of tickers it polls, in the order
+    given. Every shard is in the map, even one with no tickers. """
+
+    ring = HashRing(shard_count)
+
+    assignment = {shard: list() for shard in range(shard_count)}
+    for ticker in tickers:
+        assignment[ring.shard_for(ticker)].append(ticker)
+
+    return assignment
+
+
+def get_shard_tickers(shard, shard_count):
+    """ Returns the configured tickers the shard polls. """
+
+    return assign_tickers([ticker for _, ticker in get_configured_tickers()], shard_count)[shard]
+
+
+def run_shard_worker(shard, shard_count, stop_event, reports):
+    """ Entry point of a shard's worker process: polls the shard's tickers until the stop event is
+    set, reporting each poll cycle's shard, duration in seconds and number of tickers polled. """
+
+    # Connections inherited from the supervisor can't be shared with it.
+    DB.engine.dispose()
+    HTTP_SESSION.close()
+
+    # The workers make requests at the same time, so each may only make its share of them.
+    REQUEST_GOVERNOR.set_share(1 / shard_count)
+
+    run_poller(
+        tickers=get_shard_tickers(shard, shard_count),
+        stop_event=stop_event,
+        on_cycle=lambda seconds, tickers: reports.put((shard, seconds, tickers)),
+        retention=shard == 0,
+        backfill=False,
+        ranking=shard == 0
+    )
+
+
+def _start_worker(worker, shard, shard_count, stop_event, reports):
+    # The supervisor handles Ctrl-C and termination, and stops its workers through the stop event.
+    signal(SIGINT, SIG_IGN)
+    signal(SIGTERM, SIG_DFL)
+    worker(shard, shard_count, stop_event, reports)
+
+
+def _exit_on_signal(signum, frame):
+    # Stops the supervisor as cleanly as Ctrl-C does.
+    raise SystemExit(0)
+
+
+class ShardStats:
+    """ What the supervisor knows of a shard: its worker's process ID, how often the worker has
+    been restarted, and how many poll cycles it's reported, how long they took and how many tickers
+    were polled in the last one. """
+
+    def __init__(self, shard):
+        self.shard = shard
+        self.pid = None
+        self.restarts = 0
+        self.cycles = 0
+        self.last_cycle_seconds = None
+        self.max_cycle_seconds = None
+        self.total_cycle_seconds = 0.0
+        self.last_cycle_tickers = None
+
+    @property
+    def mean_cycle_seconds(self):
+        if not self.cycles:
+            return None
+
+        return self.total_cycle_seconds / self.cycles
+
+    def to_json(self):
+        return {
+            'shard': self.shard,
+            'pid': self.pid,
+            'restarts': self.restarts,
+            'cycles': self.cycles,
+            'last_cycle_seconds': self.last_cycle_seconds,
+            'mean_cycle_seconds': self.mean_cycle_seconds,
+            'max_cycle_seconds': self.max_cycle_seconds,
+            'last_cycle_tickers': self.last_cycle_tickers
+        }
+
+
+class PollerSupervisor:
+    """ Runs a worker process per shard, restarting any which exit, until stopped. Each worker
+    calls worker(shard, shard_count, stop_event, reports), and should return once the stop event is
+    set, putting a (shard, seconds, tickers polled) tuple on the reports queue after each cycle. """
+
+    def __init__(self, shard_count, worker=run_shard_worker, restart_delay=5, report_interval=60):
+        self.shard_count = shard_count
+        self.worker = worker
+        self.restart_delay = restart_delay
+        self.report_interval = report_interval
+
+        self._context = get_context()
+        self._stop_event = self._context.Event()
+        self._reports = self._context.Queue()
+
+        self._processes = dict()
+        self._restart_at = dict()
+        self._stats = {shard: ShardStats(shard) for shard in range(shard_count)}
+
+    def start(self):
+        """ Starts every shard's worker. """
+
+        for shard in range(self.shard_count):
+            self._start(shard)
+
+    def _start(self, shard):
+        process = self._context.Process(
+            target=_start_worker,
+            args=(self.worker, shard, self.shard_count, self._stop_event, self._reports),
+            name='poller-shard-{}'.format(shard)
+        )
+        process.start()
+
+        self._processes[shard] = process
+        self._stats[shard].pid = process.pid
+
+    def supervise(self, timeout=_SUPERVISE_WAIT_SECONDS):
+        """ Collects the cycle reports that arrive within the timeout, then restarts any worker
+        which has exited, once it's been gone for restart_delay seconds. """
+
+        deadline = monotonic() + timeout
+        while True:
+            try:
+                shard, seconds, tickers = self._reports.get(
+                    timeout=max(0, deadline - monotonic())
+                )
+            except Empty:
+                break
+
+            stats = self._stats[shard]
+            stats.cycles += 1
+            stats.last_cycle_seconds = seconds
+            stats.max_cycle_seconds = max(stats.max_cycle_seconds or 0.0, seconds)
+            stats.total_cycle_seconds += seconds
+            stats.last_cycle_tickers = tickers
+
+        if self._stop_event.is_set():
+            return
+
+        now = monotonic()
+        for shard, process in self._processes.items():
+            if process.is_alive():
+                continue
+
+            if shard not in self._restart_at:
+                _log.error('Poller shard {shard} exited with code {code}, restarting.'.format(
+                    shard=shard,
+                    code=process.exitcode
+                ))
+                self._restart_at[shard] = now + self.restart_delay
+
+            elif now >= self._restart_at[shard]:
+                del self._restart_at[shard]
+                self._stats[shard].restarts += 1
+                self._start(shard)
+
+    def stats(self):
+        """ Returns a map of each shard to its ShardStats. """
+
+        return dict(self._stats)
+
+    def stop(self, timeout=60):
+        """ Asks every worker to stop, waits up to the timeout for them to finish writing, and
+        terminates any still running after that. """
+
+        self._stop_event.set()
+
+        # Keep collecting reports meanwhile, as a worker can't exit with reports it's yet to send.
+        deadline = monotonic() + timeout
+        for shard, process in self._processes.items():
+            while process.is_alive() and monotonic() < deadline:
+                self.supervise(timeout=0.1)
+
+            if process.is_alive():
+                _log.error('Poller shard {} didn\'t stop in time, terminating.'.format(shard))
+                process.terminate()
+            process.join()
+
+        self.supervise(timeout=0)
+
+    def run(self):
+        """ Backfills rolling statistics, then starts the workers and supervises them until
+        interrupted or terminated, logging each shard's stats every report_interval seconds. """
+
+        signal(SIGTERM, _exit_on_signal)
+
+        # Before any worker is writing, as the backfill covers every shard's metrics.
+        backfill_rolling_stats()
+        DB.session.remove()
+
+        self.start()
+        next_report = monotonic() + self.report_interval
+        try:
+            while True:
+                self.supervise()
+
+                if monotonic() >= next_report:
+                    next_report += self.report_interval
+                    for stats in self._stats.values():
+                        _log.info('Poller shard stats: {}'.format(stats.to_json()))
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            self.stop()
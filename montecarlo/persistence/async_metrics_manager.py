@@ -0,0 +1,109 @@
+""" Read-only queries against this app's database for the async (ASGI) API, mirroring those of the
+same names in metrics_manager. Each takes the AsyncSession to run in, so a caller can run several
+at once on separate sessions. """
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from montecarlo.persistence.metrics_manager import (
+    _24h_metric_aggregates_statement,
+    _24h_metric_history_statement,
+    _24h_metric_rollups_statement,
+    _data_generation_statement,
+    _fresh_ranking,
+    _latest_metric_timestamp_statement,
+    _metric_aggregates_by_id
+)
+from montecarlo.persistence.models import CryptoPairMetric, MetricRanking
+
+# Async drivers for the databases the async app can serve. There's no async PostgreSQL driver
+# in requirements.txt yet.
+_ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite'
+}
+
+
+def create_async_metrics_engine(database_uri, pool_size):
+    """ Returns an AsyncEngine for the database at the (synchronous, as configured for the Flask
+    app) URI, using an async driver, with a pool of up to pool_size connections. Raises
+    RuntimeError if there's no async driver for the database. """
+
+    url = make_url(database_uri)
+    backend = url.get_backend_name()
+    if backend not in _ASYNC_DRIVERS:
+        raise RuntimeError(
+            'The async app supports SQLite only, not "{}" databases.'.format(backend)
+        )
+    url = url.set(drivername=_ASYNC_DRIVERS[backend])
+
+    # The aiosqlite dialect opens a new connection (and thread) per checkout of a database file by
+    # default. An in-memory database keeps its single shared connection.
+    if url.database in (None, '', ':memory:'):
+        return create_async_engine(url)
+
+    return create_async_engine(url, poolclass=AsyncAdaptedQueuePool, pool_size=pool_size)
+
+
+async def get_data_generation(session):
+    """ Returns the current data generation, which changes whenever the poller commits changes to
+    metric data. """
+
+    generation = (await session.execute(_data_generation_statement())).scalar()
+
+    return generation if generation is not None else 0
+
+
+async def get_latest_metric_timestamp(session, metric_type=None):
+    """ Returns the timestamp of the most recent data point saved for any CryptoPairMetric, or any
+    of the specified metric type, or None if there are none. """
+
+    return (await session.execute(_latest_metric_timestamp_statement(metric_type))).scalar()
+
+
+async def get_all_crypto_pair_metrics(session):
+    """ Returns all CryptoPairMetrics. """
+
+    return (await session.execute(select(CryptoPairMetric))).scalars().all()
+
+
+async def get_crypto_pair_metric_by_id(session, metric_id):
+    """ Returns a CryptoPairMetric by ID. """
+
+    return await session.get(CryptoPairMetric, metric_id)
+
+
+async def get_metric_ranking(session, metric_id, timestamp):
+    """ Returns the materialized MetricRanking for the specified CryptoPairMetric, or None if it
+    hasn't been ranked or its ranking is too old to be trusted as of the specified timestamp. """
+
+    return _fresh_ranking(await session.get(MetricRanking, metric_id), timestamp)
+
+
+async def get_24h_metric_history(session, metric_id, ending_timestamp):
+    """ Returns 24 hours' worth of data points (MetricInstanceValue) for the specified
+    CryptoPairMetric ending at the specified timestamp. """
+
+    statement = _24h_metric_history_statement(metric_id, ending_timestamp)
+
+    return (await session.execute(statement)).scalars().all()
+
+
+async def get_24h_metric_aggregates(session, metric_type, ending_timestamp):
+    """ Returns a map of CryptoPairMetric ID to a tuple of (count, mean, sum of squared deviations
+    from the mean) of its data points over the 24 hours ending at the specified timestamp, for
+    every CryptoPairMetric of the specified metric type which has data points in that period. """
+
+    statement = _24h_metric_aggregates_statement(metric_type, ending_timestamp)
+
+    return _metric_aggregates_by_id(await session.execute(statement))
+
+
+async def get_24h_metric_rollups(session, metric_id, resolution, ending_timestamp):
+    """ Returns the MetricRollups at the specified resolution (in seconds) for the specified
+    CryptoPairMetric, covering the 24 hours ending at the specified timestamp, in time order. """
+
+    statement = _24h_metric_rollups_statement(metric_id, resolution, ending_timestamp)
+
+    return (await session.execute(statement)).scalars().all()
@@ -1,42 +1,596 @@
 """ Easy access queries and operations against this app's database. """
 
-from datetime import timedelta
+from collections import defaultdict
+from datetime import datetime, timedelta
+from logging import getLogger
+from threading import Lock
 
-from montecarlo import DB
-from montecarlo.persistence.models import CryptoPairMetric, MetricInstanceValue
+import numpy as np
+
+from sqlalchemy import String, bindparam, case, cast, exists, func, literal, select
+from sqlalchemy.exc import IntegrityError
+
+from montecarlo import DB, app
+from montecarlo.persistence.models import (
+    CryptoPairMetric,
+    DataGeneration,
+    MetricInstanceValue,
+    MetricRanking,
+    MetricRollingStats,
+    MetricRollup
+)
+from montecarlo.persistence.ring_buffer import COVERS_ALL, RingBufferStore
+
+_log = getLogger(__name__)
 
 METRIC_PRICE = 'price'
 METRIC_VOLUME = 'volume'
 
+# Rolling statistics cover this much history, and are only trusted while the poller has kept them
+# up to date within the staleness bound.
+ROLLING_STATS_WINDOW = timedelta(days=1)
+ROLLING_STATS_MAX_STALENESS = timedelta(minutes=5)
+
+# Rollup resolutions maintained for every metric, by name, in seconds.
+ROLLUP_RESOLUTIONS = {
+    '1m': 60,
+    '5m': 5 * 60,
+    '1h': 60 * 60
+}
+
+_EPOCH = datetime(1970, 1, 1)
+
+# The data generation counter lives in a single row
+_DATA_GENERATION_ID = 1
+
+# Materialized rankings are only trusted if they were computed within this long ago.
+RANKINGS_MAX_STALENESS = timedelta(minutes=5)
+
+_ROLLING_STATS_COLUMNS = [
+    'custom_metric_id', 'shift', 'count', 'total', 'total_sq', 'evicted_through'
+]
+
+
+# Memory-mapped ring buffers of each metric's most recent values, if configured. The database
+# remains the durable store, and is read instead whenever a ring buffer doesn't cover a request.
+RING_BUFFERS = RingBufferStore(
+    app.config['METRICS_RING_BUFFER_DIR'], app.config['METRICS_RING_BUFFER_CAPACITY']
+) if app.config['METRICS_RING_BUFFER_DIR'] else None
+
+# Process-level identity cache of (ticker, metric_type) to CryptoPairMetric ID, so a steady-state
+# poll cycle doesn't have to look up every CryptoPairMetric again before saving its values.
+_crypto_pair_metric_ids = dict()
+_crypto_pair_metric_ids_warmed = False
+_crypto_pair_metric_ids_lock = Lock()
+
+
+def warm_crypto_pair_metric_cache():
+    """ Loads the ID of every CryptoPairMetric into the identity cache with a single query,
+    replacing anything that was cached before. """
+
+    global _crypto_pair_metric_ids_warmed
+
+    rows = DB.session.query(
+        CryptoPairMetric.ticker,
+        CryptoPairMetric.metric_type,
+        CryptoPairMetric.id
+    ).all()
+
+    with _crypto_pair_metric_ids_lock:
+        _crypto_pair_metric_ids.clear()
+        _crypto_pair_metric_ids.update({
+            (ticker, metric_type): id for ticker, metric_type, id in rows
+        })
+        _crypto_pair_metric_ids_warmed = True
+
+
+def clear_crypto_pair_metric_cache():
+    """ Empties the identity cache, so that it's warmed again on next use. Call this whenever
+    CryptoPairMetrics are deleted or the tables are recreated out from under this process. """
+
+    global _crypto_pair_metric_ids_warmed
+
+    with _crypto_pair_metric_ids_lock:
+        _crypto_pair_metric_ids.clear()
+        _crypto_pair_metric_ids_warmed = False
+
 
 def bulk_save_metrics(ticker_metric_map, timestamp):
     """ Accepts a map of tickers (market + crypto/fiat pair combos) to their latest values for each
      metric type, as well the current timestamp, and bulk inserts records to the database for each
      of these metrics. """
 
-    # Hold a map of ticker + metric types to the CryptoPairMetrics DB entries which represent them.
-    crypto_pair_metric_map = dict()
-
-    # First make sure we have created instances of the CryptoPairMetrics themselves. Query them and
-    # create them if they are new, so we can reference them when adding the latest metric values to
-    # the database.
-    for ticker, metric_map in ticker_metric_map.items():
-        for metric_type, _ in metric_map.items():
-            crypto_pair_metric = _get_or_create_crypto_pair_metric(ticker, metric_type)
-            crypto_pair_metric_map[(ticker, metric_type)] = crypto_pair_metric
-
-    # Now that we know the corresponding CryptoPairMetrics (and have ensured they exist), create
-    # the MetricInstanceValues and bulk insert them into the database at once.
-    for ticker, metric_map in ticker_metric_map.items():
-        for metric_type, metric_value in metric_map.items():
-            DB.session.add(MetricInstanceValue(
-                crypto_pair_metric=crypto_pair_metric_map[(ticker, metric_type)],
-                metric_value=metric_value,
-                timestamp=timestamp
-            ))
+    if not _crypto_pair_metric_ids_warmed:
+        warm_crypto_pair_metric_cache()
+        rebuild_rolling_stats(timestamp)
+
+    try:
+        _save_metric_values(ticker_metric_map, timestamp)
+
+    except IntegrityError:
+        # A cached CryptoPairMetric no longer exists, so the values referencing it were rejected.
+        # Throw away the cache, reload it from the database and try once more.
+        DB.session.rollback()
+        warm_crypto_pair_metric_cache()
+        _save_metric_values(ticker_metric_map, timestamp)
+
+
+def _save_metric_values(ticker_metric_map, timestamp):
+    """ Adds a MetricInstanceValue for every ticker and metric type in the map, creating any
+    CryptoPairMetrics not yet known, and commits everything in a single transaction. """
+
+    # First make sure we know the IDs of the CryptoPairMetrics themselves, so we can reference them
+    # when adding the latest metric values to the database. Anything not in the identity cache is
+    # either new, or was created by someone else since the cache was warmed.
+    metric_keys = [
+        (ticker, metric_type)
+        for ticker, metric_map in ticker_metric_map.items()
+        for metric_type in metric_map
+    ]
+    metric_ids = {key: _crypto_pair_metric_ids.get(key) for key in metric_keys}
+    new_metric_ids = _get_or_create_crypto_pair_metric_ids(
+        [key for key, metric_id in metric_ids.items() if metric_id is None]
+    )
+    metric_ids.update(new_metric_ids)
+
+    # Now bulk insert the metric values into the database at once, and fold them into the rolling
+    # statistics in the same transaction.
+    rows = [
+        {
+            'custom_metric_id': metric_ids[(ticker, metric_type)],
+            'metric_value': metric_value,
+            'timestamp': timestamp
+        }
+        for ticker, metric_map in ticker_metric_map.items()
+        for metric_type, metric_value in metric_map.items()
+    ]
+    _insert_metric_values(rows)
+    _update_rolling_stats(rows, timestamp)
+    _update_rollups(rows)
+    _bump_data_generation()
 
     DB.session.commit()
 
+    # Only remember newly-seen CryptoPairMetrics once they've actually been committed.
+    with _crypto_pair_metric_ids_lock:
+        _crypto_pair_metric_ids.update(new_metric_ids)
+
+    # Likewise, ring buffers only ever hold committed values.
+    _append_to_ring_buffers(rows)
+
+
+def _insert_metric_values(rows):
+    """ Inserts metric values, given as a list of dicts of MetricInstanceValue column values, with a
+    single Core executemany INSERT in the current session's transaction. This skips building an
+    ORM object (and the unit-of-work bookkeeping that comes with it) for every value. """
+
+    if rows:
+        DB.session.execute(MetricInstanceValue.__table__.insert(), rows)
+
+
+def _append_to_ring_buffers(rows):
+    """ Appends committed metric values (as passed to _insert_metric_values) to their metrics'
+    ring buffers, if configured. A ring buffer is rebuilt from the database instead the first time
+    this process writes to it, in case values were committed since it was last written to, and
+    whenever values arrive out of order. """
+
+    if RING_BUFFERS is None:
+        return
+
+    values_by_metric = defaultdict(list)
+    for row in rows:
+        values_by_metric[row['custom_metric_id']].append(
+            (_epoch_microseconds(row['timestamp']), row['metric_value'])
+        )
+
+    for metric_id, values in values_by_metric.items():
+        values.sort()
+        try:
+            ring_buffer, opened = RING_BUFFERS.open_for_writing(metric_id)
+            last_timestamp = ring_buffer.last_timestamp
+
+            if opened or (last_timestamp is not None and values[0][0] <= last_timestamp):
+                _rebuild_ring_buffer(metric_id, ring_buffer)
+            else:
+                ring_buffer.append(*zip(*values))
+
+        except (OSError, ValueError):
+            # Readers notice the ring buffer is behind the database, and read the database instead.
+            # Rebuild it next time.
+            _log.exception('Failed to update the ring buffer for metric %s.', metric_id)
+            RING_BUFFERS.close(metric_id)
+
+
+def _rebuild_ring_buffer(metric_id, ring_buffer):
+    """ Refills a ring buffer with the metric's most recent values from the database. """
+
+    values = MetricInstanceValue.__table__
+    rows = DB.session.execute(
+        select(values.c.timestamp, values.c.metric_value).
+        where(values.c.custom_metric_id == metric_id).
+        order_by(values.c.timestamp.desc()).
+        limit(ring_buffer.capacity)
+    ).all()
+    rows.reverse()
+
+    timestamps = [_epoch_microseconds(timestamp) for timestamp, _ in rows]
+
+    # If the metric has more values than fit, the ring buffer only covers the ones it holds.
+    covered_since = timestamps[0] if len(rows) == ring_buffer.capacity else COVERS_ALL
+    ring_buffer.rebuild(timestamps, [value for _, value in rows], covered_since)
+
+
+def _read_ring_buffers(metric_ids, starting_timestamp, ending_timestamp):
+    """ Returns a map of each of the specified CryptoPairMetric IDs to a tuple of arrays of the
+    timestamps (as epoch microseconds) and values of its data points between the specified
+    timestamps, inclusive, from its ring buffer. Returns None unless every metric's ring buffer
+    covers that period and holds everything the database does, for the caller to read the database
+    instead. """
+
+    if RING_BUFFERS is None or not metric_ids:
+        return None
+
+    windows = dict()
+    for metric_id in metric_ids:
+        ring_buffer = RING_BUFFERS.open(metric_id)
+        window = ring_buffer.read(
+            _epoch_microseconds(starting_timestamp), _epoch_microseconds(ending_timestamp)
+        ) if ring_buffer is not None else None
+
+        if window is None:
+            return None
+        windows[metric_id] = window
+
+    # Ring buffers are written just after the database is committed to, so one may not have the
+    # latest values yet. Check every metric's latest value in the period is there.
+    for metric_id, latest in _get_latest_metric_timestamps(metric_ids, ending_timestamp).items():
+        timestamps, _ = windows[metric_id]
+        if latest is not None and latest >= starting_timestamp and (
+            len(timestamps) == 0 or timestamps[-1] < _epoch_microseconds(latest)
+        ):
+            return None
+
+    return windows
+
+
+def _read_metric_type_ring_buffers(metric_type, starting_timestamp, ending_timestamp):
+    """ As for _read_ring_buffers, for every CryptoPairMetric of the specified metric type. """
+
+    if RING_BUFFERS is None:
+        return None
+
+    metrics = CryptoPairMetric.__table__
+    metric_ids = DB.session.execute(
+        select(metrics.c.id).where(metrics.c.metric_type == metric_type)
+    ).scalars().all()
+
+    return _read_ring_buffers(metric_ids, starting_timestamp, ending_timestamp)
+
+
+def _epoch_microseconds(timestamp):
+    return (timestamp - _EPOCH) // timedelta(microseconds=1)
+
+
+def _bump_data_generation():
+    """ Increments the data generation in the current transaction, so it's bumped exactly when the
+    changes that go with it are committed. """
+
+    generations = DataGeneration.__table__
+    row_id = literal(_DATA_GENERATION_ID)
+
+    DB.session.execute(generations.insert().from_select(
+        ['id', 'generation'],
+        select(row_id, literal(0)).where(~exists().where(generations.c.id == row_id))
+    ))
+    DB.session.execute(
+        generations.update().
+        where(generations.c.id == row_id).
+        values(generation=generations.c.generation + 1)
+    )
+
+
+def get_data_generation():
+    """ Returns the current data generation, which changes whenever the poller commits changes to
+    metric data. """
+
+    # Go straight to the table rather than through the session's identity map, which could hand
+    # back a generation loaded earlier in the same session.
+    generation = DB.session.execute(_data_generation_statement()).scalar()
+
+    return generation if generation is not None else 0
+
+
+def _data_generation_statement():
+    generations = DataGeneration.__table__
+
+    return select(generations.c.generation).where(generations.c.id == _DATA_GENERATION_ID)
+
+
+def _update_rolling_stats(rows, timestamp):
+    """ Folds newly-inserted metric values (as passed to _insert_metric_values) into the rolling
+    statistics, then slides every metric's window forward to end at the specified timestamp by
+    subtracting the values which have fallen out of it. All of this happens in SQL, with no values
+    read back into Python. """
+
+    stats = MetricRollingStats.__table__
+    values = MetricInstanceValue.__table__
+
+    if rows:
+        params = [
+            {
+                'stats_metric_id': row['custom_metric_id'],
+                'stats_value': row['metric_value'],
+                'stats_timestamp': row['timestamp']
+            }
+            for row in rows
+        ]
+        metric_id = bindparam('stats_metric_id')
+        value = bindparam('stats_value', type_=values.c.metric_value.type)
+        value_timestamp = bindparam('stats_timestamp', type_=values.c.timestamp.type)
+
+        # Start tracking any metric which isn't tracked yet, from this value onwards. Its first
+        # value is as good a shift as any.
+        DB.session.execute(
+            stats.insert().from_select(_ROLLING_STATS_COLUMNS, select(
+                metric_id, value, literal(0), literal(0.0), literal(0.0), value_timestamp
+            ).where(~exists().where(stats.c.custom_metric_id == metric_id))),
+            params
+        )
+
+        # Add each value to its metric's sums, unless it's already older than the window.
+        offset = value - stats.c.shift
+        DB.session.execute(
+            stats.update().
+            where(stats.c.custom_metric_id == metric_id).
+            where(stats.c.evicted_through <= value_timestamp).
+            values(
+                count=stats.c.count + 1,
+                total=stats.c.total + offset,
+                total_sq=stats.c.total_sq + offset * offset
+            ),
+            params
+        )
+
+    # Subtract whatever has fallen out of the window since the last cycle.
+    cutoff = bindparam('cutoff', timestamp - ROLLING_STATS_WINDOW, type_=values.c.timestamp.type)
+
+    def evicted(aggregate):
+        return select(func.coalesce(aggregate, 0)).\
+            where(values.c.custom_metric_id == stats.c.custom_metric_id).\
+            where(values.c.timestamp >= stats.c.evicted_through).\
+            where(values.c.timestamp < cutoff).\
+            scalar_subquery()
+
+    offset = values.c.metric_value - stats.c.shift
+    DB.session.execute(
+        stats.update().
+        where(stats.c.evicted_through < cutoff).
+        values(
+            count=stats.c.count - evicted(func.count(values.c.id)),
+            total=stats.c.total - evicted(func.sum(offset)),
+            total_sq=stats.c.total_sq - evicted(func.sum(offset * offset)),
+            evicted_through=cutoff
+        )
+    )
+
+
+def _update_rollups(rows):
+    """ Folds newly-inserted metric values (as passed to _insert_metric_values) into the rollup
+    bucket they fall in, at every rollup resolution. """
+
+    if not rows:
+        return
+
+    rollups = MetricRollup.__table__
+    values = MetricInstanceValue.__table__
+
+    params = [
+        {
+            'rollup_metric_id': row['custom_metric_id'],
+            'rollup_resolution': resolution,
+            'rollup_bucket_start': floor_to_bucket(row['timestamp'], resolution),
+            'rollup_value': row['metric_value'],
+            'rollup_timestamp': row['timestamp']
+        }
+        for row in rows
+        for resolution in ROLLUP_RESOLUTIONS.values()
+    ]
+    metric_id = bindparam('rollup_metric_id')
+    resolution = bindparam('rollup_resolution')
+    bucket_start = bindparam('rollup_bucket_start', type_=rollups.c.bucket_start.type)
+    value = bindparam('rollup_value', type_=values.c.metric_value.type)
+    value_timestamp = bindparam('rollup_timestamp', type_=values.c.timestamp.type)
+
+    in_bucket = [
+        rollups.c.custom_metric_id == metric_id,
+        rollups.c.resolution == resolution,
+        rollups.c.bucket_start == bucket_start
+    ]
+
+    # Start any bucket which doesn't exist yet, empty but seeded from this value.
+    DB.session.execute(
+        rollups.insert().from_select(
+            [
+                'custom_metric_id', 'resolution', 'bucket_start', 'open', 'high', 'low', 'close',
+                'count', 'total', 'first_timestamp', 'last_timestamp'
+            ],
+            select(
+                metric_id, resolution, bucket_start, value, value, value, value,
+                literal(0), literal(0.0), value_timestamp, value_timestamp
+            ).where(~exists().where(*in_bucket))
+        ),
+        params
+    )
+
+    # Then add the value to its bucket.
+    DB.session.execute(
+        rollups.update().
+        where(*in_bucket).
+        values(
+            open=case((value_timestamp < rollups.c.first_timestamp, value), else_=rollups.c.open),
+            high=case((value > rollups.c.high, value), else_=rollups.c.high),
+            low=case((value < rollups.c.low, value), else_=rollups.c.low),
+            close=case((value_timestamp >= rollups.c.last_timestamp, value), else_=rollups.c.close),
+            count=rollups.c.count + 1,
+            total=rollups.c.total + value,
+            first_timestamp=case(
+                (value_timestamp < rollups.c.first_timestamp, value_timestamp),
+                else_=rollups.c.first_timestamp
+            ),
+            last_timestamp=case(
+                (value_timestamp > rollups.c.last_timestamp, value_timestamp),
+                else_=rollups.c.last_timestamp
+            )
+        ),
+        params
+    )
+
+
+def floor_to_bucket(timestamp, resolution):
+    """ Returns the start of the bucket of the specified resolution (in seconds) which the
+    timestamp falls in. Buckets are aligned to the epoch. """
+
+    return timestamp - (timestamp - _EPOCH) % timedelta(seconds=resolution)
+
+
+def rebuild_rolling_stats(timestamp):
+    """ Computes rolling statistics from scratch, for the window ending at the specified timestamp,
+    for every metric which has values in that window but isn't tracked yet (such as metrics which
+    were written before rolling statistics existed). Doesn't commit. """
+
+    stats = MetricRollingStats.__table__
+    values = MetricInstanceValue.__table__
+    cutoff = literal(timestamp - ROLLING_STATS_WINDOW, type_=values.c.timestamp.type)
+
+    # Use each metric's mean over the window as its shift.
+    means = select(
+        values.c.custom_metric_id,
+        func.avg(values.c.metric_value).label('shift')
+    ).\
+        where(values.c.timestamp >= cutoff).\
+        where(~exists().where(stats.c.custom_metric_id == values.c.custom_metric_id)).\
+        group_by(values.c.custom_metric_id).\
+        subquery()
+
+    offset = values.c.metric_value - means.c.shift
+    backfill = select(
+        means.c.custom_metric_id,
+        means.c.shift,
+        func.count(values.c.id),
+        func.sum(offset),
+        func.sum(offset * offset),
+        cutoff
+    ).\
+        select_from(values.join(means, values.c.custom_metric_id == means.c.custom_metric_id)).\
+        where(values.c.timestamp >= cutoff).\
+        group_by(means.c.custom_metric_id, means.c.shift)
+
+    DB.session.execute(stats.insert().from_select(_ROLLING_STATS_COLUMNS, backfill))
+
+
+def get_rolling_stats(metric_ids, timestamp):
+    """ Returns a map of CryptoPairMetric ID to its MetricRollingStats, for those of the specified
+    metrics whose statistics are current for the window ending at the specified timestamp. Metrics
+    which aren't tracked, or whose statistics are stale, are left out. """
+
+    freshest = timestamp - ROLLING_STATS_WINDOW - ROLLING_STATS_MAX_STALENESS
+
+    rolling_stats = MetricRollingStats.query.\
+        filter(MetricRollingStats.custom_metric_id.in_(metric_ids)).\
+        filter(MetricRollingStats.evicted_through >= freshest).\
+        all()
+
+    return {s.custom_metric_id: s for s in rolling_stats}
+
+
+def refresh_metric_rankings(timestamp):
+    """ Ranks every metric against the other metrics of the same metric type by its standard
+    deviation over the 24h window ending at the specified timestamp, and replaces the materialized
+    rankings with the result. Metrics without current rolling statistics, or with fewer than two
+    values in the window, can't be ranked and are left out. """
+
+    metrics = DB.session.query(CryptoPairMetric.id, CryptoPairMetric.metric_type).all()
+    rolling_stats = get_rolling_stats([metric_id for metric_id, _ in metrics], timestamp)
+
+    # Group the standard deviations of rankable metrics by metric type.
+    metric_std_devs = dict()
+    for metric_id, metric_type in metrics:
+        if metric_id in rolling_stats and rolling_stats[metric_id].count > 1:
+            std_dev = rolling_stats[metric_id].standard_deviation
+            metric_std_devs.setdefault(metric_type, list()).append((metric_id, std_dev))
+
+    # Sort each metric type by standard deviation in ascending order; a metric's 1-based position
+    # is its rank.
+    rankings = list()
+    for metric_type, std_devs in metric_std_devs.items():
+        std_devs.sort(key=lambda x: x[1])
+        for i, (metric_id, std_dev) in enumerate(std_devs):
+            rankings.append({
+                'custom_metric_id': metric_id,
+                'metric_type': metric_type,
+                'standard_deviation': std_dev,
+                'rank': i + 1,
+                'total': len(std_devs),
+                'computed_at': timestamp
+            })
+
+    DB.session.execute(MetricRanking.__table__.delete())
+    if rankings:
+        DB.session.execute(MetricRanking.__table__.insert(), rankings)
+    _bump_data_generation()
+    DB.session.commit()
+
+
+def get_metric_ranking(metric_id, timestamp):
+    """ Returns the materialized MetricRanking for the specified CryptoPairMetric, or None if it
+    hasn't been ranked or its ranking is too old to be trusted as of the specified timestamp. """
+
+    return _fresh_ranking(MetricRanking.query.get(metric_id), timestamp)
+
+
+def _fresh_ranking(ranking, timestamp):
+    """ Returns the MetricRanking if there is one and it's recent enough to be trusted as of the
+    specified timestamp, or None. """
+
+    if ranking is None or ranking.computed_at < timestamp - RANKINGS_MAX_STALENESS:
+        return None
+
+    return ranking
+
+
+def _get_or_create_crypto_pair_metric_ids(metric_keys):
+    """ Accepts a list of (ticker, metric_type) tuples and returns a map of each to the ID of its
+    CryptoPairMetric, creating (but not committing) those which don't exist yet. """
+
+    if not metric_keys:
+        return dict()
+
+    tickers = {ticker for ticker, _ in metric_keys}
+    existing = DB.session.query(
+        CryptoPairMetric.ticker,
+        CryptoPairMetric.metric_type,
+        CryptoPairMetric.id
+    ).filter(CryptoPairMetric.ticker.in_(tickers)).all()
+    existing_ids = {(ticker, metric_type): id for ticker, metric_type, id in existing}
+
+    metric_ids = dict()
+    new_metrics = dict()
+    for key in metric_keys:
+        if key in existing_ids:
+            metric_ids[key] = existing_ids[key]
+        else:
+            ticker, metric_type = key
+            new_metrics[key] = CryptoPairMetric(ticker=ticker, metric_type=metric_type)
+            DB.session.add(new_metrics[key])
+
+    # Flush rather than commit, so new metrics get their IDs but land in the same transaction as
+    # their values.
+    if new_metrics:
+        DB.session.flush()
+        metric_ids.update({key: metric.id for key, metric in new_metrics.items()})
+
+    return metric_ids
+
 
 def get_all_crypto_pair_metrics():
     """ Returns all CryptoPairMetrics. """
@@ -50,6 +604,49 @@ def get_crypto_pair_metric_by_id(metric_id):
     return CryptoPairMetric.query.get(metric_id)
 
 
+def get_latest_metric_timestamp(metric_type=None):
+    """ Returns the timestamp of the most recent data point saved for any CryptoPairMetric, or any
+    of the specified metric type, or None if there are none.
+
+    Takes the latest timestamp of each metric separately, so that every one is a single seek to the
+    end of that metric's range of the (custom_metric_id, timestamp) index rather than a scan. """
+
+    return DB.session.execute(_latest_metric_timestamp_statement(metric_type)).scalar()
+
+
+def _latest_metric_timestamp_statement(metric_type):
+    values = MetricInstanceValue.__table__
+    metrics = CryptoPairMetric.__table__
+
+    latest_per_metric = select(func.max(values.c.timestamp)).\
+        where(values.c.custom_metric_id == metrics.c.id).\
+        scalar_subquery()
+
+    query = select(func.max(latest_per_metric)).select_from(metrics)
+    if metric_type is not None:
+        query = query.where(metrics.c.metric_type == metric_type)
+
+    return query
+
+
+def _get_latest_metric_timestamps(metric_ids, ending_timestamp):
+    """ Returns a map of each of the specified CryptoPairMetric IDs to the timestamp of its most
+    recent data point up to the ending timestamp, or None if it has none. Like
+    get_latest_metric_timestamp, this is a seek per metric. """
+
+    values = MetricInstanceValue.__table__
+    metrics = CryptoPairMetric.__table__
+
+    latest_per_metric = select(func.max(values.c.timestamp)).\
+        where(values.c.custom_metric_id == metrics.c.id).\
+        where(values.c.timestamp <= ending_timestamp).\
+        scalar_subquery()
+
+    return dict(DB.session.execute(
+        select(metrics.c.id, latest_per_metric).where(metrics.c.id.in_(metric_ids))
+    ).all())
+
+
 def _get_or_create_crypto_pair_metric(ticker, metric_type):
     """ Retrieves a CryptoPairMetric if it exists, otherwise creates and returns it. """
 
@@ -71,10 +668,262 @@ def get_24h_metric_history(metric_id, ending_timestamp):
     """ Returns 24 hours' worth of data points (MetricInstanceValue) for the specified
     CryptoPairMetric ending at the specified timestamp. """
 
+    return DB.session.execute(
+        _24h_metric_history_statement(metric_id, ending_timestamp)
+    ).scalars().all()
+
+
+def _24h_metric_history_statement(metric_id, ending_timestamp):
     starting_timestamp = ending_timestamp - timedelta(days=1)
 
+    return select(MetricInstanceValue).\
+        where(MetricInstanceValue.custom_metric_id == metric_id).\
+        where(MetricInstanceValue.timestamp >= starting_timestamp).\
+        where(MetricInstanceValue.timestamp <= ending_timestamp)
+
+
+def stream_24h_metric_history(metric_id, ending_timestamp, batch_size):
+    """ Yields the same data points as get_24h_metric_history, as lists of up to batch_size
+    (timestamp, value) row tuples, without ever holding the whole history in memory.
+
+    Served from the metric's ring buffer when it covers the period, otherwise rows are read from a
+    streaming cursor as they're consumed, so the caller must finish with (or close) the generator
+    before the session is removed. """
+
+    starting_timestamp = ending_timestamp - timedelta(days=1)
+
+    windows = _read_ring_buffers([metric_id], starting_timestamp, ending_timestamp)
+    if windows is not None:
+        timestamps, values = windows[metric_id]
+        for start in range(0, len(timestamps), batch_size):
+            yield list(zip(
+                timestamps[start:start + batch_size].astype('datetime64[us]').tolist(),
+                values[start:start + batch_size].tolist()
+            ))
+        return
+
+    yield from _stream_24h_metric_history_rows(
+        metric_id, starting_timestamp, ending_timestamp, batch_size
+    )
+
+
+def stream_24h_metric_history_columns(metric_id, ending_timestamp, batch_size):
+    """ Yields the same data points as stream_24h_metric_history, as batches of up to batch_size
+    data points, each a tuple of an array of timestamps as epoch milliseconds (int64) and an array
+    of values (float64). """
+
+    starting_timestamp = ending_timestamp - timedelta(days=1)
+
+    windows = _read_ring_buffers([metric_id], starting_timestamp, ending_timestamp)
+    if windows is not None:
+        timestamps, values = windows[metric_id]
+        timestamps = timestamps // 1000
+        for start in range(0, len(timestamps), batch_size):
+            yield timestamps[start:start + batch_size], values[start:start + batch_size]
+        return
+
+    # Fetch timestamps as the database's ISO 8601 text, which NumPy parses far quicker than going
+    # through a datetime object per row.
+    for rows in _stream_24h_metric_history_rows(
+        metric_id, starting_timestamp, ending_timestamp, batch_size, timestamps_as_text=True
+    ):
+        timestamps, values = zip(*rows)
+        yield (
+            np.array(timestamps, dtype='datetime64[us]').astype('datetime64[ms]').astype(np.int64),
+            np.array(values, dtype=np.float64)
+        )
+
+
+def _stream_24h_metric_history_rows(metric_id, starting_timestamp, ending_timestamp, batch_size,
+                                    timestamps_as_text=False):
+    values = MetricInstanceValue.__table__
+
+    timestamp = values.c.timestamp
+    if timestamps_as_text:
+        # As naive UTC, like SQLite already stores them, rather than with an offset
+        if DB.engine.dialect.name == 'postgresql':
+            timestamp = func.timezone('UTC', timestamp)
+        timestamp = cast(timestamp, String)
+
+    statement = select(timestamp, values.c.metric_value).\
+        where(values.c.custom_metric_id == metric_id).\
+        where(values.c.timestamp >= starting_timestamp).\
+        where(values.c.timestamp <= ending_timestamp)
+
+    # Go through Core rather than the ORM, so rows arrive as plain tuples with no per-row entity
+    # bookkeeping.
+    result = DB.session.connection().execution_options(stream_results=True).execute(statement)
+    try:
+        yield from result.partitions(batch_size)
+    finally:
+        result.close()
+
+
+def stream_24h_metric_type_values(metric_type, ending_timestamp, batch_size):
+    """ Yields the values of the data points over the 24 hours ending at the specified timestamp of
+    every CryptoPairMetric of the specified metric type, as batches of up to batch_size data points,
+    each a tuple of an array of CryptoPairMetric IDs (int64) and an array of values (float64).
+
+    Served from the metrics' ring buffers when they all cover the period, otherwise read from a
+    streaming cursor like stream_24h_metric_history. """
+
+    values = MetricInstanceValue.__table__
+    metrics = CryptoPairMetric.__table__
+    starting_timestamp = ending_timestamp - timedelta(days=1)
+
+    windows = _read_metric_type_ring_buffers(metric_type, starting_timestamp, ending_timestamp)
+    if windows is not None:
+        for metric_id, (_, metric_values) in windows.items():
+            for start in range(0, len(metric_values), batch_size):
+                batch = metric_values[start:start + batch_size]
+                yield np.full(len(batch), metric_id, dtype=np.int64), batch
+        return
+
+    # As for the aggregates, look values up per metric through the (custom_metric_id, timestamp)
+    # index.
+    metric_ids = select(metrics.c.id).where(metrics.c.metric_type == metric_type)
+    statement = select(values.c.custom_metric_id, values.c.metric_value).\
+        where(values.c.custom_metric_id.in_(metric_ids)).\
+        where(values.c.timestamp >= starting_timestamp).\
+        where(values.c.timestamp <= ending_timestamp)
+
+    result = DB.session.connection().execution_options(stream_results=True).execute(statement)
+    try:
+        for rows in result.partitions(batch_size):
+            batch_ids, batch_values = zip(*rows)
+            yield np.array(batch_ids, dtype=np.int64), np.array(batch_values, dtype=np.float64)
+    finally:
+        result.close()
+
+
+def get_metric_history_since(metric_id, since, ending_timestamp):
+    """ Returns the data points (MetricInstanceValue) for the specified CryptoPairMetric after the
+    specified timestamp, up to and including the ending timestamp, in time order. Never reaches
+    back more than 24 hours before the ending timestamp, however old the starting one is.
+
+    This is a range read over the end of the metric's (custom_metric_id, timestamp) index, so it
+    costs as much as the number of points returned, not the length of the history. """
+
+    since = max(since, ending_timestamp - timedelta(days=1))
+
     return MetricInstanceValue.query.\
         filter(MetricInstanceValue.custom_metric_id == metric_id).\
-        filter(MetricInstanceValue.timestamp >= starting_timestamp).\
+        filter(MetricInstanceValue.timestamp > since).\
         filter(MetricInstanceValue.timestamp <= ending_timestamp).\
+        order_by(MetricInstanceValue.timestamp).\
+        all()
+
+
+def get_latest_metric_value_id():
+    """ Returns the ID of the most recently saved data point (MetricInstanceValue), or 0 if there
+    are none. A seek to the end of the primary key. """
+
+    return DB.session.execute(select(func.max(MetricInstanceValue.id))).scalar() or 0
+
+
+def get_metric_values_after(metric_ids, value_id):
+    """ Returns the data points (MetricInstanceValue) for any of the specified CryptoPairMetrics
+    saved after the data point with the specified ID, in the order they were saved. IDs rather than
+    timestamps give the order, since values aren't always saved in timestamp order, e.g. by several
+    poller shards, or by a poll cycle saved in more than one batch. A range read over the end of the
+    primary key. """
+
+    if not metric_ids:
+        return list()
+
+    return MetricInstanceValue.query.\
+        filter(MetricInstanceValue.id > value_id).\
+        filter(MetricInstanceValue.custom_metric_id.in_(metric_ids)).\
+        order_by(MetricInstanceValue.id).\
         all()
+
+
+def get_24h_metric_aggregates(metric_type, ending_timestamp):
+    """ Returns a map of CryptoPairMetric ID to a tuple of (count, mean, sum of squared deviations
+    from the mean) of its data points over the 24 hours ending at the specified timestamp, for
+    every CryptoPairMetric of the specified metric type which has data points in that period.
+
+    Computed from the metrics' ring buffers when they all cover the period, otherwise in a single
+    query which loads no data points. A standard deviation is the square root
+    of sum of squared deviations / (count - 1). Summing squared deviations from the mean, rather
+    than squares of the raw values, avoids losing the variance to floating point cancellation. """
+
+    starting_timestamp = ending_timestamp - timedelta(days=1)
+
+    windows = _read_metric_type_ring_buffers(metric_type, starting_timestamp, ending_timestamp)
+    if windows is not None:
+        aggregates = dict()
+        for metric_id, (_, values) in windows.items():
+            if len(values):
+                mean = values.mean()
+                deviations = values - mean
+                aggregates[metric_id] = (len(values), float(mean), float(deviations @ deviations))
+        return aggregates
+
+    return _metric_aggregates_by_id(
+        DB.session.execute(_24h_metric_aggregates_statement(metric_type, ending_timestamp))
+    )
+
+
+def _24h_metric_aggregates_statement(metric_type, ending_timestamp):
+    starting_timestamp = ending_timestamp - timedelta(days=1)
+
+    values = MetricInstanceValue.__table__
+    metrics = CryptoPairMetric.__table__
+    in_window = [values.c.timestamp >= starting_timestamp, values.c.timestamp <= ending_timestamp]
+
+    # Filter on an IN over the metric IDs rather than joining, so that the values are always looked
+    # up per metric through the (custom_metric_id, timestamp) index.
+    metric_ids = select(metrics.c.id).where(metrics.c.metric_type == metric_type)
+    means = select(
+        values.c.custom_metric_id,
+        func.count(values.c.id).label('count'),
+        func.avg(values.c.metric_value).label('mean')
+    ).\
+        where(values.c.custom_metric_id.in_(metric_ids)).\
+        where(*in_window).\
+        group_by(values.c.custom_metric_id).\
+        subquery()
+
+    deviation = values.c.metric_value - means.c.mean
+    aggregates = select(
+        means.c.custom_metric_id,
+        means.c.count,
+        means.c.mean,
+        func.sum(deviation * deviation)
+    ).\
+        select_from(values.join(means, values.c.custom_metric_id == means.c.custom_metric_id)).\
+        where(*in_window).\
+        group_by(means.c.custom_metric_id, means.c.count, means.c.mean).\
+        order_by(means.c.custom_metric_id)
+
+    return aggregates
+
+
+def _metric_aggregates_by_id(rows):
+    return {
+        metric_id: (count, mean, sum_sq_deviations)
+        for metric_id, count, mean, sum_sq_deviations in rows
+    }
+
+
+def get_24h_metric_rollups(metric_id, resolution, ending_timestamp):
+    """ Returns the MetricRollups at the specified resolution (in seconds) for the specified
+    CryptoPairMetric, covering the 24 hours ending at the specified timestamp, in time order. The
+    first bucket may start up to one resolution before the 24 hours do. """
+
+    return DB.session.execute(
+        _24h_metric_rollups_statement(metric_id, resolution, ending_timestamp)
+    ).scalars().all()
+
+
+def _24h_metric_rollups_statement(metric_id, resolution, ending_timestamp):
+    starting_timestamp = ending_timestamp - timedelta(days=1)
+    first_bucket_start = floor_to_bucket(starting_timestamp, resolution)
+
+    return select(MetricRollup).\
+        where(MetricRollup.custom_metric_id == metric_id).\
+        where(MetricRollup.resolution == resolution).\
+        where(MetricRollup.bucket_start >= first_bucket_start).\
+        where(MetricRollup.bucket_start <= ending_timestamp).\
+        order_by(MetricRollup.bucket_start)
@@ -1,11 +1,37 @@
 """ SQLAlchemy models for the database tables. """
 
-from sqlalchemy import Index
+from datetime import timezone
+from math import sqrt
+
+from sqlalchemy import DateTime, Index, func, select
 from sqlalchemy.orm import relationship
+from sqlalchemy.types import TypeDecorator
 
 from montecarlo import DB
 
 
+class UTCDateTime(TypeDecorator):
+    """ A timestamp with a timezone, which the app reads and writes as a naive UTC datetime (as from
+    datetime.utcnow) whatever the database. SQLite stores the naive datetime as it is; a database
+    server such as PostgreSQL stores the instant, and would otherwise hand back aware datetimes. """
+
+    impl = DateTime(timezone=True)
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return _naive_utc(value)
+
+    def process_result_value(self, value, dialect):
+        return _naive_utc(value)
+
+
+def _naive_utc(timestamp):
+    if timestamp is None or timestamp.tzinfo is None:
+        return timestamp
+
+    return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+
 class CryptoPairMetric(DB.Model):
     """ Represents a specific type of metric data being tracked for a given market and crypto/fiat
     pair (ticker). For example, volume of BTC/USD trades at Kraken, or price quotes for ETH/USD at
@@ -16,8 +42,8 @@ class CryptoPairMetric(DB.Model):
     ticker = DB.Column(DB.String)
     metric_type = DB.Column(DB.Enum('price', 'volume', name='metric_type'))
 
-    # Add a composite index on CryptoPairMetric ticker and type, this should be a unique combo
-    __tableargs__ = (Index('ticker_type_index', 'ticker', 'metric_type'), )
+    # Add a unique composite index on CryptoPairMetric ticker and type, there's one metric per combo
+    __table_args__ = (Index('ticker_type_index', 'ticker', 'metric_type', unique=True), )
 
     def to_json(self):
         return {
@@ -34,9 +60,14 @@ class MetricInstanceValue(DB.Model):
     id = DB.Column(DB.Integer, primary_key=True)
     metric_value = DB.Column(DB.Float)
     custom_metric_id = DB.Column(DB.Integer, DB.ForeignKey('cryptoMetrics.id'))
-    timestamp = DB.Column(DB.DateTime(timezone=True))
+    timestamp = DB.Column(UTCDateTime)
     crypto_pair_metric = relationship('CryptoPairMetric', backref='values')
 
+    # Values are almost always read as a time range for a single metric
+    __table_args__ = (
+        Index('metric_timestamp_index', 'custom_metric_id', 'timestamp'),
+    )
+
     def to_json(self):
         return {
             'value': self.metric_value,
@@ -44,8 +75,156 @@ class MetricInstanceValue(DB.Model):
         }
 
 
+class MetricRollingStats(DB.Model):
+    """ Running statistics for a CryptoPairMetric over a sliding window of its values, maintained
+    incrementally as values are written so that the mean and standard deviation can be read without
+    touching the values themselves.
+
+    The window covers every value with a timestamp at or after `evicted_through`. Sums are kept
+    relative to a fixed `shift` (a representative value of the metric), which keeps the sum of
+    squares small enough that the variance doesn't get lost to floating point cancellation. """
+
+    __tablename__ = 'metricRollingStats'
+    custom_metric_id = DB.Column(
+        DB.Integer,
+        DB.ForeignKey('cryptoMetrics.id', ondelete='CASCADE'),
+        primary_key=True
+    )
+    shift = DB.Column(DB.Float, nullable=False)
+    count = DB.Column(DB.Integer, nullable=False)
+    total = DB.Column(DB.Float, nullable=False)
+    total_sq = DB.Column(DB.Float, nullable=False)
+    evicted_through = DB.Column(UTCDateTime, nullable=False)
+
+    @property
+    def mean(self):
+        """ Mean of the values in the window, or None if the window is empty. """
+
+        if self.count < 1:
+            return None
+        return self.shift + self.total / self.count
+
+    @property
+    def standard_deviation(self):
+        """ Sample standard deviation of the values in the window, or None if there are fewer than
+        two values in it. """
+
+        if self.count < 2:
+            return None
+
+        # Clamp at zero, since rounding can leave a tiny negative variance for a flat metric.
+        variance = (self.total_sq - self.total * self.total / self.count) / (self.count - 1)
+        return sqrt(max(variance, 0.0))
+
+
+class MetricRanking(DB.Model):
+    """ A CryptoPairMetric's standard deviation over the last 24h and its rank against the other
+    metrics of the same metric type, as of the last time the poller computed rankings. """
+
+    __tablename__ = 'metricRankings'
+    custom_metric_id = DB.Column(
+        DB.Integer,
+        DB.ForeignKey('cryptoMetrics.id', ondelete='CASCADE'),
+        primary_key=True
+    )
+    metric_type = DB.Column(DB.Enum('price', 'volume', name='metric_type'), nullable=False)
+    standard_deviation = DB.Column(DB.Float, nullable=False)
+    rank = DB.Column(DB.Integer, nullable=False)
+    total = DB.Column(DB.Integer, nullable=False)
+    computed_at = DB.Column(UTCDateTime, nullable=False)
+
+
+class MetricRollup(DB.Model):
+    """ A summary of a CryptoPairMetric's values within one fixed-size time bucket, at one of
+    several resolutions (bucket sizes, in seconds). Lets history be served at a bounded number of
+    points no matter how often the metric is sampled. """
+
+    __tablename__ = 'metricRollups'
+    custom_metric_id = DB.Column(
+        DB.Integer,
+        DB.ForeignKey('cryptoMetrics.id', ondelete='CASCADE'),
+        primary_key=True
+    )
+    resolution = DB.Column(DB.Integer, primary_key=True)
+    bucket_start = DB.Column(UTCDateTime, primary_key=True)
+    open = DB.Column(DB.Float, nullable=False)
+    high = DB.Column(DB.Float, nullable=False)
+    low = DB.Column(DB.Float, nullable=False)
+    close = DB.Column(DB.Float, nullable=False)
+    count = DB.Column(DB.Integer, nullable=False)
+    total = DB.Column(DB.Float, nullable=False)
+
+    # Timestamps of the values currently used as open and close, so that values arriving out of
+    # order still land in the right place.
+    first_timestamp = DB.Column(UTCDateTime, nullable=False)
+    last_timestamp = DB.Column(UTCDateTime, nullable=False)
+
+    def to_json(self):
+        return {
+            'timestamp': str(self.bucket_start),
+            'value': self.total / self.count if self.count else None,
+            'open': self.open,
+            'high': self.high,
+            'low': self.low,
+            'close': self.close,
+            'count': self.count
+        }
+
+
+class DataGeneration(DB.Model):
+    """ A single-row counter which is bumped every time the poller changes metric data, so readers
+    (like the API's response cache) can tell whether anything has changed since they last looked
+    without re-running their queries. """
+
+    __tablename__ = 'dataGeneration'
+    id = DB.Column(DB.Integer, primary_key=True)
+    generation = DB.Column(DB.Integer, nullable=False)
+
+
+def upgrade_schema():
+    """ Brings a database created by an earlier version of this app up to date. DB.create_all only
+    creates missing tables, so indexes added to tables which already exist are created here. """
+
+    _merge_duplicate_crypto_pair_metrics()
+
+    for table in DB.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=DB.engine, checkfirst=True)
+
+
+def _merge_duplicate_crypto_pair_metrics():
+    """ Earlier versions never actually created the ticker/metric type index, so a database may
+    have several CryptoPairMetrics for the same ticker and metric type, which would stop the now
+    unique index from being created. Keep the oldest of each, move the other duplicates' values
+    over to it, and delete them (along with anything derived from them). """
+
+    metrics = CryptoPairMetric.__table__
+    values = MetricInstanceValue.__table__
+
+    with DB.engine.begin() as connection:
+        duplicates = connection.execute(
+            select(metrics.c.ticker, metrics.c.metric_type, func.min(metrics.c.id)).
+            group_by(metrics.c.ticker, metrics.c.metric_type).
+            having(func.count(metrics.c.id) > 1)
+        ).all()
+
+        for ticker, metric_type, keep_id in duplicates:
+            duplicate_ids = select(metrics.c.id).\
+                where(metrics.c.ticker == ticker).\
+                where(metrics.c.metric_type == metric_type).\
+                where(metrics.c.id != keep_id)
+
+            connection.execute(
+                values.update().
+                where(values.c.custom_metric_id.in_(duplicate_ids)).
+                values(custom_metric_id=keep_id)
+            )
+            connection.execute(metrics.delete().where(metrics.c.id.in_(duplicate_ids)))
+
+
 # This ensures the local SQLite database and underlying tables are created.
 # In a production system, this wouldn't be the responsibility of the web app itself, but rather
 # part of the infrastructure creation/deployment process, but for the sake of simplicity in a
 # take-home assignment I think this is fine.
 DB.create_all()
+upgrade_schema()
@@ -0,0 +1,226 @@
+""" Retention and compaction of raw metric values, so the database doesn't grow without bound. """
+
+from datetime import timedelta
+from logging import getLogger, INFO
+from time import perf_counter
+
+from sqlalchemy import func, literal, select
+
+from montecarlo import DB
+from montecarlo.persistence.metrics_manager import (
+    floor_to_bucket,
+    METRIC_PRICE,
+    METRIC_VOLUME,
+    ROLLING_STATS_WINDOW,
+    ROLLUP_RESOLUTIONS
+)
+from montecarlo.persistence.models import CryptoPairMetric, MetricInstanceValue, MetricRollup
+
+_log = getLogger(__name__)
+_log.setLevel(INFO)
+
+# Raw values are compacted into hourly rollups, which are kept indefinitely.
+_COMPACTED_RESOLUTION = ROLLUP_RESOLUTIONS['1h']
+
+# Rolling statistics subtract values as they leave the 24h window, so raw values must outlive that
+# window by a comfortable margin, whatever the configured retention.
+MIN_RETENTION = ROLLING_STATS_WINDOW + timedelta(days=1)
+
+# PRAGMA auto_vacuum value for incremental mode
+_SQLITE_INCREMENTAL_VACUUM = 2
+
+
+class RetentionReport:
+    """ A summary of the work done by a single retention run. """
+
+    def __init__(self):
+        self.values_deleted = 0
+        self.rollups_created = 0
+        self.rollups_deleted = 0
+        self.pages_reclaimed = 0
+        self.elapsed_seconds = 0.0
+
+    def __str__(self):
+        return ('deleted {self.values_deleted} values and {self.rollups_deleted} rollups, created '
+                '{self.rollups_created} hourly rollups, reclaimed {self.pages_reclaimed} pages in '
+                '{self.elapsed_seconds:.2f}s').format(self=self)
+
+
+def run_retention(timestamp, retention_config):
+    """ Entry point for the periodic retention job. For each metric type, compacts raw metric
+    values older than its retention window (as of the specified timestamp) into hourly rollups and
+    deletes them, along with any finer-grained rollups that old. Then reclaims some of the freed
+    space. Returns a RetentionReport. """
+
+    start = perf_counter()
+    report = RetentionReport()
+
+    for metric_type in [METRIC_PRICE, METRIC_VOLUME]:
+        retention = timedelta(days=retention_config.days_for(metric_type))
+        if retention < MIN_RETENTION:
+            msg = 'Retention for {metric_type} is below the minimum, using {minimum}.'.format(
+                metric_type=metric_type,
+                minimum=MIN_RETENTION
+            )
+            _log.warning(msg)
+            retention = MIN_RETENTION
+
+        # Only ever expire whole hours, so an hourly rollup is never built from part of its bucket.
+        cutoff = floor_to_bucket(timestamp - retention, _COMPACTED_RESOLUTION)
+
+        _expire_values(metric_type, cutoff, retention_config.batch_size, report)
+        _expire_rollups(metric_type, cutoff, report)
+
+    report.pages_reclaimed = _incremental_vacuum(retention_config.vacuum_pages)
+    report.elapsed_seconds = perf_counter() - start
+
+    _log.info('Retention run {report}.'.format(report=report))
+
+    return report
+
+
+def _expire_values(metric_type, cutoff, batch_size, report):
+    """ Works through the raw values of the specified metric type older than the cutoff one hour
+    at a time, oldest first, compacting each hour into rollups and then deleting it. """
+
+    values = MetricInstanceValue.__table__
+    metric_ids = select(CryptoPairMetric.id).where(CryptoPairMetric.metric_type == metric_type)
+
+    while True:
+        oldest = DB.session.execute(
+            select(func.min(values.c.timestamp)).
+            where(values.c.custom_metric_id.in_(metric_ids)).
+            where(values.c.timestamp < cutoff)
+        ).scalar()
+
+        if oldest is None:
+            return
+
+        hour_start = floor_to_bucket(oldest, _COMPACTED_RESOLUTION)
+        hour_end = hour_start + timedelta(seconds=_COMPACTED_RESOLUTION)
+
+        report.rollups_created += _compact_hour(metric_ids, hour_start, hour_end)
+        DB.session.commit()
+
+        report.values_deleted += _delete_values(metric_ids, hour_end, batch_size)
+
+
+def _compact_hour(metric_ids, hour_start, hour_end):
+    """ Creates the hourly rollup for every metric with values in the specified hour which doesn't
+    have one yet. Rollups are normally maintained as values are written, so this only fills in
+    hours written before rollups existed. Returns the number of rollups created. """
+
+    values = MetricInstanceValue.__table__
+    rollups = MetricRollup.__table__
+
+    in_hour = [
+        values.c.custom_metric_id.in_(metric_ids),
+        values.c.timestamp >= hour_start,
+        values.c.timestamp < hour_end
+    ]
+
+    hour_values = values.alias('hour_values')
+
+    def value_at(order_by):
+        return select(hour_values.c.metric_value).\
+            where(hour_values.c.custom_metric_id == values.c.custom_metric_id).\
+            where(hour_values.c.timestamp >= hour_start).\
+            where(hour_values.c.timestamp < hour_end).\
+            order_by(order_by).\
+            limit(1).\
+            scalar_subquery()
+
+    already_rolled_up = select(rollups.c.custom_metric_id).\
+        where(rollups.c.resolution == _COMPACTED_RESOLUTION).\
+        where(rollups.c.bucket_start == hour_start)
+
+    compacted = select(
+        values.c.custom_metric_id,
+        literal(_COMPACTED_RESOLUTION),
+        literal(hour_start, type_=rollups.c.bucket_start.type),
+        value_at(hour_values.c.timestamp),
+        func.max(values.c.metric_value),
+        func.min(values.c.metric_value),
+        value_at(hour_values.c.timestamp.desc()),
+        func.count(values.c.id),
+        func.sum(values.c.metric_value),
+        func.min(values.c.timestamp),
+        func.max(values.c.timestamp)
+    ).\
+        where(*in_hour).\
+        where(values.c.custom_metric_id.not_in(already_rolled_up)).\
+        group_by(values.c.custom_metric_id)
+
+    result = DB.session.execute(rollups.insert().from_select([
+        'custom_metric_id', 'resolution', 'bucket_start', 'open', 'high', 'low', 'close', 'count',
+        'total', 'first_timestamp', 'last_timestamp'
+    ], compacted))
+
+    return result.rowcount
+
+
+def _delete_values(metric_ids, before, batch_size):
+    """ Deletes the raw values of the specified metrics older than the specified timestamp, at most
+    batch_size at a time with a commit after each batch, so that no single transaction holds the
+    database for long. Returns the number of values deleted. """
+
+    values = MetricInstanceValue.__table__
+    deleted = 0
+
+    while True:
+        batch = select(values.c.id).\
+            where(values.c.custom_metric_id.in_(metric_ids)).\
+            where(values.c.timestamp < before).\
+            limit(batch_size)
+
+        result = DB.session.execute(values.delete().where(values.c.id.in_(batch)))
+        DB.session.commit()
+
+        deleted += result.rowcount
+        if result.rowcount < batch_size:
+            return deleted
+
+
+def _expire_rollups(metric_type, cutoff, report):
+    """ Deletes rollups finer than hourly, for metrics of the specified type, which are older than
+    the cutoff. They only exist to serve recent history at a bounded size. """
+
+    rollups = MetricRollup.__table__
+    metric_ids = select(CryptoPairMetric.id).where(CryptoPairMetric.metric_type == metric_type)
+
+    result = DB.session.execute(
+        rollups.delete().
+        where(rollups.c.custom_metric_id.in_(metric_ids)).
+        where(rollups.c.resolution < _COMPACTED_RESOLUTION).
+        where(rollups.c.bucket_start < cutoff)
+    )
+    DB.session.commit()
+
+    report.rollups_deleted += result.rowcount
+
+
+def _incremental_vacuum(max_pages):
+    """ Returns up to max_pages free database pages to the filesystem, if the database supports
+    incremental vacuuming. Returns the number of pages reclaimed. """
+
+    if DB.engine.dialect.name != 'sqlite':
+        return 0
+
+    connection = DB.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+
+        if cursor.execute('PRAGMA auto_vacuum').fetchone()[0] != _SQLITE_INCREMENTAL_VACUUM:
+            _log.warning('Database is not in incremental auto-vacuum mode, skipping vacuum.')
+            return 0
+
+        free_pages = cursor.execute('PRAGMA freelist_count').fetchone()[0]
+
+        # The sqlite3 module only steps a statement which returns no rows once, which would free a
+        # single page. executescript runs it to completion.
+        cursor.executescript('PRAGMA incremental_vacuum({:d});'.format(max_pages))
+
+        return free_pages - cursor.execute('PRAGMA freelist_count').fetchone()[0]
+
+    finally:
+        connection.close()
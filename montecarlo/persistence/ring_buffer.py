@@ -0,0 +1,229 @@
+""" Memory-mapped ring buffers of recent metric values.
+
+Each CryptoPairMetric gets a file holding a fixed number of its most recent (timestamp, value)
+pairs, as a column of int64 epoch microseconds and a column of float64 values, in insertion order.
+The poller appends to them as it saves each cycle, and web workers map the same files read-only,
+so reading a metric's 24-hour history or its statistics is a slice of two arrays rather than a
+database query and a row (or ORM object) per data point. The database remains the durable store;
+a ring buffer can always be rebuilt from it, and readers fall back to it whenever a ring buffer
+doesn't cover the window they're after.
+
+File layout, all little-endian int64 slots:
+
+    0: magic            identifies the format, and is zeroed when a file is replaced
+    1: capacity         number of (timestamp, value) slots
+    2: head             number of values published to readers, ever
+    3: write_head       number of values claimed by the writer, ever
+    4: covered_since    no value at or after this timestamp is missing from the buffer, as long as
+                        it hasn't wrapped past first
+    5: first            logical index of the oldest value written since the buffer was last rebuilt
+    6-7: reserved
+    8...: capacity timestamps, then capacity values
+
+Value number n lives in slot n % capacity. There's a single writer per file, which claims slots by
+moving write_head on before overwriting them, and publishes them by moving head on afterwards.
+Readers copy out what they need and then check write_head to make sure none of it was
+overwritten while they did (a seqlock), so they never need a lock or to block the writer. """
+
+import os
+
+import numpy as np
+
+_MAGIC = int.from_bytes(b'MCRING01', 'little')
+_HEADER_SLOTS = 8
+_CAPACITY, _HEAD, _WRITE_HEAD, _COVERED_SINCE, _FIRST = 1, 2, 3, 4, 5
+
+# Covers every timestamp
+COVERS_ALL = np.iinfo(np.int64).min
+
+_FILE_TEMPLATE = '{metric_id}.ring'
+
+# Times to retry a read which raced the writer before giving up on the ring buffer
+_READ_ATTEMPTS = 3
+
+
+class MetricRingBuffer:
+    """ A single metric's memory-mapped ring buffer. Open an existing one for reading, or create
+    (or replace) one for writing with MetricRingBuffer.create. """
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        self.writable = writable
+        self._map = np.memmap(path, dtype='<i8', mode='r+' if writable else 'r')
+        if self._map[0] != _MAGIC:
+            raise ValueError('Not a metric ring buffer: {}'.format(path))
+
+        capacity = int(self._map[_CAPACITY])
+        self.capacity = capacity
+        self._timestamps = self._map[_HEADER_SLOTS:_HEADER_SLOTS + capacity]
+        self._values = self._map[_HEADER_SLOTS + capacity:].view('<f8')
+
+    @classmethod
+    def create(cls, path, capacity):
+        """ Creates an empty ring buffer at the path, covering all timestamps, and opens it for
+        writing. Any existing file is retired, so its readers notice and reopen the new one. """
+
+        temporary_path = path + '.new'
+        initial = np.memmap(
+            temporary_path, dtype='<i8', mode='w+', shape=(_HEADER_SLOTS + 2 * capacity,)
+        )
+        initial[_CAPACITY] = capacity
+        initial[_COVERED_SINCE] = COVERS_ALL
+        initial[0] = _MAGIC
+        initial.flush()
+        del initial
+
+        if os.path.exists(path):
+            retired = np.memmap(path, dtype='<i8', mode='r+', shape=(1,))
+            retired[0] = 0
+            del retired
+        os.replace(temporary_path, path)
+
+        return cls(path, writable=True)
+
+    @property
+    def retired(self):
+        """ Whether this file has been replaced by a new one. """
+
+        return self._map[0] != _MAGIC
+
+    @property
+    def last_timestamp(self):
+        """ The timestamp of the latest value, or None if there isn't one. """
+
+        head = int(self._map[_HEAD])
+        if head == int(self._map[_FIRST]):
+            return None
+
+        return int(self._timestamps[(head - 1) % self.capacity])
+
+    def append(self, timestamps, values):
+        """ Appends values, with their timestamps as epoch microseconds. Timestamps must be later
+        than last_timestamp, and in order. Only one process may write to a ring buffer. """
+
+        timestamps = np.asarray(timestamps, dtype=np.int64)[-self.capacity:]
+        values = np.asarray(values, dtype=np.float64)[-self.capacity:]
+
+        head = int(self._map[_HEAD])
+        self._write(head, timestamps, values)
+        self._map[_HEAD] = head + len(timestamps)
+
+    def rebuild(self, timestamps, values, covered_since):
+        """ Replaces the contents with values, as for append, of which none at or after
+        covered_since may be missing. """
+
+        timestamps = np.asarray(timestamps, dtype=np.int64)[-self.capacity:]
+        values = np.asarray(values, dtype=np.float64)[-self.capacity:]
+
+        # Skip a whole lap, so that anything a reader copies while this happens is discarded.
+        first = int(self._map[_HEAD]) + self.capacity
+        self._write(first, timestamps, values)
+        self._map[_COVERED_SINCE] = covered_since
+        self._map[_FIRST] = first
+        self._map[_HEAD] = first + len(timestamps)
+
+    def _write(self, start, timestamps, values):
+        self._map[_WRITE_HEAD] = start + len(timestamps)
+        slots = (start + np.arange(len(timestamps))) % self.capacity
+        self._timestamps[slots] = timestamps
+        self._values[slots] = values
+
+    def read(self, starting_timestamp, ending_timestamp):
+        """ Returns a copy of the values with timestamps between the specified epoch microseconds,
+        inclusive, as a tuple of arrays of timestamps and values. Returns None if some of the values
+        in that range might not be in the buffer, or if the writer kept overwriting them. """
+
+        for _ in range(_READ_ATTEMPTS):
+            head = int(self._map[_HEAD])
+            first = int(self._map[_FIRST])
+            covered_since = int(self._map[_COVERED_SINCE])
+            if first > head:
+                # Caught the writer mid-rebuild
+                continue
+
+            oldest = max(first, head - self.capacity)
+            timestamps = self._logical_slice(self._timestamps, oldest, head)
+            values = self._logical_slice(self._values, oldest, head)
+
+            # Once the buffer has wrapped, values older than the oldest one left have been lost.
+            if oldest > first:
+                covered_since = max(covered_since, int(timestamps[0]))
+
+            # Make sure nothing copied was overwritten in the meantime.
+            if oldest < int(self._map[_WRITE_HEAD]) - self.capacity:
+                continue
+
+            if starting_timestamp < covered_since:
+                return None
+
+            start = np.searchsorted(timestamps, starting_timestamp, side='left')
+            end = np.searchsorted(timestamps, ending_timestamp, side='right')
+            return timestamps[start:end], values[start:end]
+
+        return None
+
+    def _logical_slice(self, column, start, end):
+        """ Copies the values numbered from start up to end out of the column, in order. """
+
+        if start == end:
+            return column[0:0].copy()
+
+        start_slot, end_slot = start % self.capacity, end % self.capacity
+        if start_slot < end_slot:
+            return column[start_slot:end_slot].copy()
+
+        return np.concatenate([column[start_slot:], column[:end_slot]])
+
+
+class RingBufferStore:
+    """ The ring buffers of every metric, as files in a directory. Opened buffers are kept open.
+    Writers create missing buffers with the configured capacity; readers only ever open existing
+    ones. """
+
+    def __init__(self, directory, capacity):
+        self.directory = directory
+        self.capacity = capacity
+        self._buffers = dict()
+
+        os.makedirs(directory, exist_ok=True)
+
+    def open(self, metric_id):
+        """ Returns the metric's ring buffer for reading, or None if there isn't one. """
+
+        ring_buffer = self._buffers.get(metric_id)
+        if ring_buffer is None or ring_buffer.retired:
+            try:
+                ring_buffer = MetricRingBuffer(self._path(metric_id))
+            except (FileNotFoundError, ValueError):
+                return None
+            self._buffers[metric_id] = ring_buffer
+
+        return ring_buffer
+
+    def open_for_writing(self, metric_id):
+        """ Returns a tuple of the metric's ring buffer, opened for writing, and whether this is the
+        first time it's been opened for writing since it was last closed. A missing buffer, or one
+        of a different capacity, is replaced with a new one. """
+
+        ring_buffer = self._buffers.get(metric_id)
+        if ring_buffer is not None and ring_buffer.writable and not ring_buffer.retired:
+            return ring_buffer, False
+
+        path = self._path(metric_id)
+        try:
+            ring_buffer = MetricRingBuffer(path, writable=True)
+            if ring_buffer.capacity != self.capacity:
+                ring_buffer = MetricRingBuffer.create(path, self.capacity)
+        except (FileNotFoundError, ValueError):
+            ring_buffer = MetricRingBuffer.create(path, self.capacity)
+
+        self._buffers[metric_id] = ring_buffer
+        return ring_buffer, True
+
+    def close(self, metric_id):
+        """ Forgets the metric's ring buffer, if open, so that it's opened afresh next time. """
+
+        self._buffers.pop(metric_id, None)
+
+    def _path(self, metric_id):
+        return os.path.join(self.directory, _FILE_TEMPLATE.format(metric_id=metric_id))
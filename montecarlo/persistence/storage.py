@@ -0,0 +1,144 @@
+""" Storage backends: the databases the app's metrics can be kept in, and how each is tuned.
+
+The storage interface itself is metrics_manager's - bulk_save_metrics saves a batch of values,
+get_all_crypto_pair_metrics lists the metrics, get_24h_metric_history and the stream_ functions
+query a range of values, and get_24h_metric_aggregates aggregates them - written once, in
+SQLAlchemy, against whichever database is configured. What differs between databases is how their
+engine and connections are set up, which is what a backend provides:
+
+* sqlite - a single database file, in WAL mode so that API readers don't block the poller's writes
+  (or the other way round), with pragmas tuned for a write-once, read-many workload, and a pool of
+  reused connections rather than a new one per checkout.
+* server - a database server such as PostgreSQL, through a bounded pool of connections which are
+  checked before use and recycled before the server (or anything in between) drops them.
+
+The backend is picked by METRICS_STORAGE_BACKEND, or from the scheme of the database URI when that
+isn't set. """
+
+from abc import ABC, abstractmethod
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+SQLITE_BACKEND = 'sqlite'
+SERVER_BACKEND = 'server'
+
+
+class StorageBackend(ABC):
+    """ Base class for storage backends. Given the app config, provides the options to create the
+    database engine with, and configures each new database connection. """
+
+    def __init__(self, config):
+        self.config = config
+
+    @abstractmethod
+    def engine_options(self, url):
+        """ Returns the keyword arguments to create an engine for the URL with. """
+
+    def configure_connection(self, dbapi_connection, connection_record):
+        """ Configures a newly opened DBAPI connection, before it's first used. """
+
+        pass
+
+
+class SQLiteStorage(StorageBackend):
+    """ A SQLite database file, shared by the poller and the web workers. """
+
+    def engine_options(self, url):
+        # An in-memory database (as in tests) is a single shared connection, which Flask-SQLAlchemy
+        # already sets up.
+        if url.database in (None, '', ':memory:'):
+            return dict()
+
+        # Pooled connections are handed between threads, one at a time.
+        return {
+            'poolclass': QueuePool,
+            'pool_size': self.config['METRICS_DB_POOL_SIZE'],
+            'max_overflow': self.config['METRICS_DB_MAX_OVERFLOW'],
+            'connect_args': {'check_same_thread': False}
+        }
+
+    def configure_connection(self, dbapi_connection, connection_record):
+        """ SQLite doesn't enforce foreign keys unless asked to, per connection. We rely on them so
+        that values saved against a stale CryptoPairMetric ID are rejected rather than orphaned.
+
+        Also ask for incremental auto-vacuum, so the retention job can hand pages freed by deleting
+        old metric values back to the filesystem a little at a time. This only takes effect for a
+        database which has no tables yet; an existing database keeps whatever auto-vacuum mode it
+        was created with until it's rebuilt with a full VACUUM.
+
+        WAL mode lets readers carry on from a snapshot while a write is in progress, and only needs
+        the log synced at checkpoints (synchronous=NORMAL), which can lose the last commits on power
+        loss but never corrupts the database. Busy connections wait for the write lock rather than
+        failing straight away, and each keeps a larger page cache and memory-maps the file. An
+        in-memory database ignores the journal mode. """
+
+        config = self.config
+
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout={:d}'.format(config['METRICS_SQLITE_BUSY_TIMEOUT_MS']))
+        cursor.execute('PRAGMA cache_size=-{:d}'.format(config['METRICS_SQLITE_CACHE_KB']))
+        cursor.execute('PRAGMA mmap_size={:d}'.format(config['METRICS_SQLITE_MMAP_BYTES']))
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.close()
+
+
+class ServerStorage(StorageBackend):
+    """ A database server, such as PostgreSQL, which every process connects to. """
+
+    def engine_options(self, url):
+        options = {
+            'pool_size': self.config['METRICS_DB_POOL_SIZE'],
+            'max_overflow': self.config['METRICS_DB_MAX_OVERFLOW'],
+            'pool_timeout': self.config['METRICS_DB_POOL_TIMEOUT_SECONDS'],
+            'pool_recycle': self.config['METRICS_DB_POOL_RECYCLE_SECONDS'],
+            'pool_pre_ping': True
+        }
+
+        # Timestamps are naive UTC throughout the app, so have the server read and write them as
+        # UTC whatever its own timezone is.
+        if url.get_backend_name() == 'postgresql':
+            options['connect_args'] = {'options': '-c timezone=UTC'}
+
+        return options
+
+
+_BACKENDS = {
+    SQLITE_BACKEND: SQLiteStorage,
+    SERVER_BACKEND: ServerStorage
+}
+
+
+def get_storage_backend(config, url):
+    """ Returns the storage backend configured for the database URL. """
+
+    name = config.get('METRICS_STORAGE_BACKEND')
+    if name is None:
+        name = SQLITE_BACKEND if url.get_backend_name() == 'sqlite' else SERVER_BACKEND
+
+    if name not in _BACKENDS:
+        raise ValueError('Unknown storage backend: {}'.format(name))
+
+    return _BACKENDS[name](config)
+
+
+class StorageSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy, creating each engine with the options of its URL's storage backend and
+    having the backend configure the engine's connections. An engine is created for every database
+    URI the app is configured with over its lifetime, so switching the URI (as the storage tests do)
+    switches the backend with it. """
+
+    def create_engine(self, sa_url, engine_opts):
+        sa_url = make_url(sa_url)
+        storage = get_storage_backend(self.get_app().config, sa_url)
+
+        engine = super().create_engine(sa_url, dict(engine_opts, **storage.engine_options(sa_url)))
+        event.listen(engine, 'connect', storage.configure_connection)
+
+        return engine
@@ -1,22 +1,32 @@
-""" A basic period process which calls montecarlo.metrics.crypto.poll_crypto_metrics on a 1-minute
-interval to get the latest and greatest cryptocurrency metrics. """
+""" A basic period process which polls the latest and greatest cryptocurrency metrics, and runs the
+retention job hourly to keep the database from growing without bound (see
+montecarlo.metrics.poller).
+
+Run with --shards N to spread the tickers over N worker processes under a supervisor instead (see
+montecarlo.metrics.sharding). """
 
 import logging
+from argparse import ArgumentParser
 from sys import stdout
 
-from apscheduler.schedulers.blocking import BlockingScheduler
-from montecarlo.metrics.crypto import poll_crypto_metrics
+from montecarlo.metrics.poller import run_poller
+from montecarlo.metrics.sharding import PollerSupervisor
 
 log_format = '%(levelname)s %(asctime)s [%(filename)s %(funcName)s] - %(message)s'
 logging.basicConfig(stream=stdout, format=log_format)
 
+
 if __name__ == '__main__':
-    scheduler = BlockingScheduler()
-    scheduler.add_job(poll_crypto_metrics, 'interval', seconds=60)
+    parser = ArgumentParser(description='Polls crypto metrics into the database.')
+    parser.add_argument(
+        '--shards', type=int, default=1,
+        help='number of worker processes to spread the tickers over (default 1, no workers)'
+    )
+    args = parser.parse_args()
 
     print('Press Ctrl-C to exit.')
 
-    try:
-        scheduler.start()
-    except (KeyboardInterrupt, SystemExit):
-        pass
+    if args.shards > 1:
+        PollerSupervisor(args.shards).run()
+    else:
+        run_poller()
@@ -5,20 +5,37 @@
 import os
 os.environ['MONTECARLO_TEST_ENV'] = 'true'
 
+import json
+
+from base64 import urlsafe_b64encode
 from datetime import datetime, timedelta
 from statistics import stdev
 from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import event
 
 from montecarlo import DB, app
-from montecarlo.persistence.models import CryptoPairMetric, MetricInstanceValue
+from montecarlo.api.cache import LocalCacheBackend, RESPONSE_CACHE
+from montecarlo.api.columnar import COLUMNAR_JSON_MIMETYPE, PACKED_MIMETYPE, read_packed
+from montecarlo.api.routes import _rank_metric_against_similar
+from montecarlo.persistence.metrics_manager import (
+    bulk_save_metrics,
+    clear_crypto_pair_metric_cache,
+    refresh_metric_rankings
+)
+from montecarlo.persistence.models import CryptoPairMetric, MetricInstanceValue, MetricRanking
 
 
 class APIRoutesTests(TestCase):
 
     def setUp(self):
         """ Make sure that the in-memory database has the expected test data before each test. """
+        DB.session.remove()
         DB.drop_all()
         DB.create_all()
+        clear_crypto_pair_metric_cache()
+        RESPONSE_CACHE.clear()
 
         # Create a handful of metrics to use
         btcusd_price = CryptoPairMetric(ticker='KRAKEN:BTCUSD', metric_type='price')
@@ -69,6 +86,39 @@ class APIRoutesTests(TestCase):
                 'metrics': [m.to_json() for m in self.known_metrics]
             }
 
+    def test_metrics_summary(self):
+        """ Tests a call to the metrics summary route, including metrics with no data points. """
+
+        with app.test_client() as c:
+            response = c.get('/metrics/summary?metric_type=price')
+            volume = c.get('/metrics/summary?metric_type=volume')
+
+        assert response.status_code == 200
+        assert response.json['metric_type'] == 'price'
+        summaries = {s['id']: s for s in response.json['summaries']}
+        assert sorted(summaries) == [self.btcusd_price_id, self.ethusd_price_id]
+
+        btcusd = summaries[self.btcusd_price_id]
+        assert btcusd['ticker'] == 'KRAKEN:BTCUSD'
+        assert btcusd['count'] == 4
+        assert btcusd['min'] == 1 and btcusd['max'] == 4
+        assert btcusd['percentiles']['p50'] == 2.5
+        self.assertAlmostEqual(btcusd['standard_deviation'], self.btcusd_std_dev)
+
+        # No volume data points at all
+        assert volume.status_code == 200
+        assert [s['count'] for s in volume.json['summaries']] == [0, 0]
+        assert volume.json['summaries'][0]['standard_deviation'] is None
+
+    def test_metrics_summary_invalid_metric_type(self):
+        with app.test_client() as c:
+            response = c.get('/metrics/summary?metric_type=spread')
+
+        assert response.status_code == 400
+        assert response.json == {
+            'error': 'Invalid metric type: "spread". Must be one of price, volume.'
+        }
+
     def test_metrics_info_invalid_metric_id(self):
         """ Tests a call to the metrics info route with an invalid metric ID. """
 
@@ -94,6 +144,23 @@ class APIRoutesTests(TestCase):
                 'error': 'No such metric with ID 30.'
             }
 
+    def test_metrics_info_unranked_metric(self):
+        """ Tests that a metric with fewer than two data points in the window has no rank. """
+
+        DB.session.add(MetricInstanceValue(
+            custom_metric_id=self.known_metrics[1].id,
+            metric_value=10.0,
+            timestamp=datetime.utcnow() - timedelta(minutes=1)
+        ))
+        DB.session.commit()
+
+        with app.test_client() as c:
+            response = c.get('/metrics/{}'.format(self.known_metrics[1].id))
+
+        assert response.status_code == 200
+        assert response.json['metric_rank'] is None
+        assert response.json['standard_deviation'] is None
+
     def test_metrics_info_success(self):
         """ Tests a call to the metrics info route for a valid metric."""
 
@@ -116,3 +183,354 @@ class APIRoutesTests(TestCase):
             # interest of time.
             history_raw = [m['value'] for m in data['metric_24h_history']]
             assert sorted(self.btcusd_price_values) == sorted(history_raw)
+
+    def test_metrics_info_resolution(self):
+        """ Tests a call to the metrics info route for history at a coarser resolution. """
+
+        now = datetime.utcnow()
+        for n in range(10):
+            bulk_save_metrics({'KRAKEN:BTCUSD': {'price': float(n)}}, now - timedelta(minutes=n))
+
+        with app.test_client() as c:
+            raw_response = c.get('/metrics/{}'.format(self.btcusd_price_id))
+            hourly_response = c.get('/metrics/{}?resolution=1h'.format(self.btcusd_price_id))
+
+        assert raw_response.status_code == 200
+        assert hourly_response.status_code == 200
+
+        # 4 points from setUp, 10 saved by the poller, only the latter are rolled up
+        assert len(raw_response.json['metric_24h_history']) == 14
+        hourly_history = hourly_response.json['metric_24h_history']
+        assert sum(bucket['count'] for bucket in hourly_history) == 10
+        assert 1 <= len(hourly_history) <= 2
+
+        # Everything else about the response is the same
+        for key in ['id', 'ticker', 'metric_type', 'standard_deviation', 'metric_rank']:
+            assert raw_response.json[key] == hourly_response.json[key]
+
+    def test_metrics_info_invalid_resolution(self):
+        """ Tests a call to the metrics info route with a resolution we don't keep rollups for. """
+
+        with app.test_client() as c:
+            response = c.get('/metrics/{}?resolution=2m'.format(self.btcusd_price_id))
+
+            # 400 Bad Request
+            assert response.status_code == 400
+            assert response.json == {
+                'error': 'Invalid resolution: "2m". Must be one of 1m, 5m, 1h.'
+            }
+
+    def test_rank_metric_against_similar_single_query(self):
+        """ Tests that ranking on the fly costs one query, no matter how many similar metrics. """
+
+        statements = list()
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with app.app_context():
+            event.listen(DB.engine, 'before_cursor_execute', before_cursor_execute)
+            try:
+                rank, standard_deviation = _rank_metric_against_similar(
+                    CryptoPairMetric.query.get(self.ethusd_price_id)
+                )
+            finally:
+                event.remove(DB.engine, 'before_cursor_execute', before_cursor_execute)
+
+        # One to load the target metric above, one to aggregate all the similar metrics
+        assert len(statements) == 2
+        assert rank == '2/2'
+        self.assertAlmostEqual(standard_deviation, stdev([99, 106, 300, 5]))
+
+    def test_metrics_info_uses_materialized_ranking(self):
+        """ Tests that a fresh materialized ranking is served as-is, and a stale one is ignored in
+        favor of ranking on the fly. """
+
+        now = datetime.utcnow()
+
+        # Rank the metrics from setUp (the first save backfills their rolling statistics), then
+        # record a ranking for the BTCUSD price metric that disagrees with its actual history.
+        bulk_save_metrics(dict(), now)
+        refresh_metric_rankings(now)
+        ranking = MetricRanking.query.get(self.btcusd_price_id)
+        ranking.rank = 2
+        ranking.standard_deviation = 999.0
+        DB.session.commit()
+
+        with patch('montecarlo.api.routes._rank_metric_against_similar') as patched_rank:
+            with app.test_client() as c:
+                response = c.get('/metrics/{}'.format(self.btcusd_price_id))
+
+            patched_rank.assert_not_called()
+
+        assert response.status_code == 200
+        assert response.json['metric_rank'] == '2/2'
+        assert response.json['standard_deviation'] == 999.0
+
+        # Once the ranking is stale, the route goes back to ranking from history.
+        MetricRanking.query.update({'computed_at': now - timedelta(hours=1)})
+        DB.session.commit()
+
+        # Only the poller moves the data generation on, so drop the cached response by hand.
+        RESPONSE_CACHE.clear()
+
+        with app.test_client() as c:
+            response = c.get('/metrics/{}'.format(self.btcusd_price_id))
+
+        assert response.json['metric_rank'] == '1/2'
+        assert response.json['standard_deviation'] == self.btcusd_std_dev
+
+    def test_metrics_info_cached_until_next_poll_cycle(self):
+        """ Tests that responses are served from the cache until the poller saves a new cycle. """
+
+        url = '/metrics/{}'.format(self.btcusd_price_id)
+
+        with app.test_client() as c:
+            # The history is streamed, and only cached once it's been read to the end.
+            first = c.get(url)
+            first.get_data()
+            with patch('montecarlo.api.routes.stream_24h_metric_history') as patched_history:
+                second = c.get(url)
+            patched_history.assert_not_called()
+
+            # Errors aren't cached
+            c.get('/metrics/30')
+            c.get('/metrics/30')
+
+            assert first.json == second.json
+            assert RESPONSE_CACHE.stats() == {'hits': 1, 'misses': 3}
+
+            # A new poll cycle invalidates the cached response.
+            bulk_save_metrics({'KRAKEN:BTCUSD': {'price': 5.0}}, datetime.utcnow())
+            third = c.get(url)
+
+            assert RESPONSE_CACHE.stats() == {'hits': 1, 'misses': 4}
+            assert len(third.json['metric_24h_history']) == len(self.btcusd_price_values) + 1
+
+            assert c.get('/cache/stats').json == {'hits': 1, 'misses': 4}
+
+    def test_local_cache_backend_evicts_least_recently_used(self):
+        backend = LocalCacheBackend(max_bytes=10)
+
+        backend.set('a', b'aaaa')
+        backend.set('b', b'bbbb')
+        assert backend.get('a') == b'aaaa'
+
+        # Over the cap, so the least recently used entry goes.
+        backend.set('c', b'cccc')
+        assert backend.get('b') is None
+        assert backend.get('a') == b'aaaa'
+        assert backend.get('c') == b'cccc'
+        assert backend.size_bytes == 8
+
+        # Never cached at all, rather than evicting everything else.
+        backend.set('d', b'd' * 11)
+        assert backend.get('d') is None
+        assert len(backend) == 2
+
+    def test_metrics_info_conditional_get(self):
+        """ Tests that a request revalidating the current response gets a 304 without the route
+        running its queries, until the poller saves another cycle. """
+
+        url = '/metrics/{}'.format(self.btcusd_price_id)
+
+        with app.test_client() as c:
+            response = c.get(url)
+            etag = response.headers['ETag']
+            assert response.status_code == 200
+            assert not etag.startswith('W/')
+            assert response.headers['Last-Modified']
+
+            with patch('montecarlo.api.routes.stream_24h_metric_history') as patched_history, \
+                    patch('montecarlo.api.routes.get_metric_ranking') as patched_ranking:
+                not_modified = c.get(url, headers={'If-None-Match': etag})
+                since = c.get(url, headers={'If-Modified-Since': response.headers['Last-Modified']})
+
+            patched_history.assert_not_called()
+            patched_ranking.assert_not_called()
+            assert not_modified.status_code == 304
+            assert not_modified.headers['ETag'] == etag
+            assert not_modified.data == b''
+            assert since.status_code == 304
+
+            # A different resolution is a different response.
+            assert c.get(url + '?resolution=1m', headers={'If-None-Match': etag}).status_code == 200
+
+            # New values for a similar metric can change the ranking, so the response is stale.
+            later = datetime.utcnow() + timedelta(seconds=1)
+            bulk_save_metrics({'KRAKEN:ETHUSD': {'price': 5.0}}, later)
+            modified = c.get(url, headers={'If-None-Match': etag})
+
+            assert modified.status_code == 200
+            assert modified.headers['ETag'] != etag
+
+    def test_metrics_list_conditional_get(self):
+        with app.test_client() as c:
+            etag = c.get('/metrics').headers['ETag']
+            assert c.get('/metrics', headers={'If-None-Match': etag}).status_code == 304
+
+            # No validators for errors
+            assert 'ETag' not in c.get('/metrics/30').headers
+
+    def test_metrics_history_since_cursor(self):
+        """ Tests following a metric's history with the cursor from each call. """
+
+        url = '/metrics/{}/history'.format(self.btcusd_price_id)
+
+        with app.test_client() as c:
+            response = c.get(url)
+            assert response.status_code == 200
+            assert len(response.json['metric_history']) == len(self.btcusd_price_values)
+            assert response.json['metric_rank'] == '1/2'
+            cursor = response.json['cursor']
+
+            # Nothing new yet, so the cursor stays put.
+            response = c.get(url, query_string={'cursor': cursor})
+            assert response.json['metric_history'] == []
+            assert response.json['cursor'] == cursor
+
+            later = datetime.utcnow()
+            bulk_save_metrics({'KRAKEN:BTCUSD': {'price': 7.0}}, later)
+
+            response = c.get(url, query_string={'cursor': cursor})
+            assert response.json['metric_history'] == [{'value': 7.0, 'timestamp': str(later)}]
+            self.assertAlmostEqual(
+                response.json['standard_deviation'], stdev(self.btcusd_price_values + [7.0])
+            )
+
+            # A timestamp works too, and only later points are returned.
+            response = c.get(url, query_string={'since': str(later - timedelta(seconds=1))})
+            assert [p['value'] for p in response.json['metric_history']] == [7.0]
+            response = c.get(url, query_string={'since': str(later)})
+            assert response.json['metric_history'] == []
+
+    def test_metrics_history_since_time_zone(self):
+        """ Tests that timestamps with a time zone are taken as the UTC time they stand for. """
+
+        url = '/metrics/{}/history'.format(self.btcusd_price_id)
+        later = datetime.utcnow()
+        bulk_save_metrics({'KRAKEN:BTCUSD': {'price': 7.0}}, later)
+        before = later - timedelta(seconds=1)
+
+        with app.test_client() as c:
+            for since in [
+                before.isoformat() + 'Z',
+                before.isoformat() + '+00:00',
+                (before + timedelta(hours=2)).isoformat() + '+02:00'
+            ]:
+                response = c.get(url, query_string={'since': since})
+                assert response.status_code == 200
+                assert [p['value'] for p in response.json['metric_history']] == [7.0]
+
+            response = c.get(url, query_string={'since': later.isoformat() + 'Z'})
+            assert response.json['metric_history'] == []
+
+            # Likewise in a cursor
+            cursor = urlsafe_b64encode((before.isoformat() + '+00:00').encode()).decode()
+            response = c.get(url, query_string={'cursor': cursor})
+            assert response.status_code == 200
+            assert [p['value'] for p in response.json['metric_history']] == [7.0]
+
+    def test_metrics_history_invalid_since(self):
+        url = '/metrics/{}/history'.format(self.btcusd_price_id)
+
+        with app.test_client() as c:
+            assert c.get(url, query_string={'since': 'yesterday'}).status_code == 400
+            assert c.get(url, query_string={'cursor': '!!'}).status_code == 400
+            both = {'since': '2022-01-01', 'cursor': 'x'}
+            assert c.get(url, query_string=both).status_code == 400
+            assert c.get('/metrics/30/history').status_code == 404
+
+    def test_metrics_info_streams_history(self):
+        """ Tests that the raw history is streamed a batch at a time, and still parses as a whole. """
+
+        with patch('montecarlo.api.routes._HISTORY_BATCH_SIZE', 3), app.test_client() as c:
+            response = c.get('/metrics/{}'.format(self.btcusd_price_id))
+            assert response.is_streamed
+
+            # The 4 values from setUp, in a batch of 3 and a batch of 1
+            chunks = list(response.response)
+            assert len(chunks) == 4
+            history = json.loads(b''.join(chunks))['metric_24h_history']
+            assert sorted(m['value'] for m in history) == sorted(self.btcusd_price_values)
+
+            # No history at all is an empty array
+            empty = c.get('/metrics/{}'.format(self.btcusd_price_id + 1))
+            assert empty.json['metric_24h_history'] == []
+
+    def test_large_streamed_response_not_cached(self):
+        with patch.object(RESPONSE_CACHE, 'max_entry_bytes', 100), app.test_client() as c:
+            c.get('/metrics/{}'.format(self.btcusd_price_id)).get_data()
+
+        assert len(RESPONSE_CACHE.backend) == 0
+
+    def _btcusd_price_epoch_ms(self):
+        timestamps = {
+            (m.timestamp - datetime(1970, 1, 1)) // timedelta(milliseconds=1)
+            for m in MetricInstanceValue.query.filter_by(custom_metric_id=self.btcusd_price_id)
+        }
+        assert len(timestamps) == 1
+        return timestamps.pop()
+
+    def test_metrics_info_columnar_json(self):
+        epoch_ms = self._btcusd_price_epoch_ms()
+
+        with app.test_client() as c:
+            response = c.get(
+                '/metrics/{}'.format(self.btcusd_price_id),
+                headers={'Accept': COLUMNAR_JSON_MIMETYPE}
+            )
+
+        assert response.status_code == 200
+        assert response.mimetype == COLUMNAR_JSON_MIMETYPE
+        assert 'Accept' in response.vary
+
+        body = json.loads(response.get_data())
+        assert body['metric_rank'] == '1/2'
+        assert body['metric_24h_history']['timestamp'] == [epoch_ms] * 4
+        assert sorted(body['metric_24h_history']['value']) == self.btcusd_price_values
+
+    def test_metrics_info_packed(self):
+        epoch_ms = self._btcusd_price_epoch_ms()
+
+        with patch('montecarlo.api.routes._HISTORY_BATCH_SIZE', 3), app.test_client() as c:
+            response = c.get(
+                '/metrics/{}'.format(self.btcusd_price_id),
+                headers={'Accept': '{}, application/json;q=0.5'.format(PACKED_MIMETYPE)}
+            )
+            assert response.mimetype == PACKED_MIMETYPE
+            fields, timestamps, values = read_packed(response.get_data())
+
+            # No history at all is a stream with no batches
+            empty = c.get(
+                '/metrics/{}'.format(self.btcusd_price_id + 1), headers={'Accept': PACKED_MIMETYPE}
+            )
+            _, empty_timestamps, _ = read_packed(empty.get_data())
+
+        assert fields['id'] == self.btcusd_price_id
+        assert fields['ticker'] == 'KRAKEN:BTCUSD'
+        assert 'metric_24h_history' not in fields
+        assert timestamps.tolist() == [epoch_ms] * 4
+        assert sorted(values.tolist()) == self.btcusd_price_values
+        assert len(empty_timestamps) == 0
+
+    def test_metrics_info_formats_cached_separately(self):
+        """ Tests that each negotiated format is cached, and validated, as its own response. """
+
+        url = '/metrics/{}'.format(self.btcusd_price_id)
+
+        with app.test_client() as c:
+            plain = c.get(url)
+            plain.get_data()
+            packed = c.get(url, headers={'Accept': PACKED_MIMETYPE})
+            packed.get_data()
+
+            cached_plain = c.get(url)
+            cached_packed = c.get(url, headers={'Accept': PACKED_MIMETYPE})
+
+        assert RESPONSE_CACHE.stats() == {'hits': 2, 'misses': 2}
+        assert plain.get_etag() != packed.get_etag()
+        assert cached_plain.mimetype == 'application/json'
+        assert cached_plain.get_data() == plain.get_data()
+        assert cached_packed.mimetype == PACKED_MIMETYPE
+        assert cached_packed.get_data() == packed.get_data()
@@ -0,0 +1,171 @@
+""" Tests for streaming new metric values to API clients. """
+
+# Shim the Flask app database creation to use an in-memory SQLite database instead of the
+# filesystem production one.
+import os
+os.environ['MONTECARLO_TEST_ENV'] = 'true'
+
+import json
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from montecarlo import DB, app
+from montecarlo.api.stream import METRIC_HUB, MetricFeed, MetricHub
+from montecarlo.persistence.metrics_manager import (
+    bulk_save_metrics,
+    clear_crypto_pair_metric_cache,
+    _get_or_create_crypto_pair_metric
+)
+
+
+class MetricHubTest(TestCase):
+
+    def test_publish_to_subscribers(self):
+        hub = MetricHub()
+        first = hub.subscribe({1, 2}, max_queued=10)
+        second = hub.subscribe({2}, max_queued=10)
+
+        assert hub.metric_ids() == {1, 2}
+        assert hub.publish(1, 'one') == 1
+        assert hub.publish(2, 'two') == 2
+        assert hub.publish(3, 'three') == 0
+
+        assert [first.get(timeout=0), first.get(timeout=0), first.get(timeout=0)] == \
+            ['one', 'two', None]
+        assert [second.get(timeout=0), second.get(timeout=0)] == ['two', None]
+
+        hub.unsubscribe(first)
+        assert hub.metric_ids() == {2}
+
+    def test_slow_subscriber_dropped(self):
+        hub = MetricHub()
+        slow = hub.subscribe({1}, max_queued=2)
+        fast = hub.subscribe({1}, max_queued=10)
+
+        for n in range(2):
+            hub.publish(1, n)
+        fast.get(timeout=0)
+        fast.get(timeout=0)
+
+        # The slow subscriber's queue is full, so it's dropped and the other one carries on.
+        assert hub.publish(1, 2) == 1
+        assert slow.dropped
+        assert not fast.dropped
+        assert len(hub) == 1
+        assert fast.get(timeout=0) == 2
+
+
+class MetricFeedTest(TestCase):
+
+    def setUp(self):
+        """ Make sure that the in-memory database is clean before each test method. """
+        DB.session.remove()
+        DB.drop_all()
+        DB.create_all()
+        clear_crypto_pair_metric_cache()
+
+        self.now = datetime.utcnow()
+        bulk_save_metrics({'KRAKEN:BTCUSD': {'price': 1.0, 'volume': 2.0}}, self.now)
+        self.price_id = _get_or_create_crypto_pair_metric('KRAKEN:BTCUSD', 'price').id
+
+        self.hub = MetricHub()
+        self.feed = MetricFeed(self.hub, poll_seconds=1)
+
+    def test_check_publishes_new_values(self):
+        subscription = self.hub.subscribe({self.price_id}, max_queued=10)
+
+        # Values saved before the feed started aren't sent.
+        assert self.feed.check() == 0
+
+        later = self.now + timedelta(minutes=1)
+        bulk_save_metrics({'KRAKEN:BTCUSD': {'price': 3.0, 'volume': 4.0}}, later)
+
+        assert self.feed.check() == 1
+        assert subscription.get(timeout=0) == {
+            'id': self.price_id,
+            'timestamp': str(later),
+            'value': 3.0
+        }
+
+        # Nothing new since.
+        assert self.feed.check() == 0
+        assert subscription.get(timeout=0) is None
+
+    def test_check_skips_ahead_without_subscribers(self):
+        self.feed.check()
+        bulk_save_metrics({'KRAKEN:BTCUSD': {'price': 3.0}}, self.now + timedelta(minutes=1))
+        assert self.feed.check() == 0
+
+        # A new subscriber only gets values saved after it subscribed.
+        subscription = self.hub.subscribe({self.price_id}, max_queued=10)
+        bulk_save_metrics({'KRAKEN:BTCUSD': {'price': 5.0}}, self.now + timedelta(minutes=2))
+
+        assert self.feed.check() == 1
+        assert subscription.get(timeout=0)['value'] == 5.0
+
+    def test_check_poll_cycle_saved_in_batches(self):
+        volume_id = _get_or_create_crypto_pair_metric('KRAKEN:BTCUSD', 'volume').id
+        subscription = self.hub.subscribe({self.price_id, volume_id}, max_queued=10)
+        self.feed.check()
+
+        # The metrics of one poll cycle, committed one at a time with the same timestamp.
+        later = self.now + timedelta(minutes=1)
+        bulk_save_metrics({'KRAKEN:BTCUSD': {'volume': 4.0}}, later)
+        assert self.feed.check() == 1
+
+        bulk_save_metrics({'KRAKEN:BTCUSD': {'price': 3.0}}, later)
+        assert self.feed.check() == 1
+
+        assert [subscription.get(timeout=0)['value'] for _ in range(2)] == [4.0, 3.0]
+
+    def test_check_values_committed_out_of_timestamp_order(self):
+        subscription = self.hub.subscribe({self.price_id}, max_queued=10)
+        self.feed.check()
+
+        bulk_save_metrics({'KRAKEN:BTCUSD': {'price': 3.0}}, self.now + timedelta(minutes=1))
+        assert self.feed.check() == 1
+
+        # Another poller shard committing a poll cycle that started earlier.
+        bulk_save_metrics({'KRAKEN:BTCUSD': {'price': 5.0}}, self.now + timedelta(seconds=30))
+        assert self.feed.check() == 1
+
+        assert [subscription.get(timeout=0)['value'] for _ in range(2)] == [3.0, 5.0]
+
+    def test_metrics_stream(self):
+        """ Tests the streaming route end to end, with the poller saving a value while a client is
+        connected. """
+
+        feed = MetricFeed(METRIC_HUB, poll_seconds=1)
+        feed.check()
+
+        with patch('montecarlo.api.routes.METRIC_FEED'), app.test_client() as c:
+            response = c.get('/metrics/stream?ids={}'.format(self.price_id), buffered=False)
+            assert response.status_code == 200
+            assert response.mimetype == 'text/event-stream'
+
+            later = self.now + timedelta(minutes=1)
+            bulk_save_metrics({'KRAKEN:BTCUSD': {'price': 3.0, 'volume': 4.0}}, later)
+            feed.check()
+
+            events = [next(response.response).decode() for _ in range(2)]
+            response.close()
+
+        assert events[0] == ': connected\n\n'
+        assert events[1].startswith('event: value\ndata: ')
+        assert json.loads(events[1].split('data: ')[1]) == {
+            'id': self.price_id,
+            'timestamp': str(later),
+            'value': 3.0
+        }
+
+        # Disconnecting unsubscribes.
+        assert len(METRIC_HUB) == 0
+
+    def test_metrics_stream_invalid_ids(self):
+        with app.test_client() as c:
+            response = c.get('/metrics/stream?ids=1,two')
+
+        assert response.status_code == 400
+        assert len(METRIC_HUB) == 0
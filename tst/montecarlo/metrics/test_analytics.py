@@ -0,0 +1,122 @@
+""" Tests for the metric analytics module. """
+
+# Shim the Flask app database creation to use an in-memory SQLite database instead of the
+# filesystem production one.
+import os
+os.environ['MONTECARLO_TEST_ENV'] = 'true'
+
+from datetime import datetime, timedelta
+from random import Random
+from statistics import mean, stdev
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+
+from montecarlo import DB
+from montecarlo.metrics.analytics import get_24h_metric_summaries, summarize_metric_values
+from montecarlo.persistence.metrics_manager import clear_crypto_pair_metric_cache
+from montecarlo.persistence.models import CryptoPairMetric, MetricInstanceValue
+
+
+class AnalyticsTests(TestCase):
+
+    def setUp(self):
+        DB.session.remove()
+        DB.drop_all()
+        DB.create_all()
+        clear_crypto_pair_metric_cache()
+
+    def test_summarize_metric_values(self):
+        """ Tests every metric's statistics against their one-metric-at-a-time equivalents, with
+        values in no particular order. """
+
+        random = Random(0)
+        metric_values = {
+            1: [random.uniform(90, 110) for _ in range(101)],
+            2: [random.uniform(1, 2) for _ in range(7)],
+            5: [3.0, 3.0]
+        }
+        rows = [(m, v) for m, values in metric_values.items() for v in values]
+        random.shuffle(rows)
+
+        summaries = summarize_metric_values(
+            np.array([m for m, _ in rows], dtype=np.int64),
+            np.array([v for _, v in rows], dtype=np.float64)
+        )
+
+        assert sorted(summaries) == [1, 2, 5]
+        for metric_id, values in metric_values.items():
+            summary = summaries[metric_id]
+            assert summary.count == len(values)
+            self.assertAlmostEqual(summary.mean, mean(values))
+            self.assertAlmostEqual(summary.standard_deviation, stdev(values))
+            assert summary.minimum == min(values)
+            assert summary.maximum == max(values)
+            self.assertAlmostEqual(summary.percentiles['p50'], np.percentile(values, 50))
+            self.assertAlmostEqual(summary.percentiles['p90'], np.percentile(values, 90))
+            self.assertAlmostEqual(summary.percentiles['p99'], np.percentile(values, 99))
+
+    def test_summarize_degenerate_metric_values(self):
+        """ Tests that a single data point has no standard deviation, rather than raising. """
+
+        summaries = summarize_metric_values(
+            np.array([1, 2, 2], dtype=np.int64), np.array([4.0, 1.0, 2.0])
+        )
+
+        single = summaries[1]
+        assert single.count == 1
+        assert single.mean == 4.0
+        assert single.standard_deviation is None
+        assert single.minimum == single.maximum == 4.0
+        assert single.percentiles == {'p50': 4.0, 'p90': 4.0, 'p99': 4.0}
+        assert summaries[2].standard_deviation is not None
+
+        assert summarize_metric_values(np.empty(0, np.int64), np.empty(0)) == dict()
+
+    def test_get_24h_metric_summaries(self):
+        now = datetime.utcnow()
+        btcusd_price = CryptoPairMetric(ticker='KRAKEN:BTCUSD', metric_type='price')
+        ethusd_price = CryptoPairMetric(ticker='KRAKEN:ETHUSD', metric_type='price')
+        btcusd_volume = CryptoPairMetric(ticker='KRAKEN:BTCUSD', metric_type='volume')
+        DB.session.add_all([btcusd_price, ethusd_price, btcusd_volume])
+        DB.session.commit()
+
+        btcusd_prices = [1.0, 2.0, 3.0, 4.0]
+        for minutes, price in enumerate(btcusd_prices):
+            DB.session.add(MetricInstanceValue(
+                custom_metric_id=btcusd_price.id,
+                metric_value=price,
+                timestamp=now - timedelta(minutes=minutes)
+            ))
+        DB.session.add_all([
+            # Outside the window
+            MetricInstanceValue(
+                custom_metric_id=btcusd_price.id,
+                metric_value=1000.0,
+                timestamp=now - timedelta(days=2)
+            ),
+            MetricInstanceValue(
+                custom_metric_id=ethusd_price.id, metric_value=5.0, timestamp=now
+            ),
+            # Not a price
+            MetricInstanceValue(
+                custom_metric_id=btcusd_volume.id, metric_value=7.0, timestamp=now
+            )
+        ])
+        DB.session.commit()
+
+        # Load in several batches
+        with patch('montecarlo.metrics.analytics._LOAD_BATCH_SIZE', 2):
+            summaries = get_24h_metric_summaries('price', now)
+
+        assert sorted(summaries) == [btcusd_price.id, ethusd_price.id]
+        assert summaries[btcusd_price.id].count == 4
+        assert summaries[btcusd_price.id].maximum == 4.0
+        self.assertAlmostEqual(
+            summaries[btcusd_price.id].standard_deviation, stdev(btcusd_prices)
+        )
+        assert summaries[ethusd_price.id].count == 1
+        assert summaries[ethusd_price.id].standard_deviation is None
+
+        assert get_24h_metric_summaries('price', now - timedelta(days=5)) == dict()
@@ -1,16 +1,58 @@
 """ Tests for the cryptocurrency metrics module. """
 
+import json
+
 from datetime import datetime
 from unittest import TestCase
 from unittest.mock import Mock, patch
 
-from cryptowatch.errors import CryptowatchError
-
-from montecarlo.metrics.crypto import poll_crypto_metrics, pull_market_summary
+from cryptowatch.errors import APIRateLimitError, CryptowatchError
+
+from montecarlo.metrics.config import GovernorConfig, PollingConfig
+from montecarlo.metrics.crypto import (
+    poll_crypto_metrics,
+    pull_all_market_summaries,
+    pull_market_summary
+)
+from montecarlo.metrics.governor import RequestGovernor
+
+# A local fake of the Cryptowatch "all market summaries" payload, trimmed down to a few markets.
+FAKE_ALL_SUMMARIES_PAYLOAD = json.dumps({
+    'result': {
+        'kraken:btcusd': {
+            'price': {'last': 1.1, 'high': 1.5, 'low': 1.0, 'change': {'percentage': 0.1}},
+            'volume': 2.2,
+            'volumeQuote': 9.9
+        },
+        'kraken:ethusd': {
+            'price': {'last': 3.3, 'high': 3.5, 'low': 3.0, 'change': {'percentage': 0.1}},
+            'volume': 4.4,
+            'volumeQuote': 9.9
+        },
+        'binance:btcusdt': {
+            'price': {'last': 5.5, 'high': 5.5, 'low': 5.5, 'change': {'percentage': 0.0}},
+            'volume': 6.6,
+            'volumeQuote': 9.9
+        }
+    },
+    'allowance': {'cost': 0.015, 'remaining': 9.985}
+})
 
 
 class CryptoMetricsTests(TestCase):
 
+    def setUp(self):
+        """ Keep the ranking stage that follows every poll cycle away from the database, and start
+        every test with a fresh request budget. """
+        patcher = patch('montecarlo.metrics.crypto.refresh_metric_rankings')
+        self.patched_refresh_metric_rankings = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.governor = RequestGovernor(GovernorConfig(dict()))
+        patcher = patch('montecarlo.metrics.crypto.REQUEST_GOVERNOR', self.governor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     @patch('montecarlo.metrics.crypto.bulk_save_metrics')
     @patch('montecarlo.metrics.crypto.pull_market_summary')
     @patch('montecarlo.metrics.crypto.CRYPTO_CONFIG')
@@ -28,6 +70,7 @@ class CryptoMetricsTests(TestCase):
         mock_market.pairs = ['BTCUSD', 'ETHUSD']
 
         patched_config.markets = [mock_market]
+        patched_config.polling = PollingConfig({'max_workers': 1})
 
         # KRAKEN:BTCUSD price, volume, and KRAKEN:ETHUSD price, volume
         patched_pull_market_summary.side_effect = [(1.1, 2.2), (3.3, 4.4)]
@@ -48,6 +91,38 @@ class CryptoMetricsTests(TestCase):
         }
 
         patched_bulk_save_metrics.assert_called_once_with(expected_ticker_metric_map, expected_date)
+        self.patched_refresh_metric_rankings.assert_called_once_with(expected_date)
+
+    @patch('montecarlo.metrics.crypto.bulk_save_metrics')
+    @patch('montecarlo.metrics.crypto.pull_market_summary')
+    @patch('montecarlo.metrics.crypto.CRYPTO_CONFIG')
+    @patch('montecarlo.metrics.crypto.datetime')
+    def test_poll_crypto_metrics_with_writer(self,
+                                             patched_datetime,
+                                             patched_config,
+                                             patched_pull_market_summary,
+                                             patched_bulk_save_metrics):
+        expected_date = datetime.utcnow()
+        patched_datetime.utcnow.return_value = expected_date
+
+        mock_market = Mock()
+        mock_market.name = 'KRAKEN'
+        mock_market.pairs = ['BTCUSD']
+
+        patched_config.markets = [mock_market]
+        patched_config.polling = PollingConfig({'max_workers': 1})
+
+        patched_pull_market_summary.side_effect = [(1.1, 2.2)]
+
+        metric_writer = Mock()
+        poll_crypto_metrics(metric_writer)
+
+        # The writer saves and ranks the metrics, not the poll cycle
+        metric_writer.submit.assert_called_once_with(
+            {'KRAKEN:BTCUSD': {'price': 1.1, 'volume': 2.2}}, expected_date
+        )
+        patched_bulk_save_metrics.assert_not_called()
+        self.patched_refresh_metric_rankings.assert_not_called()
 
     @patch('montecarlo.metrics.crypto._log')
     @patch('montecarlo.metrics.crypto.bulk_save_metrics')
@@ -68,6 +143,7 @@ class CryptoMetricsTests(TestCase):
         mock_market.pairs = ['BTCUSD', 'ETHUSD']
 
         patched_config.markets = [mock_market]
+        patched_config.polling = PollingConfig({'max_workers': 1})
 
         patched_pull_market_summary.side_effect = [CryptowatchError, CryptowatchError]
 
@@ -97,6 +173,7 @@ class CryptoMetricsTests(TestCase):
         mock_market.pairs = ['BTCUSD', 'ETHUSD']
 
         patched_config.markets = [mock_market]
+        patched_config.polling = PollingConfig({'max_workers': 1})
 
         # KRAKEN:BTCUSD price, volume, and KRAKEN:ETHUSD market summary fails
         patched_pull_market_summary.side_effect = [(1.1, 2.2), CryptowatchError]
@@ -115,36 +192,306 @@ class CryptoMetricsTests(TestCase):
 
         patched_bulk_save_metrics.assert_called_once_with(expected_ticker_metric_map, expected_date)
 
+    @patch('montecarlo.metrics.crypto.bulk_save_metrics')
+    @patch('montecarlo.metrics.crypto.pull_market_summary')
+    @patch('montecarlo.metrics.crypto.CRYPTO_CONFIG')
+    @patch('montecarlo.metrics.crypto.datetime')
+    def test_poll_crypto_metrics_concurrent(self,
+                                            patched_datetime,
+                                            patched_config,
+                                            patched_pull_market_summary,
+                                            patched_bulk_save_metrics):
+        expected_date = datetime.utcnow()
+        patched_datetime.utcnow.return_value = expected_date
+
+        kraken_market = Mock()
+        kraken_market.name = 'KRAKEN'
+        kraken_market.pairs = ['BTCUSD', 'ETHUSD', 'LTCUSD']
+
+        zonda_market = Mock()
+        zonda_market.name = 'ZONDA'
+        zonda_market.pairs = ['BTCUSD', 'ETHUSD']
+
+        patched_config.markets = [kraken_market, zonda_market]
+        patched_config.polling = PollingConfig({'max_workers': 4, 'max_per_market': 2})
+
+        # Completion order is up to the thread pool, so derive each summary from its ticker.
+        summaries = {
+            'KRAKEN:BTCUSD': (1.1, 2.2),
+            'KRAKEN:ETHUSD': (3.3, 4.4),
+            'KRAKEN:LTCUSD': CryptowatchError(),
+            'ZONDA:BTCUSD': (5.5, 6.6),
+            'ZONDA:ETHUSD': (7.7, 8.8),
+        }
+
+        def pull_summary(ticker):
+            if isinstance(summaries[ticker], Exception):
+                raise summaries[ticker]
+            return summaries[ticker]
+
+        patched_pull_market_summary.side_effect = pull_summary
+
+        poll_crypto_metrics()
+
+        assert patched_pull_market_summary.call_count == 5
+
+        expected_ticker_metric_map = {
+            'KRAKEN:BTCUSD': {'price': 1.1, 'volume': 2.2},
+            'KRAKEN:ETHUSD': {'price': 3.3, 'volume': 4.4},
+            'ZONDA:BTCUSD': {'price': 5.5, 'volume': 6.6},
+            'ZONDA:ETHUSD': {'price': 7.7, 'volume': 8.8},
+        }
+
+        patched_bulk_save_metrics.assert_called_once_with(expected_ticker_metric_map, expected_date)
+
+        # Results are collected in config order, regardless of completion order.
+        saved_ticker_metric_map = patched_bulk_save_metrics.call_args[0][0]
+        assert list(saved_ticker_metric_map) == list(expected_ticker_metric_map)
+
+    @patch('montecarlo.metrics.crypto._log')
+    @patch('montecarlo.metrics.crypto.bulk_save_metrics')
+    @patch('montecarlo.metrics.crypto.pull_market_summary')
+    @patch('montecarlo.metrics.crypto.cw_client')
+    @patch('montecarlo.metrics.crypto.CRYPTO_CONFIG')
+    @patch('montecarlo.metrics.crypto.datetime')
+    def test_poll_crypto_metrics_bulk_mode(self,
+                                           patched_datetime,
+                                           patched_config,
+                                           patched_cw_client,
+                                           patched_pull_market_summary,
+                                           patched_bulk_save_metrics,
+                                           patched_logger):
+        expected_date = datetime.utcnow()
+        patched_datetime.utcnow.return_value = expected_date
+
+        # KRAKEN has enough pairs to be served in bulk, ZONDA does not
+        kraken_market = Mock()
+        kraken_market.name = 'KRAKEN'
+        kraken_market.pairs = ['BTCUSD', 'ETHUSD', 'LTCUSD']
+
+        zonda_market = Mock()
+        zonda_market.name = 'ZONDA'
+        zonda_market.pairs = ['BTCUSD']
+
+        patched_config.markets = [kraken_market, zonda_market]
+        patched_config.polling = PollingConfig({'max_workers': 1, 'bulk_threshold': 3})
+
+        patched_cw_client.requestor.get_resource.return_value = (FAKE_ALL_SUMMARIES_PAYLOAD, None)
+        patched_pull_market_summary.side_effect = [(7.7, 8.8)]
+
+        poll_crypto_metrics()
+
+        # One bulk call for KRAKEN, one per-ticker call for ZONDA
+        patched_cw_client.requestor.get_resource.assert_called_once_with('/markets/summaries')
+        patched_pull_market_summary.assert_called_once_with('ZONDA:BTCUSD')
+
+        # KRAKEN:LTCUSD isn't in the bulk payload
+        assert patched_logger.error.call_count == 1
+
+        expected_ticker_metric_map = {
+            'KRAKEN:BTCUSD': {'price': 1.1, 'volume': 2.2},
+            'KRAKEN:ETHUSD': {'price': 3.3, 'volume': 4.4},
+            'ZONDA:BTCUSD': {'price': 7.7, 'volume': 8.8},
+        }
+
+        patched_bulk_save_metrics.assert_called_once_with(expected_ticker_metric_map, expected_date)
+
+    @patch('montecarlo.metrics.crypto.bulk_save_metrics')
+    @patch('montecarlo.metrics.crypto.pull_market_summary')
+    @patch('montecarlo.metrics.crypto.cw_client')
+    @patch('montecarlo.metrics.crypto.CRYPTO_CONFIG')
+    @patch('montecarlo.metrics.crypto.datetime')
+    def test_poll_crypto_metrics_some_tickers(self,
+                                              patched_datetime,
+                                              patched_config,
+                                              patched_cw_client,
+                                              patched_pull_market_summary,
+                                              patched_bulk_save_metrics):
+        expected_date = datetime.utcnow()
+        patched_datetime.utcnow.return_value = expected_date
+
+        kraken_market = Mock()
+        kraken_market.name = 'KRAKEN'
+        kraken_market.pairs = ['BTCUSD', 'ETHUSD', 'LTCUSD']
+
+        patched_config.markets = [kraken_market]
+        patched_config.polling = PollingConfig({'max_workers': 1, 'bulk_threshold': 3})
+
+        patched_pull_market_summary.side_effect = [(1.1, 2.2), (3.3, 4.4)]
+
+        poll_crypto_metrics(tickers={'KRAKEN:BTCUSD', 'KRAKEN:LTCUSD'})
+
+        # Too few of KRAKEN's pairs are being polled to be worth a bulk call
+        patched_cw_client.requestor.get_resource.assert_not_called()
+        assert [c.args[0] for c in patched_pull_market_summary.call_args_list] == \
+            ['KRAKEN:BTCUSD', 'KRAKEN:LTCUSD']
+
+        patched_bulk_save_metrics.assert_called_once_with({
+            'KRAKEN:BTCUSD': {'price': 1.1, 'volume': 2.2},
+            'KRAKEN:LTCUSD': {'price': 3.3, 'volume': 4.4}
+        }, expected_date)
+
+    @patch('montecarlo.metrics.crypto._log')
+    @patch('montecarlo.metrics.crypto.bulk_save_metrics')
+    @patch('montecarlo.metrics.crypto.pull_market_summary')
+    @patch('montecarlo.metrics.crypto.cw_client')
+    @patch('montecarlo.metrics.crypto.CRYPTO_CONFIG')
+    @patch('montecarlo.metrics.crypto.datetime')
+    def test_poll_crypto_metrics_bulk_mode_failure_falls_back(self,
+                                                              patched_datetime,
+                                                              patched_config,
+                                                              patched_cw_client,
+                                                              patched_pull_market_summary,
+                                                              patched_bulk_save_metrics,
+                                                              patched_logger):
+        expected_date = datetime.utcnow()
+        patched_datetime.utcnow.return_value = expected_date
+
+        mock_market = Mock()
+        mock_market.name = 'KRAKEN'
+        mock_market.pairs = ['BTCUSD', 'ETHUSD']
+
+        patched_config.markets = [mock_market]
+        patched_config.polling = PollingConfig({'max_workers': 1, 'bulk_threshold': 2})
+
+        patched_cw_client.requestor.get_resource.side_effect = CryptowatchError
+        patched_pull_market_summary.side_effect = [(1.1, 2.2), (3.3, 4.4)]
+
+        poll_crypto_metrics()
+
+        # The failed bulk call is logged, and both tickers are pulled individually instead
+        assert patched_logger.error.call_count == 1
+        assert patched_pull_market_summary.call_count == 2
+
+        expected_ticker_metric_map = {
+            'KRAKEN:BTCUSD': {'price': 1.1, 'volume': 2.2},
+            'KRAKEN:ETHUSD': {'price': 3.3, 'volume': 4.4},
+        }
+
+        patched_bulk_save_metrics.assert_called_once_with(expected_ticker_metric_map, expected_date)
+
+    @patch('montecarlo.metrics.crypto._log')
+    @patch('montecarlo.metrics.crypto.bulk_save_metrics')
+    @patch('montecarlo.metrics.crypto.pull_market_summary')
+    @patch('montecarlo.metrics.crypto.CRYPTO_CONFIG')
+    @patch('montecarlo.metrics.crypto.datetime')
+    def test_poll_crypto_metrics_out_of_budget(self,
+                                               patched_datetime,
+                                               patched_config,
+                                               patched_pull_market_summary,
+                                               patched_bulk_save_metrics,
+                                               patched_logger):
+        expected_date = datetime.utcnow()
+        patched_datetime.utcnow.return_value = expected_date
+
+        mock_market = Mock()
+        mock_market.name = 'KRAKEN'
+        mock_market.pairs = ['BTCUSD', 'ETHUSD', 'LTCUSD']
+
+        patched_config.markets = [mock_market]
+        patched_config.polling = PollingConfig({'max_workers': 1})
+
+        patched_pull_market_summary.side_effect = [(1.1, 2.2), (5.5, 6.6)]
+
+        governor = RequestGovernor(GovernorConfig({'burst': 2, 'priorities': {'KRAKEN:LTCUSD': 1}}))
+        with patch('montecarlo.metrics.crypto.REQUEST_GOVERNOR', governor):
+            poll_crypto_metrics()
+
+        # The priority ticker and the first of the rest are polled, and the last one skipped
+        assert [c.args[0] for c in patched_pull_market_summary.call_args_list] == \
+            ['KRAKEN:BTCUSD', 'KRAKEN:LTCUSD']
+        assert patched_logger.warning.call_count == 1
+
+        patched_bulk_save_metrics.assert_called_once_with({
+            'KRAKEN:BTCUSD': {'price': 1.1, 'volume': 2.2},
+            'KRAKEN:LTCUSD': {'price': 5.5, 'volume': 6.6}
+        }, expected_date)
+
+    @patch('montecarlo.metrics.crypto._log')
+    @patch('montecarlo.metrics.crypto.bulk_save_metrics')
+    @patch('montecarlo.metrics.crypto.pull_market_summary')
+    @patch('montecarlo.metrics.crypto.CRYPTO_CONFIG')
+    def test_poll_crypto_metrics_failed_ticker_backed_off(self,
+                                                          patched_config,
+                                                          patched_pull_market_summary,
+                                                          patched_bulk_save_metrics,
+                                                          patched_logger):
+        mock_market = Mock()
+        mock_market.name = 'KRAKEN'
+        mock_market.pairs = ['BTCUSD', 'ETHUSD']
+
+        patched_config.markets = [mock_market]
+        patched_config.polling = PollingConfig({'max_workers': 1})
+
+        patched_pull_market_summary.side_effect = [
+            (1.1, 2.2), APIRateLimitError('Out of credits'), (1.2, 2.3)
+        ]
+
+        poll_crypto_metrics()
+        assert patched_pull_market_summary.call_count == 2
+
+        # Rate limited, so nothing is requested until the credits may have been replenished
+        poll_crypto_metrics()
+        assert patched_pull_market_summary.call_count == 2
+        assert patched_bulk_save_metrics.call_args_list[-1].args[0] == dict()
+
+        # Then KRAKEN:ETHUSD is still backing off
+        self.governor._credits_updated_at -= self.governor.config.credit_refresh_interval
+        poll_crypto_metrics()
+        assert [c.args[0] for c in patched_pull_market_summary.call_args_list] == \
+            ['KRAKEN:BTCUSD', 'KRAKEN:ETHUSD', 'KRAKEN:BTCUSD']
+
+        stats = self.governor.stats()
+        assert (stats.requests_rate_limited, stats.backing_off) == (1, 1)
+
+    @patch('montecarlo.metrics.crypto.cw_client')
+    def test_pull_all_market_summaries(self, patched_cw_client):
+        patched_cw_client.requestor.get_resource.return_value = (FAKE_ALL_SUMMARIES_PAYLOAD, None)
+
+        assert pull_all_market_summaries() == {
+            'KRAKEN:BTCUSD': (1.1, 2.2),
+            'KRAKEN:ETHUSD': (3.3, 4.4),
+            'BINANCE:BTCUSDT': (5.5, 6.6),
+        }
+
     @patch('montecarlo.metrics.crypto.cw_client')
     def test_pull_market_summary_success(self, patched_cw_client):
         expected_ticker = 'KRAKEN:DOGEUSD'
         expected_price = 123.45
         expected_volume = 67.89
 
-        mock_market_summary = Mock()
-        mock_market_summary.volume = expected_volume
-        mock_market_summary.price.last = expected_price
-
-        mock_api_response = Mock()
-        mock_api_response.market = mock_market_summary
-
-        patched_cw_client.markets.get.return_value = mock_api_response
+        patched_cw_client.requestor.get_resource.return_value = (json.dumps({
+            'result': {
+                'price': {'last': expected_price, 'high': 130.0, 'low': 120.0},
+                'volume': expected_volume,
+                'volumeQuote': 9.9
+            },
+            'allowance': {'cost': 0.005, 'remaining': 9.5}
+        }), None)
 
         received_price, received_volume = pull_market_summary(expected_ticker)
 
-        patched_cw_client.markets.get.assert_called_once_with(expected_ticker)
+        patched_cw_client.requestor.get_resource.assert_called_once_with(
+            '/markets/KRAKEN/DOGEUSD/summary'
+        )
 
-        assert expected_price == expected_price
+        assert received_price == expected_price
         assert received_volume == expected_volume
 
+        # The fractional credits are kept
+        stats = self.governor.stats()
+        assert (stats.request_cost, stats.credits_remaining) == (0.005, 9.5)
+
     @patch('montecarlo.metrics.crypto.cw_client')
     def test_pull_market_summary_failure(self, patched_cw_client):
 
         expected_ticker = 'KRAKEN:DOGEUSD'
 
-        patched_cw_client.markets.get.side_effect = CryptowatchError
+        patched_cw_client.requestor.get_resource.side_effect = CryptowatchError
 
         with self.assertRaises(CryptowatchError):
             pull_market_summary(expected_ticker)
 
-        patched_cw_client.markets.get.assert_called_once_with(expected_ticker)
+        patched_cw_client.requestor.get_resource.assert_called_once_with(
+            '/markets/KRAKEN/DOGEUSD/summary'
+        )
@@ -0,0 +1,146 @@
+""" Tests for the Cryptowatch request governor module. """
+
+from random import Random
+from unittest import TestCase
+
+from cryptowatch.errors import APIRateLimitError, APIServerError
+
+from montecarlo.metrics.config import GovernorConfig
+from montecarlo.metrics.governor import RequestGovernor
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class RequestGovernorTest(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.config = GovernorConfig({
+            'rate': 0.5,
+            'burst': 4,
+            'credit_reserve': 1,
+            'credit_refresh_interval': 300,
+            'backoff_base': 10,
+            'backoff_max': 60,
+            'backoff_jitter': 0.5,
+            'priorities': {'kraken:btcusd': 10}
+        })
+        self.governor = RequestGovernor(self.config, clock=self.clock, random=Random(0))
+
+    def test_token_bucket(self):
+        tickers = ['A:BTCUSD', 'B:BTCUSD', 'C:BTCUSD']
+        assert self.governor.select(tickers) == (tickers, list())
+        assert self.governor.select(tickers) == (['A:BTCUSD'], ['B:BTCUSD', 'C:BTCUSD'])
+        assert self.governor.select(tickers) == (list(), tickers)
+
+        # Refilled at half a request a second, up to the burst
+        self.clock.now += 4
+        assert len(self.governor.select(tickers)[0]) == 2
+        self.clock.now += 1000
+        assert len(self.governor.select(tickers + ['D:BTCUSD', 'E:BTCUSD'])[0]) == 4
+
+    def test_priority_then_fairness(self):
+        tickers = ['A:BTCUSD', 'KRAKEN:BTCUSD', 'B:BTCUSD', 'C:BTCUSD', 'D:BTCUSD']
+
+        # The priority ticker goes first, and the rest in the order given
+        granted, skipped = self.governor.select(tickers)
+        assert granted == ['A:BTCUSD', 'KRAKEN:BTCUSD', 'B:BTCUSD', 'C:BTCUSD']
+        assert skipped == ['D:BTCUSD']
+
+        # Then those skipped last time
+        self.clock.now += 4
+        assert self.governor.select(tickers)[0] == ['KRAKEN:BTCUSD', 'D:BTCUSD']
+
+        stats = self.governor.stats()
+        assert (stats.requests_granted, stats.requests_skipped) == (6, 4)
+
+    def test_credits(self):
+        self.governor.record_allowance({'cost': 0.5, 'remaining': 2.7})
+
+        # Leaves the 1 credit reserve unspent, and keeps count of what it's spending meanwhile
+        assert len(self.governor.select(['A:BTCUSD', 'B:BTCUSD'])[0]) == 2
+        assert self.governor.select(['A:BTCUSD', 'B:BTCUSD'])[0] == ['A:BTCUSD']
+        self.assertAlmostEqual(self.governor.stats().credits_remaining, 1.2)
+
+        self.governor.record_allowance({'cost': 0.5, 'remaining': 1.0})
+        self.clock.now += 100
+        assert self.governor.select(['A:BTCUSD']) == (list(), ['A:BTCUSD'])
+
+        # Until the balance is too old to trust
+        self.clock.now += 200
+        assert self.governor.select(['A:BTCUSD']) == (['A:BTCUSD'], list())
+        assert self.governor.stats().credits_remaining is None
+
+    def test_request_cost_smoothed(self):
+        self.governor.record_allowance({'cost': 1.0, 'remaining': 100})
+        self.governor.record_allowance({'cost': 2.0, 'remaining': 98})
+        self.assertAlmostEqual(self.governor.stats().request_cost, 1.2)
+
+        # Responses without an allowance change nothing
+        self.governor.record_allowance(None)
+        self.assertAlmostEqual(self.governor.stats().credits_remaining, 98)
+
+    def test_backoff(self):
+        error = APIServerError('Bad gateway')
+        delays = list()
+        for _ in range(5):
+            self.governor.record_failure('A:BTCUSD', error)
+            delays.append(self.governor._retry_at['A:BTCUSD'] - self.clock.now)
+
+        # Doubling from 10 seconds up to 60, give or take half
+        for delay, expected in zip(delays, [10, 20, 40, 60, 60]):
+            assert 0.5 * expected <= delay <= 1.5 * expected
+        assert len(set(delays)) == 5
+
+        # Left out until it's due a retry, then retried until it succeeds
+        assert self.governor.select(['A:BTCUSD', 'B:BTCUSD']) == (['B:BTCUSD'], list())
+        assert self.governor.retries_due(['A:BTCUSD', 'B:BTCUSD']) == list()
+
+        self.clock.now += delays[-1]
+        assert self.governor.retries_due(['A:BTCUSD', 'B:BTCUSD']) == ['A:BTCUSD']
+        assert self.governor.select(['A:BTCUSD']) == (['A:BTCUSD'], list())
+
+        self.governor.record_success('A:BTCUSD')
+        assert self.governor.retries_due(['A:BTCUSD']) == list()
+        assert self.governor.stats().requests_failed == 5
+
+    def test_backoff_never_overflows(self):
+        config = GovernorConfig({'backoff_base': 0.5, 'backoff_max': 300, 'backoff_jitter': 0})
+        governor = RequestGovernor(config, clock=self.clock)
+
+        # A ticker that keeps failing, e.g. a delisted pair
+        for _ in range(2000):
+            governor.record_failure('A:BTCUSD', APIServerError('Not found'))
+
+        assert governor._retry_at['A:BTCUSD'] - self.clock.now == 300
+
+    def test_rate_limited(self):
+        self.governor.record_failure('A:BTCUSD', APIRateLimitError('Out of credits'))
+
+        # Nothing more until the credits may have been replenished
+        assert self.governor.select(['B:BTCUSD']) == (list(), ['B:BTCUSD'])
+
+        self.clock.now += 300
+        assert self.governor.select(['B:BTCUSD']) == (['B:BTCUSD'], list())
+
+        stats = self.governor.stats()
+        assert (stats.requests_rate_limited, stats.backing_off) == (1, 0)
+
+    def test_share(self):
+        self.governor.set_share(0.5)
+        assert len(self.governor.select(['A:BTCUSD', 'B:BTCUSD', 'C:BTCUSD'])[0]) == 2
+
+        # Refilled at a quarter of a request a second, but never less than one request at a time
+        self.clock.now += 4
+        assert len(self.governor.select(['A:BTCUSD', 'B:BTCUSD'])[0]) == 1
+
+        self.governor.set_share(0.01)
+        self.clock.now += 1000
+        assert len(self.governor.select(['A:BTCUSD', 'B:BTCUSD'])[0]) == 1
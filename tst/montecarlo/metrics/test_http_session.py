@@ -0,0 +1,105 @@
+""" Tests for the pooled HTTP session module. """
+
+import json
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from unittest import TestCase
+
+from requests.exceptions import RetryError
+
+from montecarlo.metrics.config import HttpConfig
+from montecarlo.metrics.crypto import HTTP_SESSION, cw_client
+from montecarlo.metrics.http_session import create_session, get_connection_stats
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """ Answers every GET with a market summary, keeping the connection open, unless the server
+    has failures queued up to answer with first. """
+
+    protocol_version = 'HTTP/1.1'
+
+    # Send each response as soon as it's written, as a real server would.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+            status = self.server.failures.pop(0) if self.server.failures else 200
+
+        body = json.dumps({'result': {'price': {'last': 1.0}, 'volume': 2.0}}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HttpSessionTest(TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.daemon_threads = True
+        self.server.lock = Lock()
+        self.server.requests = 0
+        self.server.failures = list()
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.url = 'http://127.0.0.1:{}/markets/KRAKEN/BTCUSD/summary'.format(
+            self.server.server_address[1]
+        )
+
+    def _session(self, **config):
+        session = create_session(HttpConfig(dict({'retry_backoff': 0}, **config)))
+        self.addCleanup(session.close)
+        return session
+
+    def test_connections_reused(self):
+        session = self._session()
+        for _ in range(10):
+            assert session.get(self.url, timeout=5).json()['result']['volume'] == 2.0
+
+        stats = get_connection_stats(session)
+        assert (stats.requests, stats.connections_opened, stats.connections_reused) == (10, 1, 9)
+        assert stats.reuse_ratio == 0.9
+
+    def test_pool_shared_between_threads(self):
+        session = self._session(pool_size=2)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            responses = list(executor.map(lambda _: session.get(self.url, timeout=5), range(40)))
+
+        assert all(r.status_code == 200 for r in responses)
+
+        # Requests wait for one of the pooled connections rather than opening more
+        stats = get_connection_stats(session)
+        assert stats.requests == 40
+        assert stats.connections_opened <= 2
+
+    def test_retries(self):
+        session = self._session(retries=2)
+
+        self.server.failures = [503, 502]
+        assert session.get(self.url, timeout=5).status_code == 200
+        assert self.server.requests == 3
+
+        self.server.failures = [503, 503, 503]
+        with self.assertRaises(RetryError):
+            session.get(self.url, timeout=5)
+
+        # Errors that aren't worth retrying aren't
+        self.server.failures = [429]
+        assert session.get(self.url, timeout=5).status_code == 429
+        assert self.server.requests == 7
+
+    def test_no_stats_before_requests(self):
+        stats = get_connection_stats(self._session())
+        assert (stats.requests, stats.connections_opened, stats.reuse_ratio) == (0, 0, None)
+
+    def test_cryptowatch_client_uses_pooled_session(self):
+        assert cw_client.requestor.api_client is HTTP_SESSION
@@ -0,0 +1,171 @@
+""" Tests for the write-behind ingestion module. """
+
+# Shim the Flask app database creation to use an in-memory SQLite database instead of the
+# filesystem production one.
+import os
+os.environ['MONTECARLO_TEST_ENV'] = 'true'
+
+from datetime import datetime, timedelta
+from threading import Event
+from time import monotonic, sleep
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy.exc import OperationalError
+
+from montecarlo import DB
+from montecarlo.metrics.config import IngestionConfig
+from montecarlo.metrics.ingestion import MetricWriter
+from montecarlo.persistence.metrics_manager import (
+    clear_crypto_pair_metric_cache,
+    get_24h_metric_history,
+    get_all_crypto_pair_metrics,
+    get_metric_ranking
+)
+
+
+def _wait_for(condition, timeout=5):
+    deadline = monotonic() + timeout
+    while not condition():
+        assert monotonic() < deadline, 'Timed out'
+        sleep(0.01)
+
+
+class MetricWriterTest(TestCase):
+
+    def setUp(self):
+        DB.session.remove()
+        DB.drop_all()
+        DB.create_all()
+        clear_crypto_pair_metric_cache()
+
+        self.now = datetime.utcnow()
+
+    def _writer(self, **config):
+        writer = MetricWriter(IngestionConfig(dict({'flush_interval': 60}, **config)))
+        writer.start()
+        self.addCleanup(writer.close)
+        return writer
+
+    def test_close_writes_everything_queued(self):
+        writer = self._writer()
+        for minutes, (btc, eth) in enumerate([(1.0, 10.0), (2.0, 20.0)]):
+            assert writer.submit({
+                'KRAKEN:BTCUSD': {'price': btc, 'volume': 5.0},
+                'KRAKEN:ETHUSD': {'price': eth}
+            }, self.now - timedelta(minutes=1 - minutes)) == 2
+
+        writer.close()
+
+        metric_ids = {(m.ticker, m.metric_type): m.id for m in get_all_crypto_pair_metrics()}
+        history = get_24h_metric_history(metric_ids[('KRAKEN:BTCUSD', 'price')], self.now)
+        assert [v.metric_value for v in history] == [1.0, 2.0]
+        assert get_metric_ranking(metric_ids[('KRAKEN:BTCUSD', 'price')], self.now) is not None
+
+        stats = writer.stats()
+        assert (stats.queue_depth, stats.samples_written, stats.batches_flushed) == (0, 4, 1)
+        assert stats.last_flush_seconds == stats.max_flush_seconds == stats.mean_flush_seconds
+
+        with self.assertRaises(RuntimeError):
+            writer.submit({'KRAKEN:BTCUSD': {'price': 3.0}}, self.now)
+
+    @patch('montecarlo.metrics.ingestion.refresh_metric_rankings')
+    @patch('montecarlo.metrics.ingestion.bulk_save_metrics')
+    def test_size_triggered_batches(self, patched_bulk_save_metrics, _):
+        writer = self._writer(batch_size=2)
+        writer.submit({'A:BTCUSD': {'price': 1.0}, 'B:BTCUSD': {'price': 2.0}}, self.now)
+        writer.submit({'C:BTCUSD': {'price': 3.0}}, self.now)
+
+        # The first two samples fill a batch, the third waits for more
+        _wait_for(lambda: writer.stats().batches_flushed == 1)
+        patched_bulk_save_metrics.assert_called_once_with(
+            {'A:BTCUSD': {'price': 1.0}, 'B:BTCUSD': {'price': 2.0}}, self.now
+        )
+
+        writer.close()
+        patched_bulk_save_metrics.assert_called_with({'C:BTCUSD': {'price': 3.0}}, self.now)
+
+    @patch('montecarlo.metrics.ingestion.refresh_metric_rankings')
+    @patch('montecarlo.metrics.ingestion.bulk_save_metrics')
+    def test_time_triggered_batches(self, patched_bulk_save_metrics, _):
+        writer = self._writer(batch_size=100, flush_interval=0.05)
+        writer.submit({'A:BTCUSD': {'price': 1.0}}, self.now)
+
+        _wait_for(lambda: writer.stats().samples_written == 1)
+        patched_bulk_save_metrics.assert_called_once_with({'A:BTCUSD': {'price': 1.0}}, self.now)
+
+    @patch('montecarlo.metrics.ingestion.refresh_metric_rankings')
+    @patch('montecarlo.metrics.ingestion.bulk_save_metrics')
+    def test_full_queue_blocks_then_drops(self, patched_bulk_save_metrics, _):
+        database_unlocked = Event()
+        patched_bulk_save_metrics.side_effect = lambda *args: database_unlocked.wait()
+
+        writer = self._writer(queue_size=1, batch_size=1, put_timeout=0.1)
+
+        # The writer takes the first sample and gets stuck writing it, the second fills the queue
+        # and the third can't be queued.
+        start = monotonic()
+        queued = writer.submit({
+            'A:BTCUSD': {'price': 1.0}, 'B:BTCUSD': {'price': 2.0}, 'C:BTCUSD': {'price': 3.0}
+        }, self.now)
+        assert monotonic() - start >= 0.1
+        assert queued == 2
+
+        stats = writer.stats()
+        assert (stats.queue_depth, stats.max_queue_depth, stats.samples_dropped) == (1, 1, 1)
+
+        database_unlocked.set()
+        writer.close()
+        assert writer.stats().samples_written == 2
+
+    @patch('montecarlo.metrics.ingestion.refresh_metric_rankings')
+    @patch('montecarlo.metrics.ingestion.bulk_save_metrics')
+    def test_failed_batch_retried(self, patched_bulk_save_metrics, _):
+        patched_bulk_save_metrics.side_effect = [
+            None, OperationalError('INSERT', {}, Exception('database is locked')), None
+        ]
+
+        writer = self._writer(retry_interval=0)
+        writer.submit({'A:BTCUSD': {'price': 1.0}}, self.now - timedelta(minutes=1))
+        writer.submit({'A:BTCUSD': {'price': 2.0}}, self.now)
+        writer.close()
+
+        # The cycle committed before the failure isn't written again
+        assert [c.args[1] for c in patched_bulk_save_metrics.call_args_list] == \
+            [self.now - timedelta(minutes=1), self.now, self.now]
+
+        stats = writer.stats()
+        assert (stats.samples_written, stats.failed_flushes, stats.samples_lost) == (2, 1, 0)
+
+    @patch('montecarlo.metrics.ingestion.refresh_metric_rankings')
+    @patch('montecarlo.metrics.ingestion.bulk_save_metrics')
+    def test_ranking_skipped_if_not_asked_for(self, patched_bulk_save_metrics,
+                                              patched_refresh_metric_rankings):
+        writer = MetricWriter(IngestionConfig({'flush_interval': 60}), ranking=False)
+        writer.start()
+        writer.submit({'A:BTCUSD': {'price': 1.0}}, self.now)
+        writer.close()
+
+        patched_bulk_save_metrics.assert_called_once_with({'A:BTCUSD': {'price': 1.0}}, self.now)
+        patched_refresh_metric_rankings.assert_not_called()
+
+    @patch('montecarlo.metrics.ingestion.refresh_metric_rankings')
+    @patch('montecarlo.metrics.ingestion.bulk_save_metrics')
+    def test_unexpected_error_loses_only_uncommitted_cycles(self, patched_bulk_save_metrics, _):
+        patched_bulk_save_metrics.side_effect = [None, ValueError('Bad value'), None]
+
+        writer = self._writer(batch_size=3)
+        writer.submit({'A:BTCUSD': {'price': 1.0}}, self.now - timedelta(minutes=2))
+        writer.submit({'A:BTCUSD': {'price': 2.0}, 'B:BTCUSD': {'price': 3.0}}, self.now)
+
+        # Not retried, but the cycle committed before the failure was written.
+        _wait_for(lambda: writer.stats().samples_lost)
+        assert patched_bulk_save_metrics.call_count == 2
+
+        stats = writer.stats()
+        assert (stats.samples_written, stats.failed_flushes, stats.samples_lost) == (1, 0, 2)
+
+        # And the writer carries on.
+        writer.submit({'A:BTCUSD': {'price': 4.0}}, self.now + timedelta(minutes=1))
+        writer.close()
+        assert writer.stats().samples_written == 2
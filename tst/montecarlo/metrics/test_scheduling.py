@@ -0,0 +1,173 @@
+""" Tests for the crypto metrics polling schedule module. """
+
+# Shim the Flask app database creation to use an in-memory SQLite database instead of the
+# filesystem production one.
+import os
+os.environ['MONTECARLO_TEST_ENV'] = 'true'
+
+from datetime import datetime, timedelta
+from random import Random
+from statistics import mean, stdev
+from unittest import TestCase
+from unittest.mock import patch
+
+from cryptowatch.errors import APIServerError
+
+from montecarlo import DB
+from montecarlo.metrics.config import GovernorConfig, SchedulingConfig
+from montecarlo.metrics.governor import RequestGovernor
+from montecarlo.metrics.scheduling import (
+    SamplingScheduler,
+    allocate_rates,
+    get_ticker_volatilities,
+    poll_due_crypto_metrics
+)
+from montecarlo.persistence.metrics_manager import bulk_save_metrics, clear_crypto_pair_metric_cache
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class AllocateRatesTest(TestCase):
+
+    def test_proportional_to_weights(self):
+        rates = allocate_rates({'a': 1.0, 'b': 3.0}, 4.0, 0.0, 10.0)
+        assert rates == {'a': 1.0, 'b': 3.0}
+
+    def test_bounded(self):
+        # b would get 3.6, and a and c 0.2 each
+        rates = allocate_rates({'a': 1.0, 'b': 18.0, 'c': 1.0}, 4.0, 0.5, 3.0)
+        assert rates == {'a': 0.5, 'b': 3.0, 'c': 0.5}
+
+        rates = allocate_rates({'a': 1.0, 'b': 8.0, 'c': 1.0}, 4.0, 0.5, 3.0)
+        assert rates['b'] == 3.0
+        assert rates['a'] == rates['c'] == 0.5
+
+        # Held at the cap, with the rest shared between the others
+        rates = allocate_rates({'a': 1.0, 'b': 1.0, 'c': 10.0}, 3.0, 0.1, 2.0)
+        assert rates == {'a': 0.5, 'b': 0.5, 'c': 2.0}
+
+    def test_no_weights(self):
+        assert allocate_rates({'a': 0.0, 'b': 0.0}, 1.0, 0.1, 1.0) == {'a': 0.5, 'b': 0.5}
+
+
+class SamplingSchedulerTest(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.config = SchedulingConfig({
+            'interval': 60,
+            'min_interval': 10,
+            'max_interval': 300,
+            'jitter': 0.1,
+            'tickers': {'kraken:usdtusd': 120}
+        })
+        self.sampling_scheduler = SamplingScheduler(
+            ['KRAKEN:BTCUSD', 'KRAKEN:ETHUSD', 'KRAKEN:USDTUSD'],
+            self.config,
+            clock=self.clock,
+            random=Random(0)
+        )
+
+    def test_due(self):
+        assert self.sampling_scheduler.due() == ['KRAKEN:BTCUSD', 'KRAKEN:ETHUSD', 'KRAKEN:USDTUSD']
+        assert self.sampling_scheduler.due() == list()
+
+        self.clock.now += 54
+        assert self.sampling_scheduler.due() == list()
+
+        self.clock.now += 12
+        assert self.sampling_scheduler.due() == ['KRAKEN:BTCUSD', 'KRAKEN:ETHUSD']
+
+        # However far behind, a ticker is only polled once
+        self.clock.now += 1000
+        assert self.sampling_scheduler.due() == ['KRAKEN:BTCUSD', 'KRAKEN:ETHUSD', 'KRAKEN:USDTUSD']
+        assert self.sampling_scheduler.due() == list()
+
+    def test_due_jittered(self):
+        self.sampling_scheduler.due()
+        next_due = dict(self.sampling_scheduler._next_due)
+
+        assert len(set(next_due.values())) == 3
+        for ticker, interval in self.sampling_scheduler.intervals().items():
+            assert 0.9 * interval <= next_due[ticker] - self.clock.now <= 1.1 * interval
+
+    def test_adapt(self):
+        self.sampling_scheduler.due()
+
+        intervals = self.sampling_scheduler.adapt({
+            'KRAKEN:BTCUSD': 0.03,
+            'KRAKEN:ETHUSD': 0.01,
+            'KRAKEN:USDTUSD': 0.0001
+        })
+
+        # The fixed interval is kept, and the others share what's left of the budget of every ticker
+        # polled once every 60 seconds in proportion to their volatility.
+        assert intervals['KRAKEN:USDTUSD'] == 120
+        self.assertAlmostEqual(intervals['KRAKEN:BTCUSD'], 32)
+        self.assertAlmostEqual(intervals['KRAKEN:ETHUSD'], 96)
+        self.assertAlmostEqual(sum(1 / i for i in intervals.values()), 3 / 60)
+
+        # Polls now overdue are brought forward
+        self.clock.now += 35
+        assert self.sampling_scheduler.due() == ['KRAKEN:BTCUSD']
+
+    def test_adapt_without_volatility(self):
+        intervals = self.sampling_scheduler.adapt({'KRAKEN:BTCUSD': 0.02})
+        self.assertAlmostEqual(intervals['KRAKEN:BTCUSD'], 48)
+        self.assertAlmostEqual(intervals['KRAKEN:ETHUSD'], 48)
+
+    @patch('montecarlo.metrics.scheduling.poll_crypto_metrics')
+    def test_poll_due_crypto_metrics(self, patched_poll_crypto_metrics):
+        poll_due_crypto_metrics(self.sampling_scheduler, 'writer')
+        patched_poll_crypto_metrics.assert_called_once_with(
+            'writer', tickers={'KRAKEN:BTCUSD', 'KRAKEN:ETHUSD', 'KRAKEN:USDTUSD'}
+        )
+
+        # Nothing to poll
+        poll_due_crypto_metrics(self.sampling_scheduler, 'writer')
+        assert patched_poll_crypto_metrics.call_count == 1
+
+    @patch('montecarlo.metrics.scheduling.poll_crypto_metrics')
+    def test_poll_due_crypto_metrics_retries(self, patched_poll_crypto_metrics):
+        governor = RequestGovernor(GovernorConfig({'backoff_base': 0}))
+        with patch('montecarlo.metrics.scheduling.REQUEST_GOVERNOR', governor):
+            poll_due_crypto_metrics(self.sampling_scheduler, 'writer')
+
+            # Failed tickers are retried once their backoff is over, whether they're due or not
+            governor.record_failure('KRAKEN:ETHUSD', APIServerError('Bad gateway'))
+            poll_due_crypto_metrics(self.sampling_scheduler, 'writer')
+
+        patched_poll_crypto_metrics.assert_called_with('writer', tickers={'KRAKEN:ETHUSD'})
+
+
+class TickerVolatilitiesTest(TestCase):
+
+    def setUp(self):
+        DB.session.remove()
+        DB.drop_all()
+        DB.create_all()
+        clear_crypto_pair_metric_cache()
+
+    def test_get_ticker_volatilities(self):
+        now = datetime.utcnow()
+        btcusd_prices = [100.0, 110.0, 90.0]
+        for minutes, price in enumerate(btcusd_prices):
+            bulk_save_metrics({
+                'KRAKEN:BTCUSD': {'price': price, 'volume': 1.0},
+                'KRAKEN:USDTUSD': {'price': 1.0, 'volume': 2.0}
+            }, now - timedelta(minutes=3 - minutes))
+
+        volatilities = get_ticker_volatilities(now)
+
+        assert volatilities.keys() == {'KRAKEN:BTCUSD', 'KRAKEN:USDTUSD'}
+        self.assertAlmostEqual(
+            volatilities['KRAKEN:BTCUSD'], stdev(btcusd_prices) / mean(btcusd_prices)
+        )
+        self.assertAlmostEqual(volatilities['KRAKEN:USDTUSD'], 0.0)
@@ -0,0 +1,200 @@
+""" Tests for the sharded poller module. """
+
+# Shim the Flask app database creation to use an in-memory SQLite database instead of the
+# filesystem production one.
+import os
+os.environ['MONTECARLO_TEST_ENV'] = 'true'
+
+import json
+
+from glob import glob
+from tempfile import TemporaryDirectory
+from time import monotonic
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+
+from montecarlo.metrics.config import SchedulingConfig
+from montecarlo.metrics.crypto import get_configured_tickers
+from montecarlo.metrics.scheduling import SamplingScheduler, poll_due_crypto_metrics
+from montecarlo.metrics.sharding import (
+    HashRing,
+    PollerSupervisor,
+    assign_tickers,
+    get_shard_tickers,
+    run_shard_worker
+)
+
+# Where the fake workers record what they've polled, inherited by the worker processes
+_OUTPUT_DIR = 'MONTECARLO_TEST_SHARD_OUTPUT'
+
+
+class FakeCryptowatchClient:
+    """ Answers market summary requests, singly or in bulk, for any ticker without going near
+    Cryptowatch. """
+
+    def __init__(self):
+        self.requestor = SimpleNamespace(get_resource=self._get_resource)
+
+    @staticmethod
+    def _get_resource(resource):
+        summary = {'price': {'last': 1.0}, 'volume': 2.0}
+        if resource != '/markets/summaries':
+            return json.dumps({'result': summary}), None
+
+        return json.dumps({'result': {
+            ticker.lower(): summary for _, ticker in get_configured_tickers()
+        }}), None
+
+
+class RecordingWriter:
+    """ Records the tickers of every metric submitted to a file for the shard. """
+
+    def __init__(self, path):
+        self.path = path
+
+    def submit(self, ticker_metric_map, timestamp):
+        with open(self.path, 'a') as f:
+            for ticker in ticker_metric_map:
+                f.write(ticker + '\n')
+
+        return len(ticker_metric_map)
+
+
+def _fake_worker(shard, shard_count, stop_event, reports):
+    """ A shard worker which polls a fake Cryptowatch, and records what it polls rather than
+    writing it to the database. """
+
+    path = os.path.join(os.environ[_OUTPUT_DIR], 'shard-{}-{}'.format(shard, os.getpid()))
+    scheduling_config = SchedulingConfig({'interval': 0.1, 'min_interval': 0.1, 'jitter': 0})
+    sampling_scheduler = SamplingScheduler(get_shard_tickers(shard, shard_count), scheduling_config)
+
+    with patch('montecarlo.metrics.crypto.cw_client', FakeCryptowatchClient()):
+        while not stop_event.is_set():
+            poll_due_crypto_metrics(
+                sampling_scheduler,
+                RecordingWriter(path),
+                on_cycle=lambda seconds, tickers: reports.put((shard, seconds, tickers))
+            )
+            stop_event.wait(0.05)
+
+
+def _crashing_worker(shard, shard_count, stop_event, reports):
+    """ A shard worker which crashes the first time it's started, and runs as normal after. """
+
+    marker = os.path.join(os.environ[_OUTPUT_DIR], 'crashed-{}'.format(shard))
+    if not os.path.exists(marker):
+        open(marker, 'w').close()
+        os._exit(1)
+
+    _fake_worker(shard, shard_count, stop_event, reports)
+
+
+class HashRingTest(TestCase):
+
+    def setUp(self):
+        self.tickers = ['MARKET{}:PAIR{}'.format(i % 7, i) for i in range(1000)]
+
+    def test_every_ticker_assigned_once(self):
+        assignment = assign_tickers(self.tickers, 4)
+
+        assert set(assignment) == {0, 1, 2, 3}
+        assert sorted(t for tickers in assignment.values() for t in tickers) == sorted(self.tickers)
+
+        # Spread roughly evenly, and the same every time
+        for tickers in assignment.values():
+            assert 150 <= len(tickers) <= 350
+        assert assign_tickers(self.tickers, 4) == assignment
+
+    def test_adding_a_shard_only_moves_tickers_to_it(self):
+        ring, bigger_ring = HashRing(4), HashRing(5)
+
+        moved = [t for t in self.tickers if ring.shard_for(t) != bigger_ring.shard_for(t)]
+
+        assert all(bigger_ring.shard_for(t) == 4 for t in moved)
+        assert 100 <= len(moved) <= 300
+
+    def test_single_shard(self):
+        assert assign_tickers(self.tickers, 1) == {0: self.tickers}
+
+        with self.assertRaises(ValueError):
+            HashRing(0)
+
+
+class PollerSupervisorTest(TestCase):
+
+    def setUp(self):
+        output_dir = TemporaryDirectory()
+        self.addCleanup(output_dir.cleanup)
+        self.output_dir = output_dir.name
+
+        patcher = patch.dict(os.environ, {_OUTPUT_DIR: self.output_dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _supervise_until(self, supervisor, condition, timeout=20):
+        supervisor.start()
+        try:
+            deadline = monotonic() + timeout
+            while not condition(supervisor.stats()):
+                assert monotonic() < deadline, 'Timed out'
+                supervisor.supervise(timeout=0.1)
+        finally:
+            supervisor.stop(timeout=10)
+
+    def _polled_tickers(self, shard):
+        polled = set()
+        for path in glob(os.path.join(self.output_dir, 'shard-{}-*'.format(shard))):
+            with open(path) as f:
+                polled.update(f.read().split())
+
+        return polled
+
+    def test_shards_poll_their_own_tickers(self):
+        supervisor = PollerSupervisor(3, worker=_fake_worker)
+        self._supervise_until(
+            supervisor, lambda stats: all(s.cycles >= 2 for s in stats.values())
+        )
+
+        tickers = [ticker for _, ticker in get_configured_tickers()]
+        for shard, shard_tickers in assign_tickers(tickers, 3).items():
+            assert self._polled_tickers(shard) == set(shard_tickers)
+
+            stats = supervisor.stats()[shard]
+            assert stats.restarts == 0
+            assert stats.last_cycle_tickers == len(shard_tickers)
+            assert 0 <= stats.mean_cycle_seconds <= stats.max_cycle_seconds
+
+    def test_crashed_worker_restarted(self):
+        supervisor = PollerSupervisor(2, worker=_crashing_worker, restart_delay=0)
+        self._supervise_until(
+            supervisor, lambda stats: all(s.cycles >= 1 for s in stats.values())
+        )
+
+        tickers = [ticker for _, ticker in get_configured_tickers()]
+        for shard, shard_tickers in assign_tickers(tickers, 2).items():
+            assert supervisor.stats()[shard].restarts == 1
+            assert self._polled_tickers(shard) == set(shard_tickers)
+
+    def test_only_supervisor_backfills_and_shard_0_ranks(self):
+        with patch('montecarlo.metrics.sharding.run_poller') as run_poller, \
+                patch('montecarlo.metrics.sharding.DB'), \
+                patch('montecarlo.metrics.sharding.HTTP_SESSION'), \
+                patch('montecarlo.metrics.sharding.REQUEST_GOVERNOR'):
+            for shard in range(2):
+                run_shard_worker(shard, 2, None, None)
+
+        assert [c.kwargs['backfill'] for c in run_poller.call_args_list] == [False, False]
+        assert [c.kwargs['retention'] for c in run_poller.call_args_list] == [True, False]
+        assert [c.kwargs['ranking'] for c in run_poller.call_args_list] == [True, False]
+
+        supervisor = PollerSupervisor(2)
+        with patch('montecarlo.metrics.sharding.backfill_rolling_stats') as backfill, \
+                patch.object(supervisor, 'start'), \
+                patch.object(supervisor, 'supervise', side_effect=KeyboardInterrupt), \
+                patch.object(supervisor, 'stop'), \
+                patch('montecarlo.metrics.sharding.DB'), \
+                patch('montecarlo.metrics.sharding.signal'):
+            supervisor.run()
+
+        backfill.assert_called_once_with()
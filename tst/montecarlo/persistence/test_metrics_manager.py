@@ -5,26 +5,66 @@
 import os
 os.environ['MONTECARLO_TEST_ENV'] = 'true'
 
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from statistics import mean, stdev
 from unittest import TestCase
 
+from sqlalchemy import event
+
 from montecarlo import DB
-from montecarlo.persistence.models import CryptoPairMetric, MetricInstanceValue
+from montecarlo.persistence.models import (
+    CryptoPairMetric,
+    MetricInstanceValue,
+    MetricRollingStats
+)
 from montecarlo.persistence.metrics_manager import (
     bulk_save_metrics,
+    clear_crypto_pair_metric_cache,
+    get_metric_ranking,
+    get_rolling_stats,
+    rebuild_rolling_stats,
+    refresh_metric_rankings,
+    warm_crypto_pair_metric_cache,
     _get_or_create_crypto_pair_metric,
     get_all_crypto_pair_metrics,
     get_crypto_pair_metric_by_id,
-    get_24h_metric_history
+    get_24h_metric_aggregates,
+    get_24h_metric_history,
+    get_24h_metric_rollups
 )
 
 
+@contextmanager
+def count_statements():
+    """ Counts the SELECT statements and COMMITs issued against the database within the block. """
+
+    counts = {'select': 0, 'commit': 0}
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        if statement.lstrip().upper().startswith('SELECT'):
+            counts['select'] += 1
+
+    def commit(conn):
+        counts['commit'] += 1
+
+    event.listen(DB.engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(DB.engine, 'commit', commit)
+    try:
+        yield counts
+    finally:
+        event.remove(DB.engine, 'before_cursor_execute', before_cursor_execute)
+        event.remove(DB.engine, 'commit', commit)
+
+
 class MetricsManagerTest(TestCase):
 
     def setUp(self):
         """ Make sure that the in-memory database is clean before each test method. """
+        DB.session.remove()
         DB.drop_all()
         DB.create_all()
+        clear_crypto_pair_metric_cache()
 
     def test_create_crypto_pair_metric_creates_new_entry(self):
         assert CryptoPairMetric.query.count() == 0
@@ -124,6 +164,71 @@ class MetricsManagerTest(TestCase):
         assert MetricInstanceValue.query.count() == 16
 
 
+    def test_bulk_save_metrics_steady_state_uses_identity_cache(self):
+
+        ticker_metric_map = {
+            'KRAKEN:BTCUSD': {
+                'price': 123.45,
+                'volume': 88.77
+            },
+            'KRAKEN:LTCUSD': {
+                'price': 998.77,
+                'volume': 77.665
+            }
+        }
+
+        # The first cycle warms the cache and creates the metrics, all in a single commit.
+        with count_statements() as counts:
+            bulk_save_metrics(ticker_metric_map, datetime.utcnow())
+        assert counts['commit'] == 1
+
+        # Once the metrics are known, a cycle does no lookups at all, just the one commit.
+        with count_statements() as counts:
+            bulk_save_metrics(ticker_metric_map, datetime.utcnow() + timedelta(minutes=1))
+        assert counts['select'] == 0
+        assert counts['commit'] == 1
+
+        assert CryptoPairMetric.query.count() == 4
+        assert MetricInstanceValue.query.count() == 8
+
+    def test_bulk_save_metrics_warmed_cache_picks_up_new_metrics(self):
+
+        existing_metric = _get_or_create_crypto_pair_metric('KRAKEN:BTCUSD', 'price')
+        warm_crypto_pair_metric_cache()
+
+        # A metric created after the cache was warmed is still found, rather than duplicated.
+        new_metric = _get_or_create_crypto_pair_metric('KRAKEN:BTCUSD', 'volume')
+        bulk_save_metrics({'KRAKEN:BTCUSD': {'price': 1.0, 'volume': 2.0}}, datetime.utcnow())
+
+        assert CryptoPairMetric.query.count() == 2
+        assert MetricInstanceValue.query.filter_by(custom_metric_id=existing_metric.id).count() == 1
+        assert MetricInstanceValue.query.filter_by(custom_metric_id=new_metric.id).count() == 1
+
+    def test_bulk_save_metrics_recovers_from_missing_cached_metric(self):
+
+        ticker_metric_map = {
+            'KRAKEN:BTCUSD': {
+                'price': 123.45,
+                'volume': 88.77
+            }
+        }
+        bulk_save_metrics(ticker_metric_map, datetime.utcnow())
+
+        # Delete the price metric out from under the cache.
+        price_metric = _get_or_create_crypto_pair_metric('KRAKEN:BTCUSD', 'price')
+        MetricInstanceValue.query.filter_by(custom_metric_id=price_metric.id).delete()
+        CryptoPairMetric.query.filter_by(id=price_metric.id).delete()
+        DB.session.commit()
+
+        bulk_save_metrics(ticker_metric_map, datetime.utcnow() + timedelta(minutes=1))
+
+        # The price metric is recreated and the cycle's values are saved against the new row.
+        assert CryptoPairMetric.query.count() == 2
+        recreated_metric = _get_or_create_crypto_pair_metric('KRAKEN:BTCUSD', 'price')
+        assert recreated_metric.id != price_metric.id
+        assert MetricInstanceValue.query.filter_by(custom_metric_id=recreated_metric.id).count() == 1
+        assert MetricInstanceValue.query.count() == 3
+
     def test_get_all_crypto_pair_metrics(self):
 
         expected_metrics = list()
@@ -197,3 +302,169 @@ class MetricsManagerTest(TestCase):
         # over that in the interest of time for this exercise.
         assert len(metric_24h_history) == 6
         assert all(m.metric_value == 123.45 for m in metric_24h_history)
+
+    def test_rolling_stats_follow_sliding_window(self):
+
+        start = datetime.utcnow() - timedelta(days=2)
+        prices = [40000.0 + (n * 37 % 101) for n in range(60)]
+
+        # One value an hour for 60 hours, so the first 36 fall out of the 24h window.
+        for n, price in enumerate(prices):
+            bulk_save_metrics({'KRAKEN:BTCUSD': {'price': price}}, start + timedelta(hours=n))
+
+        now = start + timedelta(hours=len(prices) - 1)
+        metric = _get_or_create_crypto_pair_metric('KRAKEN:BTCUSD', 'price')
+        rolling_stats = get_rolling_stats([metric.id], now)[metric.id]
+
+        # The window is inclusive of values exactly 24h old, like get_24h_metric_history.
+        window = [m.metric_value for m in get_24h_metric_history(metric.id, now)]
+        assert len(window) == 25
+
+        assert rolling_stats.count == len(window)
+        self.assertAlmostEqual(rolling_stats.mean, mean(window), places=6)
+        self.assertAlmostEqual(rolling_stats.standard_deviation, stdev(window), places=6)
+
+    def test_rolling_stats_stale_are_left_out(self):
+
+        now = datetime.utcnow()
+        bulk_save_metrics({'KRAKEN:BTCUSD': {'price': 1.0}}, now - timedelta(hours=1))
+        bulk_save_metrics({'KRAKEN:BTCUSD': {'price': 2.0}}, now)
+
+        metric = _get_or_create_crypto_pair_metric('KRAKEN:BTCUSD', 'price')
+
+        assert metric.id in get_rolling_stats([metric.id], now)
+        assert metric.id not in get_rolling_stats([metric.id], now + timedelta(days=2))
+
+    def test_rebuild_rolling_stats_backfills_untracked_metrics(self):
+
+        now = datetime.utcnow()
+        metric = _get_or_create_crypto_pair_metric('KRAKEN:BTCUSD', 'price')
+
+        # Values written directly, bypassing bulk_save_metrics, aren't tracked.
+        prices = [1.0, 2.0, 4.0, 8.0]
+        for n, price in enumerate(prices):
+            DB.session.add(MetricInstanceValue(
+                custom_metric_id=metric.id,
+                metric_value=price,
+                timestamp=now - timedelta(hours=n)
+            ))
+        DB.session.add(MetricInstanceValue(
+            custom_metric_id=metric.id,
+            metric_value=1000.0,
+            timestamp=now - timedelta(days=2)
+        ))
+        DB.session.commit()
+
+        assert MetricRollingStats.query.count() == 0
+
+        rebuild_rolling_stats(now)
+        DB.session.commit()
+
+        rolling_stats = get_rolling_stats([metric.id], now)[metric.id]
+        assert rolling_stats.count == len(prices)
+        self.assertAlmostEqual(rolling_stats.standard_deviation, stdev(prices))
+
+    def test_refresh_metric_rankings(self):
+
+        now = datetime.utcnow()
+        history = [
+            {'KRAKEN:BTCUSD': {'price': 1.0, 'volume': 10.0}, 'KRAKEN:ETHUSD': {'price': 5.0}},
+            {'KRAKEN:BTCUSD': {'price': 2.0, 'volume': 10.0}, 'KRAKEN:ETHUSD': {'price': 50.0}},
+            {'KRAKEN:BTCUSD': {'price': 3.0, 'volume': 10.0}, 'KRAKEN:ETHUSD': {'price': 500.0}},
+        ]
+        for n, ticker_metric_map in enumerate(history):
+            bulk_save_metrics(ticker_metric_map, now - timedelta(minutes=len(history) - n))
+
+        refresh_metric_rankings(now)
+
+        btcusd_price = _get_or_create_crypto_pair_metric('KRAKEN:BTCUSD', 'price')
+        btcusd_volume = _get_or_create_crypto_pair_metric('KRAKEN:BTCUSD', 'volume')
+        ethusd_price = _get_or_create_crypto_pair_metric('KRAKEN:ETHUSD', 'price')
+
+        # Prices are ranked against each other, volume on its own
+        btcusd_price_ranking = get_metric_ranking(btcusd_price.id, now)
+        assert (btcusd_price_ranking.rank, btcusd_price_ranking.total) == (1, 2)
+        self.assertAlmostEqual(btcusd_price_ranking.standard_deviation, stdev([1.0, 2.0, 3.0]))
+
+        ethusd_price_ranking = get_metric_ranking(ethusd_price.id, now)
+        assert (ethusd_price_ranking.rank, ethusd_price_ranking.total) == (2, 2)
+
+        btcusd_volume_ranking = get_metric_ranking(btcusd_volume.id, now)
+        assert (btcusd_volume_ranking.rank, btcusd_volume_ranking.total) == (1, 1)
+        self.assertAlmostEqual(btcusd_volume_ranking.standard_deviation, 0.0)
+
+        # Rankings past the staleness bound aren't returned
+        assert get_metric_ranking(btcusd_price.id, now + timedelta(hours=1)) is None
+
+    def test_get_24h_metric_aggregates(self):
+
+        now = datetime.utcnow()
+        btcusd_prices = [40001.5, 40002.5, 40010.0]
+        ethusd_prices = [3000.0, 3100.0]
+        for n in range(3):
+            ticker_metric_map = {'KRAKEN:BTCUSD': {'price': btcusd_prices[n], 'volume': 1.0}}
+            if n < len(ethusd_prices):
+                ticker_metric_map['KRAKEN:ETHUSD'] = {'price': ethusd_prices[n]}
+            bulk_save_metrics(ticker_metric_map, now - timedelta(hours=n))
+
+        # Outside of the window, shouldn't be aggregated
+        bulk_save_metrics({'KRAKEN:BTCUSD': {'price': 1.0}}, now - timedelta(days=2))
+
+        btcusd_price = _get_or_create_crypto_pair_metric('KRAKEN:BTCUSD', 'price')
+        ethusd_price = _get_or_create_crypto_pair_metric('KRAKEN:ETHUSD', 'price')
+
+        aggregates = get_24h_metric_aggregates('price', now)
+
+        # Only price metrics
+        assert set(aggregates) == {btcusd_price.id, ethusd_price.id}
+
+        count, mean_value, sum_sq_deviations = aggregates[btcusd_price.id]
+        assert count == 3
+        self.assertAlmostEqual(mean_value, mean(btcusd_prices))
+        self.assertAlmostEqual((sum_sq_deviations / (count - 1)) ** 0.5, stdev(btcusd_prices))
+
+        count, mean_value, sum_sq_deviations = aggregates[ethusd_price.id]
+        assert count == 2
+        self.assertAlmostEqual((sum_sq_deviations / (count - 1)) ** 0.5, stdev(ethusd_prices))
+
+    def test_rollups_maintained_as_values_arrive(self):
+
+        hour_start = datetime(2022, 2, 27, 5, 0, 0)
+
+        # Four values in the first 5 minutes of the hour, one of them arriving out of order, and
+        # one more later in the hour.
+        for minute, price in [(1, 20.0), (0, 10.0), (3, 40.0), (4, 5.0), (42, 100.0)]:
+            bulk_save_metrics(
+                {'KRAKEN:BTCUSD': {'price': price}},
+                hour_start + timedelta(minutes=minute, seconds=30)
+            )
+
+        metric = _get_or_create_crypto_pair_metric('KRAKEN:BTCUSD', 'price')
+        now = hour_start + timedelta(hours=1)
+
+        minute_rollups = get_24h_metric_rollups(metric.id, 60, now)
+        assert [r.bucket_start.minute for r in minute_rollups] == [0, 1, 3, 4, 42]
+        assert all(r.count == 1 for r in minute_rollups)
+
+        five_minute_rollups = get_24h_metric_rollups(metric.id, 5 * 60, now)
+        assert [r.bucket_start.minute for r in five_minute_rollups] == [0, 40]
+
+        first_bucket = five_minute_rollups[0].to_json()
+        assert first_bucket == {
+            'timestamp': '2022-02-27 05:00:00',
+            'value': 18.75,
+            'open': 10.0,
+            'high': 40.0,
+            'low': 5.0,
+            'close': 5.0,
+            'count': 4
+        }
+
+        hour_rollups = get_24h_metric_rollups(metric.id, 60 * 60, now)
+        assert len(hour_rollups) == 1
+        assert (hour_rollups[0].open, hour_rollups[0].close) == (10.0, 100.0)
+        assert (hour_rollups[0].low, hour_rollups[0].high) == (5.0, 100.0)
+        assert hour_rollups[0].count == 5
+
+        # Nothing from more than a day ago
+        assert get_24h_metric_rollups(metric.id, 60, now + timedelta(days=2)) == []
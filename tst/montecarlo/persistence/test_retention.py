@@ -0,0 +1,107 @@
+""" Tests for the retention module. """
+
+# Shim the Flask app database creation to use an in-memory SQLite database instead of the
+# filesystem production one.
+import os
+os.environ['MONTECARLO_TEST_ENV'] = 'true'
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from montecarlo import DB
+from montecarlo.metrics.config import RetentionConfig
+from montecarlo.persistence.metrics_manager import (
+    bulk_save_metrics,
+    clear_crypto_pair_metric_cache,
+    _get_or_create_crypto_pair_metric
+)
+from montecarlo.persistence.models import MetricInstanceValue, MetricRollup
+from montecarlo.persistence.retention import run_retention
+
+
+class RetentionTest(TestCase):
+
+    def setUp(self):
+        """ Make sure that the in-memory database is clean before each test method. """
+        DB.session.remove()
+        DB.drop_all()
+        DB.create_all()
+        clear_crypto_pair_metric_cache()
+
+        self.now = datetime(2022, 3, 31, 12, 30, 0)
+
+    def test_run_retention_compacts_and_deletes_expired_values(self):
+
+        price_metric = _get_or_create_crypto_pair_metric('KRAKEN:BTCUSD', 'price')
+        legacy_hour = datetime(2022, 2, 20, 7, 0, 0)
+
+        # Values from before rollups existed, written directly, so they have no rollups yet.
+        for minute, price in [(10, 2.0), (5, 1.0), (50, 3.0), (55, 0.5)]:
+            DB.session.add(MetricInstanceValue(
+                custom_metric_id=price_metric.id,
+                metric_value=price,
+                timestamp=legacy_hour + timedelta(minutes=minute)
+            ))
+        DB.session.commit()
+
+        # Expired values written by the poller, which already have rollups.
+        for minute in range(3):
+            bulk_save_metrics(
+                {'KRAKEN:BTCUSD': {'price': 10.0, 'volume': 20.0}},
+                datetime(2022, 2, 25, 7, minute, 0)
+            )
+
+        # Recent values, which should be left alone.
+        for minute in range(3):
+            bulk_save_metrics(
+                {'KRAKEN:BTCUSD': {'price': 100.0, 'volume': 200.0}},
+                self.now - timedelta(minutes=minute)
+            )
+
+        retention_config = RetentionConfig({
+            'days': {'price': 30, 'volume': 30},
+            'batch_size': 2
+        })
+        report = run_retention(self.now, retention_config)
+
+        # Only the recent values remain.
+        assert MetricInstanceValue.query.count() == 6
+        assert report.values_deleted == 10
+
+        # The legacy hour was compacted into an hourly rollup; the poller's hour already had one.
+        assert report.rollups_created == 1
+        legacy_rollup = MetricRollup.query.get((price_metric.id, 60 * 60, legacy_hour))
+        assert legacy_rollup.to_json() == {
+            'timestamp': str(legacy_hour),
+            'value': 1.625,
+            'open': 1.0,
+            'high': 3.0,
+            'low': 0.5,
+            'close': 0.5,
+            'count': 4
+        }
+
+        poller_rollup = MetricRollup.query.get(
+            (price_metric.id, 60 * 60, datetime(2022, 2, 25, 7, 0, 0))
+        )
+        assert poller_rollup.count == 3
+
+        # Finer-grained rollups that old are gone, recent ones remain.
+        expired_rollups = MetricRollup.query.\
+            filter(MetricRollup.resolution < 60 * 60).\
+            filter(MetricRollup.bucket_start < datetime(2022, 3, 1)).\
+            count()
+        assert expired_rollups == 0
+        assert report.rollups_deleted == 2 * 3 + 2 * 1
+        assert MetricRollup.query.filter(MetricRollup.resolution == 60).count() == 2 * 3
+
+    def test_run_retention_enforces_minimum_retention(self):
+
+        bulk_save_metrics({'KRAKEN:BTCUSD': {'price': 1.0}}, self.now - timedelta(hours=30))
+        bulk_save_metrics({'KRAKEN:BTCUSD': {'price': 1.0}}, self.now - timedelta(days=3))
+
+        # A day of retention would eat into values the rolling statistics still depend on.
+        report = run_retention(self.now, RetentionConfig({'days': {'price': 1}}))
+
+        assert report.values_deleted == 1
+        assert MetricInstanceValue.query.count() == 1
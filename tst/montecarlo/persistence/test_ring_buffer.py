@@ -0,0 +1,195 @@
+""" Tests for the metric ring buffers, and the metrics_manager reads served from them. """
+
+# Shim the Flask app database creation to use an in-memory SQLite database instead of the
+# filesystem production one.
+import os
+os.environ['MONTECARLO_TEST_ENV'] = 'true'
+
+from datetime import datetime, timedelta
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from montecarlo import DB
+from montecarlo.persistence import metrics_manager
+from montecarlo.persistence.metrics_manager import (
+    _insert_metric_values,
+    bulk_save_metrics,
+    clear_crypto_pair_metric_cache,
+    get_24h_metric_aggregates,
+    get_all_crypto_pair_metrics,
+    stream_24h_metric_history,
+    stream_24h_metric_history_columns
+)
+from montecarlo.persistence.ring_buffer import COVERS_ALL, MetricRingBuffer, RingBufferStore
+
+
+class MetricRingBufferTest(TestCase):
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, '1.ring')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_append_and_read(self):
+        writer = MetricRingBuffer.create(self.path, capacity=4)
+        reader = MetricRingBuffer(self.path)
+        assert writer.last_timestamp is None
+
+        writer.append([10, 20, 30], [1.0, 2.0, 3.0])
+        assert writer.last_timestamp == 30
+
+        timestamps, values = reader.read(15, 30)
+        assert timestamps.tolist() == [20, 30]
+        assert values.tolist() == [2.0, 3.0]
+
+        # Nothing in the window, but nothing missing either
+        timestamps, values = reader.read(0, 5)
+        assert len(timestamps) == 0
+
+    def test_wrapped_buffer_only_covers_what_it_holds(self):
+        writer = MetricRingBuffer.create(self.path, capacity=4)
+        writer.append([10, 20, 30], [1.0, 2.0, 3.0])
+        writer.append([40, 50, 60], [4.0, 5.0, 6.0])
+
+        timestamps, values = writer.read(30, 60)
+        assert timestamps.tolist() == [30, 40, 50, 60]
+        assert values.tolist() == [3.0, 4.0, 5.0, 6.0]
+
+        # 10 and 20 have been overwritten
+        assert writer.read(25, 60) is None
+
+    def test_rebuild(self):
+        writer = MetricRingBuffer.create(self.path, capacity=4)
+        writer.append([10, 20], [1.0, 2.0])
+
+        writer.rebuild([30, 40, 50], [3.0, 4.0, 5.0], covered_since=30)
+        assert writer.last_timestamp == 50
+        assert writer.read(30, 50)[0].tolist() == [30, 40, 50]
+        assert writer.read(20, 50) is None
+
+        writer.rebuild([], [], covered_since=COVERS_ALL)
+        assert writer.last_timestamp is None
+        assert len(writer.read(0, 100)[0]) == 0
+
+    def test_read_racing_writer_gives_up(self):
+        writer = MetricRingBuffer.create(self.path, capacity=4)
+        writer.append([10, 20, 30, 40], [1.0, 2.0, 3.0, 4.0])
+
+        # A writer which has claimed slots it hasn't published yet, on every read
+        writer._map[3] += 2
+        assert writer.read(30, 40) is None
+
+    def test_store_replaces_buffers_of_another_capacity(self):
+        RingBufferStore(self.directory.name, 4).open_for_writing(1)[0].append([10], [1.0])
+
+        reader = RingBufferStore(self.directory.name, 4)
+        assert reader.open(1).capacity == 4
+
+        ring_buffer, opened = RingBufferStore(self.directory.name, 8).open_for_writing(1)
+        assert opened
+        assert ring_buffer.capacity == 8
+        assert ring_buffer.last_timestamp is None
+
+        # Readers notice the old file was retired, and reopen the new one
+        assert reader.open(1).capacity == 8
+
+    def test_store_without_buffer(self):
+        assert RingBufferStore(self.directory.name, 4).open(2) is None
+
+
+class RingBufferReadsTest(TestCase):
+
+    def setUp(self):
+        DB.session.remove()
+        DB.drop_all()
+        DB.create_all()
+        clear_crypto_pair_metric_cache()
+
+        self.directory = TemporaryDirectory()
+        self.ring_buffers = RingBufferStore(self.directory.name, 16)
+        patcher = patch.object(metrics_manager, 'RING_BUFFERS', self.ring_buffers)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.now = datetime.utcnow()
+        for minutes, (btc, eth) in enumerate([(1.0, 10.0), (3.0, 20.0), (2.0, 40.0)]):
+            bulk_save_metrics({
+                'KRAKEN:BTCUSD': {'price': btc},
+                'KRAKEN:ETHUSD': {'price': eth}
+            }, self.now - timedelta(minutes=3 - minutes))
+        self.btcusd_price_id = get_all_crypto_pair_metrics()[0].id
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _history(self):
+        return [
+            row for rows in stream_24h_metric_history(self.btcusd_price_id, self.now, 2)
+            for row in rows
+        ]
+
+    def test_reads_match_database(self):
+        from_ring_buffers = (self._history(), get_24h_metric_aggregates('price', self.now))
+        ring_buffer_columns = list(
+            stream_24h_metric_history_columns(self.btcusd_price_id, self.now, 2)
+        )
+
+        with patch.object(metrics_manager, 'RING_BUFFERS', None):
+            from_database = (self._history(), get_24h_metric_aggregates('price', self.now))
+            database_columns = list(
+                stream_24h_metric_history_columns(self.btcusd_price_id, self.now, 2)
+            )
+
+        assert [value for _, value in from_ring_buffers[0]] == [1.0, 3.0, 2.0]
+        assert from_ring_buffers[0] == from_database[0]
+        assert from_ring_buffers[1].keys() == from_database[1].keys()
+        for metric_id, (count, mean, sum_sq_deviations) in from_database[1].items():
+            assert from_ring_buffers[1][metric_id][0] == count
+            self.assertAlmostEqual(from_ring_buffers[1][metric_id][1], mean)
+            self.assertAlmostEqual(from_ring_buffers[1][metric_id][2], sum_sq_deviations)
+        assert [t.tolist() for t, _ in ring_buffer_columns] == \
+            [t.tolist() for t, _ in database_columns]
+
+    def test_reads_served_from_ring_buffer(self):
+        """ Tests that the history comes from the ring buffer, by changing the database. """
+
+        DB.session.execute(
+            metrics_manager.MetricInstanceValue.__table__.update().values(metric_value=0.0)
+        )
+
+        assert [value for _, value in self._history()] == [1.0, 3.0, 2.0]
+
+    def test_ring_buffer_behind_database_not_used(self):
+        """ Tests that values not yet in the ring buffer are read from the database. """
+
+        _insert_metric_values([{
+            'custom_metric_id': self.btcusd_price_id,
+            'metric_value': 9.0,
+            'timestamp': self.now
+        }])
+
+        assert [value for _, value in self._history()] == [1.0, 3.0, 2.0, 9.0]
+
+    def test_ring_buffer_rebuilt_from_database(self):
+        """ Tests that a new process' first write rebuilds the ring buffer from the database, so
+        values it missed aren't lost. """
+
+        _insert_metric_values([{
+            'custom_metric_id': self.btcusd_price_id,
+            'metric_value': 9.0,
+            'timestamp': self.now - timedelta(seconds=30)
+        }])
+        DB.session.commit()
+
+        with patch.object(
+            metrics_manager, 'RING_BUFFERS', RingBufferStore(self.directory.name, 16)
+        ):
+            bulk_save_metrics({'KRAKEN:BTCUSD': {'price': 5.0}}, self.now)
+            DB.session.execute(
+                metrics_manager.MetricInstanceValue.__table__.update().values(metric_value=0.0)
+            )
+
+            assert [value for _, value in self._history()] == [1.0, 3.0, 2.0, 9.0, 5.0]
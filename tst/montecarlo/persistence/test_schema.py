@@ -0,0 +1,202 @@
+""" Tests for the database schema: indexes, query plans against them, and upgrading old databases. """
+
+# Shim the Flask app database creation to use an in-memory SQLite database instead of the
+# filesystem production one.
+import os
+os.environ['MONTECARLO_TEST_ENV'] = 'true'
+
+import re
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import IntegrityError
+
+from montecarlo import DB
+from montecarlo.persistence.metrics_manager import (
+    bulk_save_metrics,
+    clear_crypto_pair_metric_cache,
+    get_24h_metric_aggregates,
+    get_24h_metric_history,
+    get_24h_metric_rollups,
+    get_latest_metric_timestamp,
+    get_metric_history_since,
+    stream_24h_metric_type_values,
+    _get_or_create_crypto_pair_metric
+)
+from montecarlo.persistence.models import CryptoPairMetric, MetricInstanceValue, upgrade_schema
+
+# A query plan step which reads every row of the metric values table
+_FULL_SCAN = re.compile(r'^SCAN (TABLE )?metricValues\b')
+
+
+@contextmanager
+def capture_query_plans():
+    """ Collects the EXPLAIN QUERY PLAN steps of every statement executed within the block, as a
+    list of (statement, [plan step details]) tuples. """
+
+    statements = list()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, *args):
+        statements.append((statement, parameters))
+
+    plans = list()
+
+    event.listen(DB.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield plans
+    finally:
+        event.remove(DB.engine, 'before_cursor_execute', before_cursor_execute)
+
+    for statement, parameters in statements:
+        # executemany parameters are a list of parameter sets; any one of them will do.
+        if isinstance(parameters, list):
+            parameters = parameters[0]
+        rows = DB.session.connection().exec_driver_sql(
+            'EXPLAIN QUERY PLAN ' + statement, parameters
+        ).all()
+        plans.append((statement, [row[-1] for row in rows]))
+
+
+class QueryPlanTest(TestCase):
+    """ Guards against changes to the schema or queries which would have the hot queries fall back
+    to scanning every metric value. """
+
+    def setUp(self):
+        """ Make sure that the in-memory database is clean before each test method. """
+        DB.session.remove()
+        DB.drop_all()
+        DB.create_all()
+        clear_crypto_pair_metric_cache()
+
+        self.now = datetime.utcnow()
+        for n in range(3):
+            bulk_save_metrics(
+                {'KRAKEN:BTCUSD': {'price': 1.0 + n, 'volume': 2.0 + n}},
+                self.now - timedelta(minutes=n)
+            )
+        self.metric = _get_or_create_crypto_pair_metric('KRAKEN:BTCUSD', 'price')
+
+    def assert_no_full_scans(self, plans):
+        assert plans, 'No statements were captured'
+        for statement, steps in plans:
+            for step in steps:
+                assert not _FULL_SCAN.match(step), '{}\n{}'.format(statement, '\n'.join(steps))
+
+    def test_get_24h_metric_history_uses_index(self):
+        with capture_query_plans() as plans:
+            get_24h_metric_history(self.metric.id, self.now)
+
+        self.assert_no_full_scans(plans)
+        assert any('metric_timestamp_index' in step for _, steps in plans for step in steps)
+
+    def test_get_metric_history_since_uses_index(self):
+        with capture_query_plans() as plans:
+            since = self.now - timedelta(minutes=1)
+            history = get_metric_history_since(self.metric.id, since, self.now)
+
+        assert len(history) == 1
+        self.assert_no_full_scans(plans)
+        assert any('metric_timestamp_index' in step for _, steps in plans for step in steps)
+
+    def test_get_24h_metric_aggregates_uses_index(self):
+        with capture_query_plans() as plans:
+            get_24h_metric_aggregates('price', self.now)
+
+        self.assert_no_full_scans(plans)
+        assert any('metric_timestamp_index' in step for _, steps in plans for step in steps)
+
+    def test_stream_24h_metric_type_values_uses_index(self):
+        with capture_query_plans() as plans:
+            for _ in stream_24h_metric_type_values('price', self.now, 100):
+                pass
+
+        self.assert_no_full_scans(plans)
+        assert any('metric_timestamp_index' in step for _, steps in plans for step in steps)
+
+    def test_get_24h_metric_rollups_uses_index(self):
+        with capture_query_plans() as plans:
+            get_24h_metric_rollups(self.metric.id, 60, self.now)
+
+        self.assert_no_full_scans(plans)
+        assert all(not step.startswith('SCAN') for _, steps in plans for step in steps)
+
+    def test_get_latest_metric_timestamp_uses_index(self):
+        with capture_query_plans() as plans:
+            assert get_latest_metric_timestamp('price') == self.now
+
+        self.assert_no_full_scans(plans)
+        assert any('metric_timestamp_index' in step for _, steps in plans for step in steps)
+
+    def test_get_crypto_pair_metric_uses_index(self):
+        with capture_query_plans() as plans:
+            _get_or_create_crypto_pair_metric('KRAKEN:BTCUSD', 'price')
+
+        assert any('ticker_type_index' in step for _, steps in plans for step in steps)
+
+    def test_bulk_save_metrics_uses_index(self):
+        # Saving a cycle also slides the rolling statistics window, which looks up evicted values.
+        with capture_query_plans() as plans:
+            bulk_save_metrics(
+                {'KRAKEN:BTCUSD': {'price': 9.0, 'volume': 9.0}},
+                self.now + timedelta(days=1)
+            )
+
+        self.assert_no_full_scans(plans)
+
+
+class UpgradeSchemaTest(TestCase):
+
+    def setUp(self):
+        """ Make sure that the in-memory database is clean before each test method. """
+        DB.session.remove()
+        DB.drop_all()
+        DB.create_all()
+        clear_crypto_pair_metric_cache()
+
+    def test_unique_ticker_metric_type(self):
+        DB.session.add(CryptoPairMetric(ticker='KRAKEN:BTCUSD', metric_type='price'))
+        DB.session.add(CryptoPairMetric(ticker='KRAKEN:BTCUSD', metric_type='price'))
+
+        with self.assertRaises(IntegrityError):
+            DB.session.commit()
+        DB.session.rollback()
+
+    def test_upgrade_schema_creates_indexes_and_merges_duplicates(self):
+        # Recreate a database from before the indexes existed, with a duplicated metric.
+        DB.session.remove()
+        with DB.engine.begin() as connection:
+            connection.exec_driver_sql('DROP INDEX ticker_type_index')
+            connection.exec_driver_sql('DROP INDEX metric_timestamp_index')
+
+        now = datetime.utcnow()
+        metrics = [CryptoPairMetric(ticker='KRAKEN:BTCUSD', metric_type='price') for _ in range(3)]
+        for metric in metrics:
+            DB.session.add(metric)
+        DB.session.commit()
+
+        for n, metric in enumerate(metrics):
+            DB.session.add(MetricInstanceValue(
+                custom_metric_id=metric.id,
+                metric_value=float(n),
+                timestamp=now - timedelta(minutes=n)
+            ))
+        DB.session.commit()
+        kept_id = metrics[0].id
+        DB.session.remove()
+
+        upgrade_schema()
+
+        inspector = inspect(DB.engine)
+        assert 'ticker_type_index' in {i['name'] for i in inspector.get_indexes('cryptoMetrics')}
+        assert 'metric_timestamp_index' in {i['name'] for i in inspector.get_indexes('metricValues')}
+
+        # One metric remains, and it has all of the values.
+        assert [m.id for m in CryptoPairMetric.query.all()] == [kept_id]
+        assert MetricInstanceValue.query.filter_by(custom_metric_id=kept_id).count() == 3
+
+        # Running it again on an up to date database is harmless.
+        upgrade_schema()
+        assert CryptoPairMetric.query.count() == 1
@@ -0,0 +1,189 @@
+""" Conformance tests for the storage backends: the same storage operations, run against a SQLite
+database file and against a local PostgreSQL server. The PostgreSQL tests are skipped unless the
+pgserver package (which bundles a PostgreSQL server) and a PostgreSQL driver are installed. """
+
+# Shim the Flask app database creation to use an in-memory SQLite database instead of the
+# filesystem production one, for every other test.
+import os
+os.environ['MONTECARLO_TEST_ENV'] = 'true'
+
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from statistics import mean, stdev
+from tempfile import TemporaryDirectory
+from unittest import TestCase, skipIf
+
+from sqlalchemy import text
+from sqlalchemy.pool import QueuePool
+
+from montecarlo import DB, app
+from montecarlo.metrics.analytics import get_24h_metric_summaries
+from montecarlo.persistence.metrics_manager import (
+    bulk_save_metrics,
+    clear_crypto_pair_metric_cache,
+    get_24h_metric_aggregates,
+    get_24h_metric_history,
+    get_all_crypto_pair_metrics,
+    stream_24h_metric_history,
+    stream_24h_metric_history_columns
+)
+from montecarlo.persistence.models import MetricInstanceValue
+from montecarlo.persistence.storage import SQLiteStorage, ServerStorage, get_storage_backend
+
+try:
+    import pgserver
+    import psycopg2
+except ImportError:
+    pgserver = None
+
+
+class StorageConformanceTests(ABC):
+    """ Tests every storage backend must pass. Mixed into a TestCase per backend, which points the
+    app at its database by implementing start_database and stop_database. """
+
+    @classmethod
+    @abstractmethod
+    def start_database(cls):
+        """ Starts the database, returning its URI. """
+
+    @classmethod
+    def stop_database(cls):
+        pass
+
+    @classmethod
+    def setUpClass(cls):
+        cls.original_database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+        DB.session.remove()
+        app.config['SQLALCHEMY_DATABASE_URI'] = cls.start_database()
+
+    @classmethod
+    def tearDownClass(cls):
+        DB.session.remove()
+        DB.engine.dispose()
+        app.config['SQLALCHEMY_DATABASE_URI'] = cls.original_database_uri
+        cls.stop_database()
+
+    def setUp(self):
+        DB.session.remove()
+        DB.drop_all()
+        DB.create_all()
+        clear_crypto_pair_metric_cache()
+
+        self.now = datetime(2022, 3, 31, 12, 30, 0, 123456)
+        self.btcusd_prices = [1.0, 3.0, 2.0, 4.0]
+        for minutes, price in enumerate(self.btcusd_prices):
+            bulk_save_metrics({
+                'KRAKEN:BTCUSD': {'price': price, 'volume': 10.0 * price},
+                'KRAKEN:ETHUSD': {'price': 100.0 + price}
+            }, self.now - timedelta(minutes=len(self.btcusd_prices) - 1 - minutes))
+
+        self.metric_ids = {
+            (m.ticker, m.metric_type): m.id for m in get_all_crypto_pair_metrics()
+        }
+        self.btcusd_price_id = self.metric_ids[('KRAKEN:BTCUSD', 'price')]
+
+    def tearDown(self):
+        DB.session.remove()
+
+    def test_save_batch_and_list_metrics(self):
+        assert sorted(self.metric_ids) == [
+            ('KRAKEN:BTCUSD', 'price'),
+            ('KRAKEN:BTCUSD', 'volume'),
+            ('KRAKEN:ETHUSD', 'price')
+        ]
+        assert MetricInstanceValue.query.count() == 3 * len(self.btcusd_prices)
+
+        # Later batches reuse the existing metrics
+        bulk_save_metrics({'KRAKEN:BTCUSD': {'price': 5.0}}, self.now + timedelta(minutes=1))
+        assert len(get_all_crypto_pair_metrics()) == 3
+        assert MetricInstanceValue.query.count() == 3 * len(self.btcusd_prices) + 1
+
+    def test_range_query(self):
+        history = get_24h_metric_history(self.btcusd_price_id, self.now)
+        assert [v.metric_value for v in history] == self.btcusd_prices
+
+        # Timestamps come back exactly as saved, as naive UTC
+        assert history[-1].timestamp == self.now
+
+        # The window includes both ends
+        history = get_24h_metric_history(
+            self.btcusd_price_id, self.now - timedelta(minutes=1) + timedelta(days=1)
+        )
+        assert [v.metric_value for v in history] == self.btcusd_prices[-2:]
+
+        rows = [
+            row for rows in stream_24h_metric_history(self.btcusd_price_id, self.now, 3)
+            for row in rows
+        ]
+        assert rows == [(v.timestamp, v.metric_value) for v in
+                        get_24h_metric_history(self.btcusd_price_id, self.now)]
+
+        columns = list(stream_24h_metric_history_columns(self.btcusd_price_id, self.now, 3))
+        assert [len(timestamps) for timestamps, _ in columns] == [3, 1]
+        epoch = datetime(1970, 1, 1)
+        assert columns[-1][0].tolist() == [(self.now - epoch) // timedelta(milliseconds=1)]
+        assert [v for _, values in columns for v in values.tolist()] == self.btcusd_prices
+
+    def test_aggregate_query(self):
+        aggregates = get_24h_metric_aggregates('price', self.now)
+        assert sorted(aggregates) == sorted([
+            self.metric_ids[('KRAKEN:BTCUSD', 'price')],
+            self.metric_ids[('KRAKEN:ETHUSD', 'price')]
+        ])
+
+        count, metric_mean, sum_sq_deviations = aggregates[self.btcusd_price_id]
+        assert count == len(self.btcusd_prices)
+        self.assertAlmostEqual(metric_mean, mean(self.btcusd_prices))
+        self.assertAlmostEqual(
+            sum_sq_deviations, stdev(self.btcusd_prices) ** 2 * (len(self.btcusd_prices) - 1)
+        )
+
+        summary = get_24h_metric_summaries('price', self.now)[self.btcusd_price_id]
+        assert (summary.count, summary.minimum, summary.maximum) == (4, 1.0, 4.0)
+        self.assertAlmostEqual(summary.standard_deviation, stdev(self.btcusd_prices))
+
+        # Nothing in a window before the first value
+        assert get_24h_metric_aggregates('price', self.now - timedelta(hours=1)) == dict()
+
+
+class SQLiteStorageTest(StorageConformanceTests, TestCase):
+
+    @classmethod
+    def start_database(cls):
+        cls.directory = TemporaryDirectory()
+        return 'sqlite:///' + os.path.join(cls.directory.name, 'metrics_db.sqlite')
+
+    @classmethod
+    def stop_database(cls):
+        cls.directory.cleanup()
+
+    def test_connections_configured(self):
+        assert isinstance(get_storage_backend(app.config, DB.engine.url), SQLiteStorage)
+        assert isinstance(DB.engine.pool, QueuePool)
+
+        assert DB.session.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+        assert DB.session.execute(text('PRAGMA foreign_keys')).scalar() == 1
+        assert DB.session.execute(text('PRAGMA busy_timeout')).scalar() == \
+            app.config['METRICS_SQLITE_BUSY_TIMEOUT_MS']
+
+
+@skipIf(pgserver is None, 'pgserver and psycopg2 are needed to run a local PostgreSQL server')
+class PostgreSQLStorageTest(StorageConformanceTests, TestCase):
+
+    @classmethod
+    def start_database(cls):
+        cls.directory = TemporaryDirectory()
+        cls.server = pgserver.get_server(cls.directory.name, cleanup_mode='stop')
+        return cls.server.get_uri()
+
+    @classmethod
+    def stop_database(cls):
+        cls.server.cleanup()
+        cls.directory.cleanup()
+
+    def test_connections_configured(self):
+        assert isinstance(get_storage_backend(app.config, DB.engine.url), ServerStorage)
+        assert isinstance(DB.engine.pool, QueuePool)
+        assert DB.engine.pool.size() == app.config['METRICS_DB_POOL_SIZE']
+
+        assert DB.session.execute(text('SHOW timezone')).scalar() == 'UTC'